@@ -12,7 +12,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from lib.base_action import SharepointBaseAction
+import requests
+from lib.base_action import SharepointBaseAction, DOC_LIBS_URI, normalize_url
+from lib.odata_batch import BatchRequestError
+from lib.site_cache import get_site_tree_cache, DEFAULT_MAX_STALENESS
+
+# Number of site groups fetched from SharePoint at the same time
+DEFAULT_MAX_CONCURRENCY = 10
 
 
 class DocLibList(SharepointBaseAction):
@@ -23,9 +29,88 @@ class DocLibList(SharepointBaseAction):
         """
         super(DocLibList, self).__init__(config)
 
+    # Return the document libraries of a site as a record, or the error that stopped
+    # them from being listed so one failing site doesn't fail the rest
+    def get_site_doc_libs(self, site_url, response):
+        try:
+            return {'SiteUrl': site_url, 'DocLibs': self.parse_doc_libs(response)}
+        except (requests.RequestException, BatchRequestError, ValueError) as error:
+            return {'SiteUrl': site_url, 'Error': str(error)}
+
+    # Return a dict of site URL to doc libs record for a group of sites on the same host
+    def get_doc_libs_group(self, site_urls, auth_token):
+        try:
+            responses = self.batch_request(site_urls[0],
+                                           [site + DOC_LIBS_URI for site in site_urls],
+                                           auth_token)
+        except (requests.RequestException, BatchRequestError):
+            # The $batch request itself failed, e.g. on a site the user can't access,
+            # so every site is requested on its own
+            responses = []
+            for site in site_urls:
+                try:
+                    responses.append(self.rest_request(site + DOC_LIBS_URI, auth_token))
+                except requests.RequestException as error:
+                    responses.append(error)
+
+        records = {}
+        for site, response in zip(site_urls, responses):
+            if isinstance(response, Exception):
+                records[site] = {'SiteUrl': site, 'Error': str(response)}
+            else:
+                records[site] = self.get_site_doc_libs(site, response)
+        return records
+
+    def iter_doc_libs(self, site_urls, auth_token, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """Yield a record with the document libraries of each site in order. Sites on the
+        same host are requested together in $batch requests and the groups are fetched
+        concurrently. A site whose libraries can't be listed gets an Error instead.
+        :param site_urls: List of site URLs
+        :returns: Generator of dicts with the SiteUrl and its DocLibs or Error
+        """
+        return self.imap_site_groups(
+            lambda sites: self.get_doc_libs_group(sites, auth_token), site_urls,
+            self.batch_size, max_concurrency)
+
+    def get_cached_doc_libs(self, site_urls, max_staleness=DEFAULT_MAX_STALENESS):
+        """Return the document libraries of the sites the site tree sensor saved recently
+        enough, without sending any requests
+        :param site_urls: List of site URLs
+        :returns: Dict of site URL to its list of document libraries, sites that aren't
+            cached are left out
+        """
+        cache = get_site_tree_cache(self.config)
+        # Webs whose libraries changed since they were cached are requested again
+        dirty = set(mark['url'] for mark in cache.get_dirty())
+        cached = {}
+        for site in site_urls:
+            web = cache.find_web(site, max_staleness)
+            # A cached web above the site doesn't hold the libraries of the site
+            if web is not None and normalize_url(web['SiteUrl']) == normalize_url(site) and \
+                    normalize_url(site) not in dirty:
+                cached[site] = web['DocLibs']
+        return cached
+
+    def iter_doc_libs_cached(self, site_urls, cached, auth_token,
+                             max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """Yield a record with the document libraries of each site in order, taking them
+        from cached and fetching only the other sites with iter_doc_libs()
+        :param cached: Dict returned by get_cached_doc_libs()
+        """
+        fetched = self.iter_doc_libs([site for site in site_urls if site not in cached],
+                                     auth_token, max_concurrency)
+        for site in site_urls:
+            if site in cached:
+                yield {'SiteUrl': site, 'DocLibs': cached[site]}
+            else:
+                yield next(fetched)
+
     def run(self, domain, output_file, output_file_append, output_type,
             password, site_url, username, token_auth, rsa_private_key,
-            cert_thumbprint, tenent_id, client_id):
+            cert_thumbprint, tenent_id, client_id, output_file_format='json',
+            metrics=False, metrics_file=None, metrics_format='prometheus', site_urls=None,
+            max_concurrency=DEFAULT_MAX_CONCURRENCY, access_token=None, use_cache=False,
+            max_staleness=DEFAULT_MAX_STALENESS):
         """
         Return a list of document libraries on the given site or subsite
 
@@ -36,28 +121,64 @@ class DocLibList(SharepointBaseAction):
             given file or overwrite it
         - output_type: "console" or "file" specifies whether to send output to
             console or save it in a specified file
+        - output_file_format: "json" or "ndjson" format of the output file
         - password: Password to login to sharepoint
         - site_url: URL of the base Sharepoint site
         - username: Username to login to sharepoint
+        - metrics: Boolean, whether to return the count, size, status codes and latency
+            of the requests sent to each endpoint in a _metrics section
+        - metrics_file: (Optional) file to write the request metrics to
+        - metrics_format: "prometheus" or "statsd" format of the metrics file
+        - site_urls: (Optional) list of site URLs to list the document libraries of
+            instead of site_url
+        - max_concurrency: Number of site groups to fetch from SharePoint at the same time
+            when site_urls is given
+        - access_token: (Optional) bearer token to send instead of authenticating with
+            NTLM or the Azure AD app
+        - use_cache: Boolean, whether to take the document libraries of sites the site
+            tree sensor saved recently enough from its cache instead of SharePoint
+        - max_staleness: Maximum age in seconds of cached document libraries that are
+            returned
 
         Returns:
-        - List: List of Sharepoint sites and subsites
+        - List: List of document libraries of site_url, or a record with the SiteUrl
+            and its DocLibs or Error for each site in site_urls
+        - Dict: The result above and the request metrics if metrics is true
         """
-        self.token_auth = token_auth
-
-        if self.token_auth:
-            user_auth = self.create_token_auth_cred(rsa_private_key,
-                                                    cert_thumbprint,
-                                                    tenent_id,
-                                                    client_id,
-                                                    site_url)
-        else:
-            user_auth = self.create_ntlm_auth_cred(domain, username, password)
+        # Remove duplicates while keeping the order of the sites
+        unique_urls = {}
+        for site in site_urls or []:
+            unique_urls.setdefault(normalize_url(site), site.strip().rstrip('/'))
+        site_urls = list(unique_urls.values())
+        if not site_url and not site_urls:
+            raise ValueError('site_url or site_urls must be specified.')
+        # Keep enough pooled connections open for every worker
+        self.pool_size = max(self.pool_size, max_concurrency)
 
-        doc_libs = self.get_doc_libs(site_url, user_auth)
+        cached = self.get_cached_doc_libs(site_urls or [site_url], max_staleness) \
+            if use_cache else {}
+
+        # Sites that are all cached are answered without authenticating
+        user_auth = None
+        if any(site not in cached for site in site_urls or [site_url]):
+            user_auth = self.create_auth_cred(token_auth, domain, username, password,
+                                              rsa_private_key, cert_thumbprint, tenent_id,
+                                              client_id, site_url or site_urls[0],
+                                              access_token)
+
+        if site_urls:
+            doc_libs = self.iter_doc_libs_cached(site_urls, cached, user_auth,
+                                                 max_concurrency)
+            if output_type != 'file':
+                doc_libs = list(doc_libs)
+        elif site_url in cached:
+            doc_libs = cached[site_url]
+        else:
+            doc_libs = self.get_doc_libs(site_url, user_auth)
 
         if output_type == 'file':
-            return self.save_sites_list_to_file(doc_libs, output_file,
-                                                output_file_append)
+            doc_libs = self.save_sites_list_to_file(doc_libs, output_file,
+                                                    output_file_append, output_file_format)
 
-        return doc_libs
+        return self.add_metrics(doc_libs, 'doc_lib_list', metrics, metrics_file,
+                                metrics_format)
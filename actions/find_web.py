@@ -0,0 +1,45 @@
+#!/usr/bin/python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from lib.base_action import SharepointBaseAction
+from lib.site_cache import get_site_tree_cache, DEFAULT_MAX_STALENESS
+
+
+class FindWeb(SharepointBaseAction):
+    def __init__(self, config):
+        """Creates a new BaseAction given a StackStorm config object (kwargs works too)
+        :param config: StackStorm configuration object for the pack
+        :returns: a new BaseAction
+        """
+        super(FindWeb, self).__init__(config)
+
+    def run(self, url, max_staleness=DEFAULT_MAX_STALENESS):
+        """
+        Return the web a URL belongs to from the site tree cache kept by the site tree
+        sensor, without sending any requests to SharePoint
+
+        Args:
+        - url: URL of a web, document library, folder or file
+        - max_staleness: Maximum age in seconds of the cached site tree the web is
+            taken from
+
+        Returns:
+        - Dict: The subsite record of the closest web containing the URL
+        """
+        web = get_site_tree_cache(self.config).find_web(url, max_staleness)
+        if web is None:
+            raise ValueError('No web containing {0} was cached in the last {1} seconds.'
+                             .format(url, max_staleness))
+
+        return web
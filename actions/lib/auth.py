@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import requests
+from lib.token_cache import token_cache_key, token_scope, DEFAULT_EXPIRES_IN
+
+# Every action runs in a new Python process, so the libraries of an auth backend are
+# only imported once that backend is selected. NTLM runs never load msal and its
+# cryptography dependencies, and token runs never load requests_ntlm.
+
+TOKEN_ENDPOINT = 'https://login.microsoftonline.com/{0}/oauth2/v2.0/token'
+
+
+class AuthBackend(object):
+    # Whether the credential is sent as a bearer token instead of being set as the
+    # auth of the pooled sessions
+    bearer = False
+
+    @classmethod
+    def accepts(cls, params):
+        """Return whether the backend authenticates with the given auth parameters
+        """
+        raise NotImplementedError()
+
+    def create_credential(self, action, params):
+        """Return the credential requests are sent with
+        :param action: SharepointBaseAction the credential is for, which holds the token
+            cache and request metrics
+        :param params: Dict of the auth parameters of the action: token_auth, domain,
+            username, password, rsa_private_key, cert_thumbprint, tenent_id, client_id,
+            site_url and access_token
+        """
+        raise NotImplementedError()
+
+
+class BearerBackend(AuthBackend):
+    bearer = True
+
+    @classmethod
+    def accepts(cls, params):
+        return bool(params.get('access_token'))
+
+    def create_credential(self, action, params):
+        """Return an access token that was obtained outside of the pack
+        """
+        return params['access_token']
+
+
+class CertificateBackend(AuthBackend):
+    bearer = True
+
+    @classmethod
+    def accepts(cls, params):
+        return bool(params.get('token_auth'))
+
+    def create_credential(self, action, params):
+        """Return an Azure AD access token for the app certificate. Tokens are cached in
+        the store selected by the token_cache pack config, one per app and SharePoint host.
+        """
+        scope = token_scope(params['site_url'])
+
+        # Reuse a cached token for the same app and host until it is about to expire
+        cache = action.get_token_cache()
+        cache_key = token_cache_key(params['tenent_id'], params['client_id'],
+                                    params['cert_thumbprint'], scope)
+        action.token_identity = cache_key
+        if cache:
+            access_token = cache.get(cache_key)
+            if access_token:
+                return access_token
+
+        token_endpoint = TOKEN_ENDPOINT.format(params['tenent_id'])
+        token_payload = {
+            'client_id': params['client_id'],
+            'scope': scope,
+            'grant_type': 'client_credentials',
+            'client_assertion_type': 'urn:ietf:params:oauth:client-assertion-type:jwt-bearer',
+            'client_assertion': self.create_assertion(params['rsa_private_key'],
+                                                      params['cert_thumbprint'],
+                                                      token_endpoint, params['client_id'])
+        }
+
+        sent_at = time.monotonic()
+        token_response = requests.request('POST', token_endpoint, data=token_payload)
+        action.metrics.record(token_endpoint, token_response.status_code,
+                              len(token_response.content), time.monotonic() - sent_at)
+
+        token_response.raise_for_status()
+
+        token = token_response.json()
+        if cache:
+            cache.set(cache_key, token['access_token'],
+                      token.get('expires_in', DEFAULT_EXPIRES_IN))
+
+        return token['access_token']
+
+    def create_assertion(self, rsa_private_key, cert_thumbprint, token_endpoint, client_id):
+        """Return a client assertion signed with the certificate of an Azure AD app, which
+        is exchanged for an access token at the token endpoint
+        :param rsa_private_key: RSA Private key to sign the client assertion with
+        :param cert_thumbprint: Thumbprint of the certificate uploaded in Azure
+        :param token_endpoint: URL of the token endpoint, the audience of the assertion
+        :param client_id: Client ID of the App in Azure
+        """
+        from msal.oauth2cli import JwtAssertionCreator
+
+        assertion = JwtAssertionCreator(
+            rsa_private_key,
+            algorithm="RS256",
+            sha1_thumbprint=cert_thumbprint,
+            headers={}
+        )
+
+        return assertion.create_normal_assertion(audience=token_endpoint, issuer=client_id)
+
+
+class NtlmBackend(AuthBackend):
+    @classmethod
+    def accepts(cls, params):
+        # The fallback when no other backend applies
+        return True
+
+    def create_credential(self, action, params):
+        """Return an NTLM auth object for the domain, username and password
+        """
+        from requests_ntlm import HttpNtlmAuth
+
+        return HttpNtlmAuth(params['domain'] + "\\" + params['username'], params['password'])
+
+
+# Auth backends by name, in the order they are tried. Add a class here to support
+# another way to authenticate.
+AUTH_BACKENDS = {
+    'bearer': BearerBackend,
+    'certificate': CertificateBackend,
+    'ntlm': NtlmBackend,
+}
+
+
+def get_auth_backend(name):
+    """Return the auth backend registered under the name
+    :param name: Name of the backend, one of AUTH_BACKENDS
+    """
+    if name not in AUTH_BACKENDS:
+        raise ValueError('Unknown auth backend: {0}'.format(name))
+
+    return AUTH_BACKENDS[name]()
+
+
+def select_auth_backend(params):
+    """Return the first auth backend that accepts the auth parameters
+    :param params: Dict of auth parameters, see AuthBackend.create_credential
+    """
+    for backend_cls in AUTH_BACKENDS.values():
+        if backend_cls.accepts(params):
+            return backend_cls()
+
+    raise ValueError('No auth backend accepts the given parameters')
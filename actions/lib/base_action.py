@@ -12,11 +12,76 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import requests
+import hashlib
 import json
+import requests
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, unquote
+from requests.adapters import HTTPAdapter
 from st2common.runners.base_action import Action
-from msal.oauth2cli import JwtAssertionCreator
-from requests_ntlm import HttpNtlmAuth
+from lib.auth import select_auth_backend
+from lib.memo import RequestMemo, DEFAULT_MEMO_SIZE
+from lib.metrics import RequestMetrics, write_metrics
+from lib.odata import normalize_payload, odata_accept, unwrap_result, DEFAULT_ODATA_METADATA
+from lib.odata_batch import (BatchRequestError, build_batch_body, parse_batch_response,
+                             MAX_BATCH_SIZE)
+from lib.output_file import write_records, OUTPUT_FORMATS
+from lib.response_cache import (ResponseCache, build_batch_response, build_response,
+                                response_cache_key, validator_headers, DEFAULT_TTL,
+                                DEFAULT_MAX_SIZE)
+from lib.throttle import (AimdLimiter, retry_delay, RETRY_STATUS_CODES,
+                          THROTTLED_STATUS_CODES, DEFAULT_MAX_RETRIES,
+                          DEFAULT_RETRY_BACKOFF, DEFAULT_RETRY_MAX_DELAY)
+from lib.token_cache import DatastoreTokenCache, FileTokenCache, DEFAULT_REFRESH_MARGIN
+
+# Number of keep-alive connections to hold open per host
+DEFAULT_POOL_SIZE = 10
+# Number of requests to send in a single OData $batch request
+DEFAULT_BATCH_SIZE = 50
+# Where access tokens are cached between action executions
+DEFAULT_TOKEN_CACHE = 'datastore'
+DEFAULT_TOKEN_CACHE_FILE = '/tmp/stackstorm_sharepoint_token_cache.json'
+# Where GET responses are cached between action executions, off by default
+DEFAULT_RESPONSE_CACHE = 'none'
+DEFAULT_RESPONSE_CACHE_FILE = '/tmp/stackstorm_sharepoint_response_cache.sqlite'
+
+# Endpoint to return lists filtered for document libraries
+# The base template 101 is for document libraries
+# https://docs.microsoft.com/en-us/previous-versions/office/
+# sharepoint-server/ee541191(v=office.15)
+DOC_LIBS_URI = '/_api/web/lists?$filter=BaseTemplate eq ' \
+               '101&$select=Title,Id,DocumentTemplateUrl'
+
+# State shared by actions that work together in one execution so they send their
+# requests over the same sessions and token, under the same limits and metrics
+SHARED_ATTRIBUTES = ['action_service', 'token_auth', 'token_identity', 'pool_size', 'sessions',
+                     'sessions_lock', 'limiter', 'form_digests', 'fields', 'metrics', 'memo',
+                     'response_cache_db']
+
+# Web fields the actions use themselves, always selected along with the requested fields
+WEB_FIELDS = ['Id', 'ServerRelativeUrl']
+
+
+def normalize_url(url):
+    """Return a normalized form of a site URL used to compare sites, without
+    percent encoding, surrounding whitespace, trailing slashes or case differences
+    """
+    return unquote(url).strip().rstrip('/').lower()
+
+
+def worker_pool(max_workers, executor=None):
+    """Return a context manager for the given executor, or for a new pool of max_workers
+    threads that is shut down when the context exits. Stages of a crawl share one
+    executor so they don't each start max_workers threads.
+    """
+    if executor is not None:
+        return nullcontext(executor)
+    return ThreadPoolExecutor(max_workers=max_workers)
 
 
 class SharepointBaseAction(Action):
@@ -29,118 +94,634 @@ class SharepointBaseAction(Action):
         super(SharepointBaseAction, self).__init__(config)
         self.token_auth = False
 
+        pack_config = self.config or {}
+        self.pool_size = pack_config.get('pool_size', DEFAULT_POOL_SIZE)
+        self.force_auth = pack_config.get('force_authentication', False)
+        self.batch_size = min(pack_config.get('batch_size', DEFAULT_BATCH_SIZE),
+                              MAX_BATCH_SIZE)
+        self.token_cache = pack_config.get('token_cache', DEFAULT_TOKEN_CACHE)
+        self.token_cache_file = pack_config.get('token_cache_file', DEFAULT_TOKEN_CACHE_FILE)
+        self.token_refresh_margin = pack_config.get('token_refresh_margin',
+                                                    DEFAULT_REFRESH_MARGIN)
+        self.response_cache = pack_config.get('response_cache', DEFAULT_RESPONSE_CACHE)
+        self.response_cache_file = pack_config.get('response_cache_file',
+                                                   DEFAULT_RESPONSE_CACHE_FILE)
+        self.response_cache_ttl = pack_config.get('response_cache_ttl', DEFAULT_TTL)
+        self.response_cache_max_size = pack_config.get('response_cache_max_size',
+                                                       DEFAULT_MAX_SIZE)
+        self.max_retries = pack_config.get('max_retries', DEFAULT_MAX_RETRIES)
+        self.retry_backoff = pack_config.get('retry_backoff', DEFAULT_RETRY_BACKOFF)
+        self.retry_max_delay = pack_config.get('retry_max_delay', DEFAULT_RETRY_MAX_DELAY)
+        self.adaptive_concurrency = pack_config.get('adaptive_concurrency', True)
+        self.odata_metadata = pack_config.get('odata_metadata', DEFAULT_ODATA_METADATA)
+        # GET responses shared by the requests of this run that ask for the same URL
+        self.memo = RequestMemo(pack_config.get('memo_size', DEFAULT_MEMO_SIZE))
+        # Created on first use so it starts at the pool size set by the action
+        self.limiter = None
+        # Created on first use and kept for every request of the run
+        self.response_cache_db = None
+
+        # Identifies the app a bearer token belongs to so cached responses outlive the token
+        self.token_identity = None
+
+        # Pooled sessions keyed by host and credential so NTLM authenticated
+        # connections are reused instead of re-negotiated on every request
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+        # Form digests for POST requests keyed by site URL
+        self.form_digests = {}
+
+        # Web fields to request, set by actions with a fields parameter. None returns
+        # every field.
+        self.fields = None
+
+        # Counts, sizes and latencies of the requests sent, by endpoint
+        self.metrics = RequestMetrics()
+
     def get_doc_libs(self, base_url, auth_token):
-        # Endpoint to return lists filtered for document libraries
-        # The base template 101 is for document libraries
-        # https://docs.microsoft.com/en-us/previous-versions/office/
-        # sharepoint-server/ee541191(v=office.15)
-        endpoint_uri = '/_api/web/lists?$filter=BaseTemplate eq ' \
-                       '101&$select=Title,Id,DocumentTemplateUrl'
-        result = self.rest_request(base_url + endpoint_uri, auth_token)
+        result = self.rest_request(base_url + DOC_LIBS_URI, auth_token)
+
+        return self.parse_doc_libs(result)
+
+    def get_doc_libs_batch(self, batch_url, site_urls, auth_token):
+        """Return the document libraries for each of the given sites using $batch requests
+        :param batch_url: URL of the site to send the $batch requests to
+        :param site_urls: List of site URLs to get the document libraries for
+        :param auth_token: NTLM auth object or bearer token used for the requests
+        :returns: List with the document libraries of each site in the same order
+        """
+        responses = self.batch_request(batch_url,
+                                       [site + DOC_LIBS_URI for site in site_urls],
+                                       auth_token)
+
+        return [self.parse_doc_libs(response) for response in responses]
+
+    def parse_doc_libs(self, response):
+        """Return the document libraries from a doc libs response.
+        Raises an error naming the request if it failed.
+        """
+        response.raise_for_status()
+        return self.parse_json(response)
+
+    def parse_json(self, response):
+        """Return the body of a JSON response normalized so it has the same shape
+        whatever OData metadata level was requested. Collections are lists and entities
+        are dicts without the __metadata and __deferred properties.
+        """
+        return normalize_payload(response.json())
+
+    def select_fields(self, endpoint, required=WEB_FIELDS):
+        """Return the endpoint with a $select of the fields set on the action so SharePoint
+        only returns those, or the endpoint as it is if no fields are set
+        :param endpoint: URL or path of a REST endpoint returning webs
+        :param required: List of fields that are always selected since the action uses them
+        """
+        if not self.fields:
+            return endpoint
+
+        fields = list(required) + [field for field in self.fields if field not in required]
+        separator = '&' if '?' in endpoint else '?'
+        return endpoint + separator + '$select=' + ','.join(fields)
+
+    def batch_request(self, batch_url, endpoints, auth_token, use_cache=True):
+        """Send GET requests for all of the given endpoints using OData $batch requests
+        holding up to batch_size requests each. If batching is disabled (batch_size
+        less than 2) every endpoint is requested on its own instead.
+        :param batch_url: URL of the site to send the $batch requests to
+        :param endpoints: List of absolute URLs to GET
+        :param auth_token: NTLM auth object or bearer token used for the requests
+        :param use_cache: Boolean, whether responses can come from the response cache
+        :returns: List of responses in the same order as the endpoints. Each response
+            has to be checked with raise_for_status() since failures are per request.
+        """
+        if self.batch_size < 2:
+            return [self.rest_request(endpoint, auth_token, use_cache=use_cache)
+                    for endpoint in endpoints]
+        if not use_cache:
+            return self.send_batch_requests(batch_url, endpoints, auth_token, False)
+
+        # Endpoints this run already requested, or is requesting on another thread, share
+        # that response. The rest are sent here and shared with later requests.
+        claims = [self.memo.claim(normalize_url(endpoint)) for endpoint in endpoints]
+        owned = [index for index, (_, owner) in enumerate(claims) if owner]
+        try:
+            responses = self.send_batch_requests(batch_url,
+                                                 [endpoints[index] for index in owned],
+                                                 auth_token)
+        except BaseException as error:
+            for index in owned:
+                self.memo.resolve(normalize_url(endpoints[index]), claims[index][0],
+                                  error=error)
+            raise
+        for index, response in zip(owned, responses):
+            self.memo.resolve(normalize_url(endpoints[index]), claims[index][0], response)
+
+        return [future.result() for future, _ in claims]
+
+    def send_batch_requests(self, batch_url, endpoints, auth_token, use_cache=True):
+        """Send GET requests for the endpoints in $batch requests of up to batch_size
+        requests each, using the response cache if use_cache is true
+        :returns: List of responses in the same order as the endpoints
+        """
+        # Fresh cached responses are used as they are, the rest are requested and
+        # cached responses that expired are sent with their validators
+        cache = self.get_response_cache() if use_cache else None
+        accept = odata_accept(self.odata_metadata)
+        responses = [None] * len(endpoints)
+        requests_to_send = []
+        for index, endpoint in enumerate(endpoints):
+            key = None
+            entry = None
+            if cache:
+                key = self.get_response_cache_key(endpoint, auth_token, accept)
+                entry = cache.get(key)
+                if entry and entry['fresh']:
+                    self.metrics.record_cache_hit(endpoint)
+                    responses[index] = build_batch_response(entry, endpoint)
+                    continue
+            requests_to_send.append((index, key, entry))
+
+        for start in range(0, len(requests_to_send), self.batch_size):
+            chunk = requests_to_send[start:start + self.batch_size]
+            urls = [endpoints[index] for index, _, _ in chunk]
+            request_headers = [validator_headers(entry) if entry else {}
+                               for _, _, entry in chunk]
+
+            chunk_responses = self.send_batch(batch_url, urls, request_headers, auth_token)
+            for (index, key, entry), response in zip(chunk, chunk_responses):
+                if entry and response.status_code == 304:
+                    # Not modified, the cached response is still good
+                    cache.refresh(key)
+                    response = build_batch_response(entry, response.url)
+                elif cache and response.status_code == 200:
+                    cache.set(key, response.status_code, response.headers,
+                              response.text.encode('utf-8'))
+                responses[index] = response
+
+        return responses
+
+    def send_batch(self, batch_url, urls, request_headers, auth_token):
+        """Send a single $batch request with a GET for each of the given URLs. Requests in
+        the batch that SharePoint throttled are sent again in another $batch request,
+        waiting between attempts like rest_request does.
+        :param batch_url: URL of the site to send the $batch request to
+        :param urls: List of absolute URLs to GET
+        :param request_headers: List with a dict of extra headers for each request
+        :param auth_token: NTLM auth object or bearer token used for the requests
+        :returns: List of BatchResponse objects in the same order as the URLs
+        """
+        responses = [None] * len(urls)
+        pending = list(range(len(urls)))
+        for attempt in range(self.max_retries + 1):
+            boundary = "batch_{0}".format(uuid.uuid4())
+            headers = {'content-type': 'multipart/mixed; boundary=' + boundary}
+            digest = self.get_form_digest(batch_url, auth_token)
+            if digest:
+                headers['X-RequestDigest'] = digest
+
+            body = build_batch_body([urls[index] for index in pending], boundary,
+                                    accept=odata_accept(self.odata_metadata),
+                                    headers=[request_headers[index] for index in pending])
+            result = self.rest_request(batch_url.rstrip('/') + '/_api/$batch', auth_token,
+                                       'POST', body, headers=headers)
+            result.raise_for_status()
+
+            batch_responses = parse_batch_response([urls[index] for index in pending],
+                                                   result.headers['content-type'],
+                                                   result.text)
+            retry = []
+            for index, response in zip(pending, batch_responses):
+                self.metrics.record(response.url, response.status_code,
+                                    len(response.text.encode('utf-8')))
+                responses[index] = response
+                if response.status_code in RETRY_STATUS_CODES:
+                    retry.append(index)
+
+            if not retry:
+                break
+            if attempt == self.max_retries:
+                raise BatchRequestError(responses[retry[0]])
+
+            time.sleep(retry_delay(responses[retry[0]].headers, attempt, self.retry_backoff,
+                                   self.retry_max_delay))
+            pending = retry
+
+        return responses
+
+    def get_form_digest(self, site_url, auth_token):
+        """Return the form digest SharePoint requires on POST requests made with NTLM
+        authentication. Digests are reused until shortly before they time out.
+        :param site_url: URL of the site the POST requests are sent to
+        :param auth_token: NTLM auth object or bearer token used for the requests
+        :returns: Form digest value or None when using token authentication
+        """
+        # Requests with a bearer token don't need a form digest
+        if self.token_auth:
+            return None
+
+        site_url = site_url.rstrip('/')
+        digest = self.form_digests.get(site_url)
+        if digest and digest[1] > time.time():
+            return digest[0]
+
+        result = self.rest_request(site_url + '/_api/contextinfo', auth_token, 'POST')
+        result.raise_for_status()
+        info = unwrap_result(self.parse_json(result), 'GetContextWebInformation')
+
+        # Refresh the digest a minute before it times out
+        expires_at = time.time() + info['FormDigestTimeoutSeconds'] - 60
+        self.form_digests[site_url] = (info['FormDigestValue'], expires_at)
+
+        return info['FormDigestValue']
+
+    def post_request(self, site_url, endpoint, auth_token, payload=None, headers=None):
+        """Send a POST request to a SharePoint REST method along with the form digest
+        of the site when one is needed
+        :param site_url: URL of the site the endpoint belongs to
+        :param endpoint: Absolute URL of the REST method
+        :param auth_token: NTLM auth object or bearer token used for the request
+        :param payload: (Optional) JSON serializable request body
+        :param headers: (Optional) dict of headers to add, e.g. X-HTTP-Method to update
+            or delete an object
+        :returns: result from the rest request
+        """
+        headers = dict(headers or {})
+        digest = self.get_form_digest(site_url, auth_token)
+        if digest:
+            headers['X-RequestDigest'] = digest
+
+        data = json.dumps(payload) if payload is not None else None
+        return self.rest_request(endpoint, auth_token, 'POST', data, headers=headers)
+
+    def map_concurrent(self, func, args_list, max_concurrency, hosts=None,
+                       host_concurrency=0):
+        """Call func with each set of arguments on a bounded pool of worker threads
+        :param func: Function to call
+        :param args_list: List of argument tuples, func is called once for each
+        :param max_concurrency: Maximum number of calls running at the same time
+        :param hosts: (Optional) list with the host each call talks to
+        :param host_concurrency: Maximum number of calls running at the same time for a
+            single host. 0 means no limit other than max_concurrency.
+        :returns: List of results in the same order as args_list
+        """
+        return list(self.imap_concurrent(func, args_list, max_concurrency, hosts,
+                                         host_concurrency))
+
+    def imap_concurrent(self, func, args_list, max_concurrency, hosts=None,
+                        host_concurrency=0, executor=None):
+        """Generator version of map_concurrent that yields each result in order as soon
+        as it is available. Only a window of twice max_concurrency calls is started
+        ahead of the results that have been consumed, so memory use stays bounded.
+        :param executor: (Optional) executor to run the calls on instead of a new pool
+        """
+        semaphores = {}
+        if hosts and host_concurrency > 0:
+            for host in set(hosts):
+                semaphores[host] = threading.BoundedSemaphore(host_concurrency)
+
+        def call(index):
+            semaphore = semaphores.get(hosts[index]) if semaphores else None
+            if semaphore is None:
+                return func(*args_list[index])
+            with semaphore:
+                return func(*args_list[index])
+
+        max_workers = max(1, max_concurrency)
+        with worker_pool(max_workers, executor) as executor:
+            futures = deque()
+            for index in range(len(args_list)):
+                futures.append(executor.submit(call, index))
+                if len(futures) >= max_workers * 2:
+                    yield futures.popleft().result()
+
+            while futures:
+                yield futures.popleft().result()
 
-        return result.json()['d']['results']
+    def imap_site_groups(self, func, site_urls, group_size, max_concurrency,
+                         host_concurrency=0, executor=None):
+        """Call func for groups of the given sites that are on the same host and yield the
+        value it returns for each site in order. Sites are taken in windows of group_size,
+        so a window fits in a single $batch request, and the groups are fetched
+        concurrently with imap_concurrent().
+        :param func: Function called with a list of sites on one host, returning a dict of
+            site URL to value
+        :param site_urls: List of site URLs
+        :param group_size: Number of sites in each window
+        :param max_concurrency: Maximum number of groups fetched at the same time
+        :param host_concurrency: Maximum number of groups fetched from a single host at the
+            same time, 0 for no limit
+        :param executor: (Optional) executor to fetch the groups on instead of a new pool
+        :returns: Generator of the value of each site in the order of site_urls
+        """
+        group_size = max(1, group_size)
+        args_list = []
+        hosts = []
+        windows = []
+        for start in range(0, len(site_urls), group_size):
+            window = site_urls[start:start + group_size]
+            groups = {}
+            for site in window:
+                groups.setdefault(urlparse(site).netloc.lower(), []).append(site)
+            for host, sites in groups.items():
+                args_list.append((sites,))
+                hosts.append(host)
+            windows.append((window, len(groups)))
+
+        results = self.imap_concurrent(func, args_list, max_concurrency, hosts,
+                                       host_concurrency, executor)
+        for window, group_count in windows:
+            values = {}
+            for _ in range(group_count):
+                values.update(next(results))
+            for site in window:
+                yield values[site]
 
     def rest_request(self, endpoint, auth_token, method='GET',
-                     payload=None, ssl_verify=False):
+                     payload=None, ssl_verify=False, headers=None, use_cache=True):
         """Establish a connection with the sharepoint url and return the results
         :param endpoint: Sharepooint endpoint to connect to
+        :param headers: (Optional) dict of headers to add to or override the defaults
+        :param use_cache: Boolean, whether a GET response can come from the response cache
+            or another request of this run for the same URL
         :returns: result from the rest request
         """
-        headers = {
-            'accept': 'application/json;odata=verbose',
+        if use_cache and method == 'GET' and not headers:
+            return self.memo.get(normalize_url(endpoint), self.send_rest_request, endpoint,
+                                 auth_token, method, payload, ssl_verify, headers, use_cache)
+
+        return self.send_rest_request(endpoint, auth_token, method, payload, ssl_verify,
+                                      headers, use_cache)
+
+    def send_rest_request(self, endpoint, auth_token, method='GET', payload=None,
+                          ssl_verify=False, headers=None, use_cache=True):
+        """Send a request to SharePoint through the response cache, see rest_request
+        """
+        # Request bodies are always sent in the verbose format since POST payloads
+        # carry their type in __metadata
+        request_headers = {
+            'accept': odata_accept(self.odata_metadata),
             'content-type': 'application/json;odata=verbose',
-            'odata': 'verbose',
-            'X-RequestForceAuthentication': 'true'
+            'odata': 'verbose'
         }
+        request_headers.update(headers or {})
+
+        # Fresh cached responses skip the network, expired ones are revalidated
+        cache = self.get_response_cache() if use_cache and method == 'GET' else None
+        entry = None
+        if cache:
+            key = self.get_response_cache_key(endpoint, auth_token, request_headers['accept'])
+            entry = cache.get(key)
+            if entry and entry['fresh']:
+                self.metrics.record_cache_hit(endpoint)
+                return build_response(entry, endpoint)
+            if entry:
+                request_headers.update(validator_headers(entry))
+
+        # Forcing authentication makes SharePoint re-run the NTLM handshake on every
+        # request even over a kept-alive connection so it is opt-in only
+        if self.force_auth:
+            request_headers['X-RequestForceAuthentication'] = 'true'
 
         if self.token_auth:
-            headers['Authorization'] = "Bearer {0}".format(auth_token)
-            result = requests.request(method, endpoint, data=payload,
-                                      headers=headers, verify=ssl_verify)
-        else:
-            result = requests.request(method, endpoint, auth=auth_token, data=payload,
-                                      headers=headers, verify=ssl_verify)
+            request_headers['Authorization'] = "Bearer {0}".format(auth_token)
+
+        session = self.get_session(endpoint, auth_token)
+        result = self.send_request(session, method, endpoint, data=payload,
+                                   headers=request_headers, verify=ssl_verify)
+
+        if entry and result.status_code == 304:
+            cache.refresh(key)
+            return build_response(entry, endpoint)
+        if cache and result.status_code == 200:
+            cache.set(key, result.status_code, result.headers, result.content)
 
         return result
 
-    def create_token_auth_cred(self,
-                               rsa_private_key,
-                               cert_thumbprint,
-                               tenent_id,
-                               client_id,
-                               site_url):
-        """Create and return an NTLM auth object which will be used to make REST requests
-        :param domain: Domain for the given username
-        :param password: Password to login to sharepoint
-        :param username: Username to login to sharepoint
-        :returns: NTLM auth object to make REST requests
-        """
-        assertion = JwtAssertionCreator(
-            rsa_private_key,
-            algorithm="RS256",
-            sha1_thumbprint=cert_thumbprint,
-            headers={}
-        )
-
-        token_endpoint = "https://login.microsoftonline.com/{0}/oauth2/v2.0/token".format(tenent_id)
-
-        client_assertion = assertion.create_normal_assertion(
-            audience=token_endpoint,
-            issuer=client_id
-        )
-
-        token_scope = "{0}/.default".format(site_url)
-
-        print(client_assertion)
-
-        token_payload = {
-            'client_id': client_id,
-            'scope': token_scope,
-            'grant_type': 'client_credentials',
-            'client_assertion_type': 'urn:ietf:params:oauth:client-assertion-type:jwt-bearer',
-            'client_assertion': client_assertion
-        }
+    def send_request(self, session, method, endpoint, **kwargs):
+        """Send a request on the session, retrying throttled and transient failures.
+        The Retry-After header SharePoint sends with throttled responses is honored,
+        other failures are retried with jittered exponential backoff. Requests wait for
+        the adaptive concurrency limiter, which is cut when requests are throttled.
+        :param session: requests Session to send the request on
+        :param kwargs: Arguments passed on to session.request()
+        :returns: The response
+        :raises requests.HTTPError: if the request was still throttled after max_retries
+        """
+        limiter = self.get_limiter()
+        for attempt in range(self.max_retries + 1):
+            started = limiter.acquire() if limiter else None
+            result = None
+            sent_at = time.monotonic()
+            try:
+                result = session.request(method, endpoint, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+            finally:
+                if limiter:
+                    limiter.release(started, result is not None and
+                                    result.status_code in THROTTLED_STATUS_CODES)
+                self.metrics.record(endpoint,
+                                    result.status_code if result is not None else None,
+                                    len(result.content) if result is not None else 0,
+                                    time.monotonic() - sent_at)
+
+            if result is not None and result.status_code not in RETRY_STATUS_CODES:
+                return result
+            if attempt == self.max_retries:
+                # Fail with the status instead of letting callers parse the error body
+                result.raise_for_status()
+                return result
+
+            time.sleep(retry_delay(result.headers if result is not None else None, attempt,
+                                   self.retry_backoff, self.retry_max_delay))
+
+    def get_limiter(self):
+        """Return the adaptive concurrency limiter shared by every request of the action
+        :returns: AimdLimiter object or None if adaptive concurrency is disabled
+        """
+        if not self.adaptive_concurrency:
+            return None
+
+        with self.sessions_lock:
+            if self.limiter is None:
+                self.limiter = AimdLimiter(self.pool_size)
+
+        return self.limiter
 
-        token_response = requests.request('POST', token_endpoint, data=token_payload)
+    def get_response_cache(self):
+        """Return the response cache selected in the pack config
+        :returns: ResponseCache object or None if caching is disabled
+        """
+        if self.response_cache != 'sqlite':
+            return None
 
-        token_response.raise_for_status()
+        with self.sessions_lock:
+            if self.response_cache_db is None:
+                self.response_cache_db = ResponseCache(self.response_cache_file,
+                                                       self.response_cache_ttl,
+                                                       self.response_cache_max_size)
 
-        return token_response.json()['access_token']
+        return self.response_cache_db
 
-    def create_ntlm_auth_cred(self, domain, username, password):
-        """Create and return an NTLM auth object which will be used to make REST requests
-        :param domain: Domain for the given username
-        :param password: Password to login to sharepoint
-        :param username: Username to login to sharepoint
-        :returns: NTLM auth object to make REST requests
+    def get_response_cache_key(self, endpoint, auth_token, accept):
+        """Return the key the response to a GET request is cached under. Responses are
+        cached per credential since SharePoint trims results to what the caller can see.
         """
-        login_user = domain + "\\" + username
-        return HttpNtlmAuth(login_user, password)
+        if self.token_auth and self.token_identity:
+            identity = 'bearer:' + self.token_identity
+        else:
+            identity = self.get_session_key(endpoint, auth_token)[1]
 
-    def save_sites_list_to_file(self, site_objs, file_path, file_append):
+        return response_cache_key('GET', endpoint, identity, accept)
+
+    def get_session_key(self, endpoint, auth_token):
+        """Return the key used to look up the pooled session for a request
+        :param endpoint: Sharepoint endpoint the request is sent to
+        :param auth_token: NTLM auth object or bearer token used for the request
+        :returns: tuple of the host and a hash identifying the credential
+        """
+        url = urlparse(endpoint)
+        host = "{0}://{1}".format(url.scheme, url.netloc).lower()
+
+        if self.token_auth:
+            identity = "bearer:{0}".format(auth_token)
+        else:
+            identity = "ntlm:{0}:{1}".format(getattr(auth_token, 'username', auth_token),
+                                             getattr(auth_token, 'password', ''))
+
+        return (host, hashlib.sha256(identity.encode('utf-8')).hexdigest())
+
+    def get_session(self, endpoint, auth_token):
+        """Return a keep-alive session for the host and credential of the given request.
+        Sessions are created on first use and shared by every later request.
+        :param endpoint: Sharepoint endpoint the request is sent to
+        :param auth_token: NTLM auth object or bearer token used for the request
+        :returns: requests Session object
+        """
+        key = self.get_session_key(endpoint, auth_token)
+
+        with self.sessions_lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+
+                if not self.token_auth:
+                    session.auth = auth_token
+
+                self.sessions[key] = session
+
+        return session
+
+    def close_sessions(self):
+        """Close every pooled session and the connections they hold open
+        """
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+    def get_token_cache(self):
+        """Return the access token cache selected in the pack config
+        :returns: TokenCache object or None if caching is disabled
+        """
+        if self.token_cache == 'datastore' and self.action_service:
+            return DatastoreTokenCache(self.action_service, self.token_refresh_margin)
+        elif self.token_cache == 'file':
+            return FileTokenCache(self.token_cache_file, self.token_refresh_margin)
+
+        return None
+
+    def create_auth_cred(self, token_auth, domain, username, password, rsa_private_key,
+                         cert_thumbprint, tenent_id, client_id, site_url, access_token=None):
+        """Return the credential for the auth backend selected by the action parameters
+        and set token_auth to match. A pre-supplied access_token is used as it is,
+        token_auth requests a token with the certificate of an Azure AD app and NTLM is
+        used otherwise. Only the libraries of the selected backend are imported.
+        :param site_url: URL of the Sharepoint site a requested token is for
+        :param access_token: (Optional) bearer token obtained outside of the pack
+        :returns: NTLM auth object or bearer token to make REST requests
+        """
+        params = {'token_auth': token_auth, 'domain': domain, 'username': username,
+                  'password': password, 'rsa_private_key': rsa_private_key,
+                  'cert_thumbprint': cert_thumbprint, 'tenent_id': tenent_id,
+                  'client_id': client_id, 'site_url': site_url, 'access_token': access_token}
+        backend = select_auth_backend(params)
+
+        # Bearer credentials are sent as a header, the others are set as the session auth
+        self.token_auth = backend.bearer
+        return backend.create_credential(self, params)
+
+    def create_auth_cred_from_config(self, credentials):
+        """Return the credential for the auth parameters in a section of the pack config,
+        for sensors which have no action parameters to take them from
+        :param credentials: Dict with the base_url and the auth parameters of the actions
+        """
+        return self.create_auth_cred(credentials.get('token_auth', False),
+                                     credentials.get('domain'), credentials.get('username'),
+                                     credentials.get('password'),
+                                     credentials.get('rsa_private_key'),
+                                     credentials.get('cert_thumbprint'),
+                                     credentials.get('tenent_id'), credentials.get('client_id'),
+                                     credentials.get('base_url'))
+
+    def save_sites_list_to_file(self, site_objs, file_path, file_append,
+                                file_format='json'):
         """Write the given list of sharepoint sites to the specified file
-        :param site_objs: List of Sharepoint site objects
+        :param site_objs: List or generator of Sharepoint site objects. Sites are written
+            as they are generated so the whole list is never held in memory.
         :param file_path: Path to the file that will store the list of sites
         :param file_append: Boolean, if true append sites to end of file otherwise overwrite it
+        :param file_format: "json" to save a JSON array or "ndjson" to save one site per line
         """
         if not file_path:
             raise ValueError('output_file path must be specified to save output to file.')
+        if file_format not in OUTPUT_FORMATS:
+            raise ValueError('Unknown output file format: {0}'.format(file_format))
 
-        # If appending sites to the file then read in the file first before overwriting it
-        if file_append:
-            file = open(file_path, 'r')
-            sites_list = json.loads(file.read())
-            file.close()
-            sites_list.extend(site_objs)
-        else:
-            sites_list = site_objs
-
-        with open(file_path, 'w') as outfile:
-            json.dump(sites_list, outfile)
-            outfile.close()
+        write_records(site_objs, file_path, file_append, file_format)
 
         return 'Output saved to: ' + file_path
 
+    def create_shared_action(self, action_cls):
+        """Return a new action of the given class that shares this action's sessions,
+        token, concurrency limiter, memo and metrics, so one execution can use the methods
+        of several actions without authenticating or connecting again
+        :param action_cls: SharepointBaseAction subclass to create
+        """
+        action = action_cls(self.config)
+        # Created now so both actions hold the same limiter and response cache
+        self.get_limiter()
+        self.get_response_cache()
+        for name in SHARED_ATTRIBUTES:
+            setattr(action, name, getattr(self, name))
+
+        return action
+
+    def add_metrics(self, result, action, include_metrics=False, metrics_file=None,
+                    metrics_format='prometheus'):
+        """Return the result of an action run along with the metrics of the requests it
+        sent, if asked for, and write the metrics to a file
+        :param result: Result of the action
+        :param action: Name of the action, used as a label in the metrics file
+        :param include_metrics: Boolean, whether to return the metrics with the result
+        :param metrics_file: (Optional) path to write the metrics to
+        :param metrics_format: "prometheus" or "statsd" format of the metrics file
+        :returns: The result, or a dict with the result and a _metrics section
+        """
+        if metrics_file:
+            write_metrics(self.metrics, metrics_file, metrics_format, action)
+
+        if include_metrics:
+            return {'result': result, '_metrics': self.metrics.as_dict()}
+
+        return result
+
     # Need this method here because of the following error with unit tests
     # TypeError: Can't instantiate class with abstract methods run
     def run(self, **kwargs):
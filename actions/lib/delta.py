@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from lib.json_store import JsonStore, store_key
+
+# Change types returned by SharePoint in SP.Change objects
+CHANGE_TYPE_DELETE = 3
+
+
+def checkpoint_key(action, *scope):
+    """Return the key the inventory of an action run is checkpointed under, so one
+    checkpoint file can hold the inventories of several actions and scopes
+    :param action: Name of the action
+    :param scope: Values identifying what the action inventoried
+    :returns: String key
+    """
+    return store_key(action, *scope)
+
+
+class DeltaCheckpoint(JsonStore):
+    def __init__(self, file_path):
+        """Checkpoint index of a previous inventory used to only re-fetch what changed.
+        Each checkpoint key has one entry in the JSON store file.
+        :param file_path: Path to the checkpoint file
+        """
+        super(DeltaCheckpoint, self).__init__(file_path)
+
+
+def subtree_end(records, index):
+    """Return the index just past the subtree of the web at the given index in a list
+    of webs in depth-first order
+    """
+    prefix = records[index]['ServerRelativeUrl'].rstrip('/').lower() + '/'
+    end = index + 1
+    while end < len(records) and \
+            records[end]['ServerRelativeUrl'].lower().startswith(prefix):
+        end += 1
+
+    return end
+
+
+def find_web(records, web_id):
+    """Return the index of the web with the given ID or None if it isn't in the list
+    """
+    web_id = web_id.lower()
+    for index, record in enumerate(records):
+        if record['Id'].lower() == web_id:
+            return index
+
+    return None
+
+
+def find_parent(records, url):
+    """Return the index of the closest web whose URL contains the given URL or None
+    if none of the webs in the list do
+    """
+    url = url.lower()
+    parent = None
+    parent_length = -1
+    for index, record in enumerate(records):
+        parent_url = record['ServerRelativeUrl'].rstrip('/').lower()
+        if url.startswith(parent_url + '/') and len(parent_url) > parent_length:
+            parent = index
+            parent_length = len(parent_url)
+
+    return parent
+
+
+def replace_subtree(records, web_id, subtree):
+    """Replace the subtree of a web in a list of webs in depth-first order. Webs that
+    weren't in the list are inserted after the last subsite of their parent, or at
+    the end if the parent isn't in the list either.
+    :param records: List of webs in depth-first order, updated in place
+    :param web_id: ID of the web whose subtree is replaced
+    :param subtree: List of webs that replace the subtree, empty to remove it
+    """
+    index = find_web(records, web_id)
+    if index is not None:
+        records[index:subtree_end(records, index)] = subtree
+        return
+
+    if not subtree:
+        return
+
+    parent = find_parent(records, subtree[0]['ServerRelativeUrl'])
+    position = len(records) if parent is None else subtree_end(records, parent)
+    records[position:position] = subtree
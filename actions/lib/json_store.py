@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+
+def store_key(prefix, *scope):
+    """Return a key for an entry of a JSON store, so one file can hold the entries of
+    several actions or sensors and scopes
+    :param prefix: Name the key starts with, e.g. the action the entry belongs to
+    :param scope: Values identifying what the entry is about
+    :returns: String key
+    """
+    identity = json.dumps([prefix] + list(scope), sort_keys=True)
+    return prefix + '.' + hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+class JsonStore(object):
+    def __init__(self, file_path):
+        """Keyed store of JSON entries in a local file. The file holds a JSON object with
+        one entry per key. It is replaced atomically and locked while it is written so a
+        crash never leaves it half written and concurrent writers don't lose entries.
+        :param file_path: Path to the store file
+        """
+        self.file_path = file_path
+
+    def read_entries(self):
+        try:
+            with open(self.file_path, 'r') as file:
+                data = file.read()
+        except IOError:
+            return {}
+
+        return json.loads(data) if data else {}
+
+    def load(self, key):
+        """Return the entry for the key or None if there isn't one
+        """
+        return self.read_entries().get(key)
+
+    def save(self, key, entry):
+        """Store the entry for the key, keeping the entries of other keys
+        """
+        self.update(key, entry)
+
+    def remove(self, key):
+        """Remove the entry for the key if there is one
+        """
+        self.update(key, None)
+
+    def update(self, key, entry):
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        with open(self.file_path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self.read_entries()
+            if entry is None:
+                entries.pop(key, None)
+            else:
+                entries[key] = entry
+
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.json_store')
+            try:
+                with os.fdopen(fd, 'w') as file:
+                    json.dump(entries, file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.file_path)
+            except Exception:
+                os.remove(temp_path)
+                raise
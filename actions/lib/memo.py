@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+# Number of finished lookups kept for the rest of the run. Each one holds a whole
+# response body, so this stays small.
+DEFAULT_MEMO_SIZE = 100
+
+
+class RequestMemo(object):
+    def __init__(self, max_size=DEFAULT_MEMO_SIZE):
+        """Shares the results of lookups that are repeated within a single run, like the
+        document libraries of a web that is reached twice. A lookup that is still running
+        is waited for instead of being sent again, and only the results of the last max_size
+        lookups are kept. Failed lookups are forgotten so a later call tries again.
+        :param max_size: Number of finished lookups to keep, 0 turns sharing off
+        """
+        self.max_size = max_size
+        self.futures = OrderedDict()
+        self.lock = threading.Lock()
+
+    def claim(self, key):
+        """Return the future holding the result of the lookup for the key and whether the
+        caller owns the lookup. Owners have to pass the result to resolve(), everybody
+        else waits for it with future.result().
+        """
+        with self.lock:
+            future = self.futures.get(key)
+            if future is not None:
+                self.futures.move_to_end(key)
+                return future, False
+
+            future = Future()
+            self.futures[key] = future
+            while len(self.futures) > self.max_size:
+                self.futures.popitem(last=False)
+
+        return future, True
+
+    def resolve(self, key, future, result=None, error=None):
+        """Finish a lookup claimed with claim(), with its result or the error it raised
+        """
+        if error is None:
+            future.set_result(result)
+            return
+
+        with self.lock:
+            if self.futures.get(key) is future:
+                del self.futures[key]
+        future.set_exception(error)
+
+    def get(self, key, func, *args, **kwargs):
+        """Return the result of func for the key, calling it only if no other call for
+        the key finished or is running
+        """
+        future, owner = self.claim(key)
+        if owner:
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as error:
+                self.resolve(key, future, error=error)
+                raise
+            self.resolve(key, future, result)
+
+        return future.result()
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import re
+import tempfile
+import threading
+from urllib.parse import urlparse, unquote
+
+METRICS_FORMATS = ['prometheus', 'statsd']
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Logical endpoints requests are grouped under, matched against the lower case path in order
+ENDPOINTS = [
+    ('token', re.compile(r'/oauth2/(v2\.0/)?token$')),
+    ('batch', re.compile(r'/_api/\$batch$')),
+    ('contextinfo', re.compile(r'/_api/contextinfo$')),
+    ('search', re.compile(r'/_api/search/')),
+    ('rootweb', re.compile(r'/_api/site/rootweb$')),
+    ('parentweb', re.compile(r'/_api/web/parentweb$')),
+    ('subwebs', re.compile(r'/_api/web/getsubwebsfilteredforcurrentuser')),
+    ('lists', re.compile(r'/_api/web/lists$')),
+    ('changes', re.compile(r'/_api/site(/getchanges|/openwebbyid\(.*\))?$')),
+]
+
+
+def endpoint_name(url):
+    """Return the logical endpoint a request URL belongs to, e.g. "subwebs" or "search"
+    """
+    path = unquote(urlparse(url).path).rstrip('/').lower()
+    for name, pattern in ENDPOINTS:
+        if pattern.search(path):
+            return name
+    return 'other'
+
+
+class RequestMetrics(object):
+    def __init__(self):
+        """Counts, response sizes, status codes and latency histograms of the requests an
+        action sends, grouped by logical endpoint. Requests sent inside $batch requests
+        are counted under their own endpoint without a latency, since only the $batch
+        request as a whole is timed.
+        """
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def get_endpoint(self, name):
+        endpoint = self.endpoints.get(name)
+        if endpoint is None:
+            endpoint = {'requests': 0,
+                        'bytes': 0,
+                        'cache_hits': 0,
+                        'status_codes': {},
+                        'latency_buckets': [0] * len(LATENCY_BUCKETS),
+                        'latency_count': 0,
+                        'latency_sum': 0.0,
+                        'latency_max': 0.0}
+            self.endpoints[name] = endpoint
+        return endpoint
+
+    def record(self, url, status_code, size, elapsed=None):
+        """Record a response
+        :param url: URL of the request
+        :param status_code: HTTP status code, or None if no response was received
+        :param size: Size of the response body in bytes
+        :param elapsed: (Optional) seconds the request took
+        """
+        status = str(status_code) if status_code is not None else 'error'
+        with self.lock:
+            endpoint = self.get_endpoint(endpoint_name(url))
+            endpoint['requests'] += 1
+            endpoint['bytes'] += size
+            endpoint['status_codes'][status] = endpoint['status_codes'].get(status, 0) + 1
+            if elapsed is not None:
+                for index, bound in enumerate(LATENCY_BUCKETS):
+                    if elapsed <= bound:
+                        endpoint['latency_buckets'][index] += 1
+                endpoint['latency_count'] += 1
+                endpoint['latency_sum'] += elapsed
+                endpoint['latency_max'] = max(endpoint['latency_max'], elapsed)
+
+    def record_cache_hit(self, url):
+        """Record a response that came from the response cache without a request
+        """
+        with self.lock:
+            self.get_endpoint(endpoint_name(url))['cache_hits'] += 1
+
+    def as_dict(self):
+        """Return the metrics as a JSON serializable dict keyed by endpoint, along with
+        the totals of every endpoint
+        """
+        with self.lock:
+            endpoints = {}
+            for name, endpoint in sorted(self.endpoints.items()):
+                data = dict(endpoint, status_codes=dict(endpoint['status_codes']))
+                data['latency_buckets'] = dict(zip([str(bound) for bound in LATENCY_BUCKETS],
+                                                   endpoint['latency_buckets']))
+                endpoints[name] = data
+
+        total = {'requests': 0, 'bytes': 0, 'cache_hits': 0, 'latency_sum': 0.0}
+        for endpoint in endpoints.values():
+            for key in total:
+                total[key] += endpoint[key]
+
+        return {'endpoints': endpoints, 'total': total}
+
+    def to_prometheus(self, labels=None, prefix='sharepoint'):
+        """Return the metrics in the Prometheus text format, for the node exporter
+        textfile collector
+        :param labels: (Optional) dict of labels added to every sample, e.g. the action
+        """
+        def format_labels(**extra):
+            items = sorted((labels or {}).items()) + list(extra.items())
+            return '{' + ','.join('{0}="{1}"'.format(name, str(value).replace('"', '\\"'))
+                                  for name, value in items) + '}'
+
+        data = self.as_dict()['endpoints']
+        lines = []
+
+        def metric(name, metric_type, description):
+            lines.append('# HELP {0}_{1} {2}'.format(prefix, name, description))
+            lines.append('# TYPE {0}_{1} {2}'.format(prefix, name, metric_type))
+
+        metric('requests_total', 'counter', 'Requests sent to SharePoint')
+        for name, endpoint in data.items():
+            lines.append('{0}_requests_total{1} {2}'.format(
+                prefix, format_labels(endpoint=name), endpoint['requests']))
+        metric('responses_total', 'counter', 'Responses from SharePoint by status code')
+        for name, endpoint in data.items():
+            for code, count in sorted(endpoint['status_codes'].items()):
+                lines.append('{0}_responses_total{1} {2}'.format(
+                    prefix, format_labels(endpoint=name, code=code), count))
+        metric('response_bytes_total', 'counter', 'Size of the response bodies')
+        for name, endpoint in data.items():
+            lines.append('{0}_response_bytes_total{1} {2}'.format(
+                prefix, format_labels(endpoint=name), endpoint['bytes']))
+        metric('cache_hits_total', 'counter', 'Responses served from the response cache')
+        for name, endpoint in data.items():
+            lines.append('{0}_cache_hits_total{1} {2}'.format(
+                prefix, format_labels(endpoint=name), endpoint['cache_hits']))
+        metric('request_duration_seconds', 'histogram', 'Latency of the requests')
+        for name, endpoint in data.items():
+            for bound, count in endpoint['latency_buckets'].items():
+                lines.append('{0}_request_duration_seconds_bucket{1} {2}'.format(
+                    prefix, format_labels(endpoint=name, le=bound), count))
+            lines.append('{0}_request_duration_seconds_bucket{1} {2}'.format(
+                prefix, format_labels(endpoint=name, le='+Inf'), endpoint['latency_count']))
+            lines.append('{0}_request_duration_seconds_sum{1} {2}'.format(
+                prefix, format_labels(endpoint=name), endpoint['latency_sum']))
+            lines.append('{0}_request_duration_seconds_count{1} {2}'.format(
+                prefix, format_labels(endpoint=name), endpoint['latency_count']))
+
+        return '\n'.join(lines) + '\n'
+
+    def to_statsd(self, prefix='sharepoint'):
+        """Return the metrics as StatsD lines. Counts are counters and the average and
+        maximum latencies in milliseconds are gauges.
+        :param prefix: Prefix of every metric name, e.g. including the action
+        """
+        lines = []
+        for name, endpoint in self.as_dict()['endpoints'].items():
+            base = '{0}.{1}'.format(prefix, name)
+            lines.append('{0}.requests:{1}|c'.format(base, endpoint['requests']))
+            lines.append('{0}.bytes:{1}|c'.format(base, endpoint['bytes']))
+            lines.append('{0}.cache_hits:{1}|c'.format(base, endpoint['cache_hits']))
+            for code, count in sorted(endpoint['status_codes'].items()):
+                lines.append('{0}.status.{1}:{2}|c'.format(base, code, count))
+            if endpoint['latency_count']:
+                average = endpoint['latency_sum'] / endpoint['latency_count']
+                lines.append('{0}.latency_avg_ms:{1:.3f}|g'.format(base, average * 1000))
+                lines.append('{0}.latency_max_ms:{1:.3f}|g'.format(
+                    base, endpoint['latency_max'] * 1000))
+
+        return '\n'.join(lines) + '\n'
+
+
+def write_metrics(metrics, file_path, metrics_format='prometheus', action=None):
+    """Write metrics to a file in the Prometheus text or StatsD format. The file is
+    replaced atomically so collectors never read a partial file.
+    :param metrics: RequestMetrics object
+    :param action: (Optional) name of the action, added as a label or metric prefix
+    """
+    if metrics_format == 'prometheus':
+        text = metrics.to_prometheus({'action': action} if action else None)
+    elif metrics_format == 'statsd':
+        text = metrics.to_statsd('sharepoint.' + action if action else 'sharepoint')
+    else:
+        raise ValueError('Unknown metrics format: {0}'.format(metrics_format))
+
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.metrics.')
+    try:
+        with os.fdopen(fd, 'w') as temp_file:
+            temp_file.write(text)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# OData metadata levels SharePoint can return JSON in. verbose wraps everything in
+# "d" and "results" and adds __metadata and __deferred to every object, the other
+# two return plain objects and put collections in "value".
+ODATA_METADATA_LEVELS = ['verbose', 'minimalmetadata', 'nometadata']
+DEFAULT_ODATA_METADATA = 'verbose'
+
+
+def odata_accept(metadata=DEFAULT_ODATA_METADATA):
+    """Return the Accept header that asks SharePoint for JSON with the metadata level
+    """
+    if metadata not in ODATA_METADATA_LEVELS:
+        raise ValueError('Unknown OData metadata level: {0}'.format(metadata))
+
+    return 'application/json;odata=' + metadata
+
+
+def normalize_payload(data):
+    """Return a SharePoint JSON response in the same shape whatever metadata level it
+    was requested with. Collections become lists, entities become plain dicts and the
+    __metadata, __deferred and odata.* annotations are removed.
+    :param data: Decoded JSON response body
+    :returns: List for collections, dict for entities
+    """
+    # verbose responses are wrapped in "d"
+    if isinstance(data, dict) and list(data) == ['d']:
+        data = data['d']
+
+    data = _normalize(data)
+
+    # minimalmetadata and nometadata responses put collections in "value"
+    if isinstance(data, dict) and list(data) == ['value'] and isinstance(data['value'], list):
+        return data['value']
+
+    return data
+
+
+def unwrap_result(data, name):
+    """Return the result of a REST method from a normalized response. verbose responses
+    put the result in a property named after the method, the others return it as is.
+    :param data: Normalized response
+    :param name: Name of the method, e.g. "query" for search
+    """
+    if isinstance(data, dict) and name in data:
+        return data[name]
+
+    return data
+
+
+def _is_annotation(key):
+    return key.startswith('__') or key.startswith('odata.') or '@odata.' in key
+
+
+def _normalize(value):
+    if isinstance(value, list):
+        return [_normalize(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+
+    # verbose collections are an object holding the list in "results"
+    if isinstance(value.get('results'), list) and \
+            all(key == 'results' or _is_annotation(key) for key in value):
+        return [_normalize(item) for item in value['results']]
+
+    result = {}
+    for key, item in value.items():
+        if _is_annotation(key):
+            continue
+        # Navigation properties that weren't expanded
+        if isinstance(item, dict) and list(item) == ['__deferred']:
+            continue
+        result[key] = _normalize(item)
+
+    return result
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import re
+from requests.utils import requote_uri
+
+# SharePoint Online rejects batches with more than 100 requests
+MAX_BATCH_SIZE = 100
+# Accept header sent with every request in a batch
+DEFAULT_ACCEPT = 'application/json;odata=verbose'
+
+
+class BatchRequestError(Exception):
+    def __init__(self, response):
+        """Error raised for a single failed request inside an OData $batch request
+        :param response: BatchResponse of the failed request
+        """
+        super(BatchRequestError, self).__init__(
+            "Batch request to {0} failed with status {1}: {2}".format(
+                response.url, response.status_code, response.text[:500]))
+        self.response = response
+
+
+class BatchResponse(object):
+    def __init__(self, url, status_code, headers, text):
+        """Response to a single request inside an OData $batch request. Provides the
+        parts of the requests Response interface used by the actions.
+        :param url: URL of the request this response belongs to
+        :param status_code: HTTP status code of the request
+        :param headers: Dict of response headers
+        :param text: Body of the response
+        """
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 400
+
+    def json(self):
+        return json.loads(self.text)
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise BatchRequestError(self)
+
+
+def build_batch_body(urls, boundary, accept=DEFAULT_ACCEPT, headers=None):
+    """Return the multipart body of a $batch request containing a GET for every URL
+    :param urls: List of absolute URLs to request
+    :param boundary: Multipart boundary, must also be sent in the content-type header
+    :param accept: Accept header sent with every request in the batch
+    :param headers: (Optional) list with a dict of extra headers for each request
+    :returns: String with the body of the batch request
+    """
+    parts = []
+    for index, url in enumerate(urls):
+        extra_headers = "".join("{0}: {1}\r\n".format(name, value)
+                                for name, value in (headers[index] if headers else {}).items())
+        parts.append("--{0}\r\n"
+                     "Content-Type: application/http\r\n"
+                     "Content-Transfer-Encoding: binary\r\n"
+                     "\r\n"
+                     "GET {1} HTTP/1.1\r\n"
+                     "Accept: {2}\r\n"
+                     "{3}"
+                     "\r\n".format(boundary, requote_uri(url), accept, extra_headers))
+
+    parts.append("--{0}--\r\n".format(boundary))
+
+    return "".join(parts)
+
+
+def parse_batch_response(urls, content_type, text):
+    """Split the multipart response of a $batch request into one response per request
+    :param urls: List of the URLs that were sent in the batch, in the same order
+    :param content_type: Content-Type header of the batch response
+    :param text: Body of the batch response
+    :returns: List of BatchResponse objects in the same order as the given URLs
+    """
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    if not match:
+        raise ValueError("No multipart boundary in batch response: " + content_type)
+
+    delimiter = "--" + match.group(1)
+    # The first section is the preamble and the last is the closing delimiter
+    parts = text.split(delimiter)[1:-1]
+    if len(parts) != len(urls):
+        raise ValueError("Batch response contained {0} responses for {1} requests".format(
+            len(parts), len(urls)))
+
+    responses = []
+    for url, part in zip(urls, parts):
+        # Each part has MIME headers followed by the embedded HTTP response
+        http_response = _split_headers(part.lstrip("\r\n"))[1]
+        status_line, body = _split_headers(http_response)
+        lines = status_line.splitlines()
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        status_code = int(lines[0].split()[1])
+        responses.append(BatchResponse(url, status_code, headers, body.strip()))
+
+    return responses
+
+
+def _split_headers(text):
+    """Split a block of text into its header section and body at the first blank line
+    """
+    match = re.search(r'\r?\n\r?\n', text)
+    if not match:
+        return text, ''
+
+    return text[:match.start()], text[match.end():]
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+
+# Output file formats. "json" is a single JSON array and "ndjson" (JSON Lines)
+# has one JSON object per line so records can be appended and streamed.
+OUTPUT_FORMATS = ['json', 'ndjson']
+
+# Number of records held in memory before they are written to the output file
+DEFAULT_BUFFER_SIZE = 100
+
+
+def write_records(records, file_path, file_append, file_format='json',
+                  buffer_size=DEFAULT_BUFFER_SIZE, on_flush=None):
+    """Write records to the output file as they are produced. Records are written
+    every buffer_size records so only that many are held in memory at a time.
+    :param records: Iterable of JSON serializable records, can be a generator
+    :param file_path: Path to the output file
+    :param file_append: Boolean, if true append to the file otherwise overwrite it
+    :param file_format: "json" for a JSON array or "ndjson" for one record per line
+    :param buffer_size: Number of records to buffer between writes
+    :param on_flush: (Optional) function called with the number of records written and
+        the file offset after them, once the file is opened and after every write. The
+        records up to that offset have been synced to disk when it is called.
+    :returns: Number of records written
+    """
+    if file_format == 'ndjson':
+        return write_ndjson(records, file_path, file_append, buffer_size, on_flush)
+
+    return write_json_array(records, file_path, file_append, buffer_size, on_flush)
+
+
+def _flush(outfile, count, on_flush):
+    outfile.flush()
+    if on_flush:
+        os.fsync(outfile.fileno())
+        on_flush(count, outfile.tell())
+
+
+def write_ndjson(records, file_path, file_append, buffer_size=DEFAULT_BUFFER_SIZE,
+                 on_flush=None):
+    """Write records to a JSON Lines file, one record per line. Appending only
+    writes the new records so it doesn't depend on the size of the file.
+    :param records: Iterable of JSON serializable records
+    :param file_path: Path to the output file
+    :param file_append: Boolean, if true append to the file otherwise overwrite it
+    :param buffer_size: Number of records to buffer between writes
+    :param on_flush: (Optional) function called after every write, see write_records
+    :returns: Number of records written
+    """
+    count = 0
+    with open(file_path, 'a' if file_append else 'w') as outfile:
+        if on_flush:
+            _flush(outfile, count, on_flush)
+        buffer = []
+        for record in records:
+            buffer.append(json.dumps(record) + '\n')
+            count += 1
+            if len(buffer) >= buffer_size:
+                outfile.writelines(buffer)
+                _flush(outfile, count, on_flush)
+                buffer = []
+        outfile.writelines(buffer)
+
+    return count
+
+
+def write_json_array(records, file_path, file_append, buffer_size=DEFAULT_BUFFER_SIZE,
+                     on_flush=None):
+    """Write records to a file holding a JSON array. When appending the closing
+    bracket of the existing array is removed and the new records are written after
+    the existing ones, so the existing records are never read into memory.
+    :param records: Iterable of JSON serializable records
+    :param file_path: Path to the output file
+    :param file_append: Boolean, if true append to the array in the file
+    :param buffer_size: Number of records to buffer between writes
+    :param on_flush: (Optional) function called after every write, see write_records
+    :returns: Number of records written
+    """
+    has_records = False
+    if file_append and os.path.exists(file_path) and os.path.getsize(file_path):
+        outfile = open(file_path, 'rb+')
+        try:
+            has_records = _reopen_json_array(outfile)
+        except ValueError:
+            outfile.close()
+            raise
+    else:
+        outfile = open(file_path, 'wb')
+        outfile.write(b'[')
+
+    count = 0
+    with outfile:
+        # The array is closed even if the records raise, so the file keeps every
+        # record written up to the last flush and stays valid JSON
+        try:
+            if on_flush:
+                _flush(outfile, count, on_flush)
+            buffer = []
+            for record in records:
+                separator = ', ' if has_records or count else ''
+                buffer.append((separator + json.dumps(record)).encode('utf-8'))
+                count += 1
+                if len(buffer) >= buffer_size:
+                    outfile.writelines(buffer)
+                    _flush(outfile, count, on_flush)
+                    buffer = []
+            outfile.writelines(buffer)
+        finally:
+            outfile.write(b']')
+
+    return count
+
+
+def _reopen_json_array(outfile):
+    """Position the file just before the closing bracket of its JSON array and
+    truncate it there so more records can be written.
+    :returns: Boolean, whether the array already has records
+    """
+    outfile.seek(0, os.SEEK_END)
+    position = outfile.tell()
+    closing = None
+    # Read backwards in blocks to find the last two non whitespace characters
+    while position > 0:
+        block_size = min(4096, position)
+        position -= block_size
+        outfile.seek(position)
+        block = outfile.read(block_size)
+        for index in range(len(block) - 1, -1, -1):
+            if block[index:index + 1].isspace():
+                continue
+            if closing is None:
+                if block[index:index + 1] != b']':
+                    raise ValueError('Output file does not contain a JSON array: '
+                                     + outfile.name)
+                closing = position + index
+            else:
+                outfile.seek(closing)
+                outfile.truncate()
+                return block[index:index + 1] != b'['
+
+    raise ValueError('Output file does not contain a JSON array: ' + outfile.name)
+
+
+def truncate_records(file_path, offset, file_format='json'):
+    """Cut an output file back to the given offset, dropping the records written after
+    it. A JSON array gets its closing bracket back so more records can be appended.
+    :param offset: File offset passed to on_flush by write_records
+    """
+    with open(file_path, 'rb+') as outfile:
+        outfile.truncate(offset)
+        if file_format == 'json':
+            outfile.seek(offset)
+            outfile.write(b']')
+
+
+def read_ndjson(file_path):
+    """Yield the records in a JSON Lines file one at a time
+    :param file_path: Path to the file to read
+    """
+    with open(file_path, 'r') as infile:
+        for line in infile:
+            if line.strip():
+                yield json.loads(line)
+
+
+def json_to_ndjson(input_file, output_file):
+    """Convert a file with a JSON array of records into a JSON Lines file
+    :returns: Number of records converted
+    """
+    with open(input_file, 'r') as infile:
+        records = json.load(infile)
+
+    return write_ndjson(records, output_file, False)
+
+
+def ndjson_to_json(input_file, output_file):
+    """Convert a JSON Lines file into a file with a JSON array of records.
+    Records are streamed so the input file is never fully loaded into memory.
+    :returns: Number of records converted
+    """
+    return write_json_array(read_ndjson(input_file), output_file, False)
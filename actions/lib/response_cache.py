@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from lib.odata_batch import BatchResponse
+
+# Seconds a cached response is used without asking SharePoint whether it changed
+DEFAULT_TTL = 300
+# Maximum size of all cached response bodies in megabytes
+DEFAULT_MAX_SIZE = 100
+
+
+def response_cache_key(method, url, identity, accept):
+    """Return the key a response is cached under
+    :param method: HTTP method of the request
+    :param url: URL of the request
+    :param identity: String identifying the credential the request was made with
+    :param accept: Accept header of the request, which decides the response format
+    :returns: Hex digest identifying the response
+    """
+    key = "|".join([method.upper(), url, identity, accept])
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def build_response(entry, url):
+    """Return a requests Response holding a cached response
+    :param entry: Cached entry returned by ResponseCache.get()
+    :param url: URL of the request the response is for
+    """
+    response = Response()
+    response.status_code = entry['status_code']
+    response.headers = CaseInsensitiveDict(entry['headers'])
+    response._content = entry['body']
+    response.encoding = 'utf-8'
+    response.url = url
+    return response
+
+
+def build_batch_response(entry, url):
+    """Return a BatchResponse holding a cached response to a request in a $batch request
+    """
+    return BatchResponse(url, entry['status_code'], entry['headers'],
+                         entry['body'].decode('utf-8'))
+
+
+def validator_headers(entry):
+    """Return the headers that make a request conditional on the cached response
+    having changed
+    """
+    headers = {}
+    if entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+class ResponseCache(object):
+    def __init__(self, file_path, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        """Response cache stored in a SQLite database so it is shared by every action
+        execution on the host. Responses older than the TTL are revalidated with their
+        ETag or Last-Modified header, and the responses stored or revalidated longest ago
+        are evicted once the cached bodies take up more than max_size megabytes. Reads
+        don't write to the database.
+        :param file_path: Path to the database, created with owner only permissions
+        :param ttl: Seconds a response is used without revalidating it
+        :param max_size: Maximum size of the cached bodies in megabytes
+        """
+        self.file_path = file_path
+        self.ttl = ttl
+        self.max_size = max_size * 1024 * 1024
+        # The database and table are created by the first connection only
+        self.initialized = False
+
+    def connect(self):
+        if self.initialized:
+            return sqlite3.connect(self.file_path, timeout=30)
+
+        if not os.path.exists(self.file_path):
+            os.close(os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o600))
+
+        connection = sqlite3.connect(self.file_path, timeout=30)
+        with connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS responses ('
+                               'key TEXT PRIMARY KEY, status_code INTEGER, headers TEXT, '
+                               'body BLOB, size INTEGER, expires_at REAL, stored_at REAL)')
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(responses)')]
+            # Caches created by earlier versions named the column after the last read
+            if 'accessed_at' in columns:
+                connection.execute('ALTER TABLE responses RENAME COLUMN accessed_at TO '
+                                   'stored_at')
+        self.initialized = True
+        return connection
+
+    def get(self, key):
+        """Return the cached entry for the key or None if there isn't one. The entry is
+        returned even if it expired, check 'fresh' before using it without revalidating.
+        """
+        with closing(self.connect()) as connection:
+            row = connection.execute('SELECT status_code, headers, body, expires_at '
+                                     'FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+
+        headers = json.loads(row[1])
+        lower_headers = dict((name.lower(), value) for name, value in headers.items())
+        return {'status_code': row[0],
+                'headers': headers,
+                'body': bytes(row[2]),
+                'fresh': row[3] > time.time(),
+                'etag': lower_headers.get('etag'),
+                'last_modified': lower_headers.get('last-modified')}
+
+    def set(self, key, status_code, headers, body):
+        """Store a response and evict the responses stored or revalidated longest ago if
+        the cache is over its maximum size
+        :param headers: Dict of the response headers
+        :param body: Response body as bytes
+        """
+        now = time.time()
+        with closing(self.connect()) as connection, connection:
+            connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (key, status_code, json.dumps(dict(headers)),
+                                sqlite3.Binary(body), len(body), now + self.ttl, now))
+            self.evict(connection)
+
+    def refresh(self, key):
+        """Mark a cached response as fresh again after SharePoint said it hasn't changed
+        """
+        now = time.time()
+        with closing(self.connect()) as connection, connection:
+            connection.execute('UPDATE responses SET expires_at = ?, stored_at = ? '
+                               'WHERE key = ?', (now + self.ttl, now, key))
+
+    def evict(self, connection):
+        total = connection.execute('SELECT SUM(size) FROM responses').fetchone()[0] or 0
+        if total <= self.max_size:
+            return
+
+        evicted = []
+        for key, size in connection.execute('SELECT key, size FROM responses '
+                                            'ORDER BY stored_at'):
+            if total <= self.max_size:
+                break
+            evicted.append((key,))
+            total -= size
+        connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+from lib.base_action import normalize_url
+from lib.delta import checkpoint_key
+
+DEFAULT_SITE_TREE_CACHE_FILE = '/tmp/stackstorm_sharepoint_site_tree.sqlite'
+# Seconds a cached site tree is used by actions before they crawl SharePoint themselves
+DEFAULT_MAX_STALENESS = 900
+
+
+def site_tree_key(base_url, endpoint, fields=None):
+    """Return the key the subsites of an endpoint are cached under
+    :param fields: (Optional) list of web fields the subsites were requested with
+    """
+    return checkpoint_key('site_tree', normalize_url(base_url), normalize_url(endpoint),
+                          fields or [])
+
+
+def get_site_tree_cache(config):
+    """Return the site tree cache at the path set in the pack config
+    """
+    return SiteTreeCache((config or {}).get('site_tree_cache_file',
+                                            DEFAULT_SITE_TREE_CACHE_FILE))
+
+
+def doc_lib_id(doc_lib):
+    """Return the value identifying a document library within its web
+    """
+    return str(doc_lib.get('Id') or doc_lib.get('Title')).lower()
+
+
+def diff_trees(old_records, new_records):
+    """Return the webs and document libraries that were added or removed between two
+    lists of subsites. The libraries of added and removed webs are part of the web and
+    aren't listed on their own.
+    :returns: Dict with lists of webs_added and webs_removed records, and lists of
+        doc_libs_added and doc_libs_removed (web, doc lib) pairs
+    """
+    old_webs = dict((record['Guid'], record) for record in old_records)
+    new_webs = dict((record['Guid'], record) for record in new_records)
+    changes = {'webs_added': [record for guid, record in new_webs.items()
+                              if guid not in old_webs],
+               'webs_removed': [record for guid, record in old_webs.items()
+                                if guid not in new_webs],
+               'doc_libs_added': [],
+               'doc_libs_removed': []}
+
+    for guid, record in new_webs.items():
+        if guid not in old_webs:
+            continue
+        old_libs = dict((doc_lib_id(lib), lib) for lib in old_webs[guid].get('DocLibs') or [])
+        new_libs = dict((doc_lib_id(lib), lib) for lib in record.get('DocLibs') or [])
+        changes['doc_libs_added'] += [(record, lib) for lib_id, lib in new_libs.items()
+                                      if lib_id not in old_libs]
+        changes['doc_libs_removed'] += [(record, lib) for lib_id, lib in old_libs.items()
+                                        if lib_id not in new_libs]
+
+    return changes
+
+
+def url_prefixes(url):
+    """Return the normalized URL and every URL above it in the path, longest first
+    """
+    url = normalize_url(url)
+    prefixes = [url]
+    while '/' in url.split('://', 1)[-1]:
+        url = url.rsplit('/', 1)[0].rstrip('/')
+        prefixes.append(url)
+
+    return prefixes
+
+
+class SiteTreeCache(object):
+    def __init__(self, file_path):
+        """Site trees kept in a SQLite database on the host by the site tree sensor, so
+        actions can answer from the last crawl instead of crawling SharePoint again. Webs
+        are indexed by URL so the web owning a URL is found without reading whole trees.
+        :param file_path: Path to the database, created with owner only permissions
+        """
+        self.file_path = file_path
+
+    def connect(self):
+        if not os.path.exists(self.file_path):
+            os.close(os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o600))
+
+        connection = sqlite3.connect(self.file_path, timeout=30)
+        connection.execute('CREATE TABLE IF NOT EXISTS trees ('
+                           'key TEXT PRIMARY KEY, base_url TEXT, endpoint TEXT, '
+                           'refreshed_at REAL)')
+        connection.execute('CREATE TABLE IF NOT EXISTS webs ('
+                           'tree TEXT, position INTEGER, guid TEXT, url TEXT, record TEXT, '
+                           'PRIMARY KEY (tree, position))')
+        connection.execute('CREATE INDEX IF NOT EXISTS webs_url ON webs (url)')
+        connection.execute('CREATE TABLE IF NOT EXISTS dirty ('
+                           'url TEXT, list_id TEXT, marked_at REAL, '
+                           'PRIMARY KEY (url, list_id))')
+        return connection
+
+    def get_refreshed_at(self, key):
+        """Return the time the tree was last saved or None if it isn't cached
+        """
+        with closing(self.connect()) as connection:
+            row = connection.execute('SELECT refreshed_at FROM trees WHERE key = ?',
+                                     (key,)).fetchone()
+
+        return row[0] if row else None
+
+    def load_tree(self, key, max_staleness=None):
+        """Return the cached subsites in depth-first order, or None if the tree isn't
+        cached or was saved more than max_staleness seconds ago
+        """
+        with closing(self.connect()) as connection:
+            row = connection.execute('SELECT refreshed_at FROM trees WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None or not self.is_fresh(row[0], max_staleness):
+                return None
+            # A web with changes that weren't fetched yet makes the whole tree stale
+            if connection.execute('SELECT 1 FROM webs JOIN dirty ON webs.url = dirty.url '
+                                  'WHERE webs.tree = ? LIMIT 1', (key,)).fetchone():
+                return None
+
+            return [json.loads(record) for record, in connection.execute(
+                'SELECT record FROM webs WHERE tree = ? ORDER BY position', (key,))]
+
+    def save_tree(self, key, base_url, endpoint, records, crawled_at=None):
+        """Replace the cached subsites of an endpoint. Webs marked dirty before the crawl
+        started are clean again.
+        :param records: List of subsites in depth-first order
+        :param crawled_at: (Optional) time the crawl of the records started, now if unset
+        :returns: The webs and document libraries that changed, see diff_trees()
+        """
+        crawled_at = time.time() if crawled_at is None else crawled_at
+        with closing(self.connect()) as connection, connection:
+            old_records = [json.loads(record) for record, in connection.execute(
+                'SELECT record FROM webs WHERE tree = ? ORDER BY position', (key,))]
+            connection.execute('DELETE FROM webs WHERE tree = ?', (key,))
+            connection.executemany('INSERT INTO webs VALUES (?, ?, ?, ?, ?)', [
+                (key, position, record['Guid'], normalize_url(record['SiteUrl']),
+                 json.dumps(record))
+                for position, record in enumerate(records)])
+            connection.execute('INSERT OR REPLACE INTO trees VALUES (?, ?, ?, ?)',
+                               (key, base_url, endpoint, time.time()))
+            connection.execute('DELETE FROM dirty WHERE marked_at <= ? AND url IN '
+                               '(SELECT url FROM webs WHERE tree = ?)', (crawled_at, key))
+
+        return diff_trees(old_records, records)
+
+    def get_site_urls(self):
+        """Return the SiteUrl of every cached web, each web once
+        """
+        with closing(self.connect()) as connection:
+            rows = connection.execute('SELECT url, record FROM webs ORDER BY tree, position')
+            urls = {}
+            for url, record in rows:
+                if url not in urls:
+                    urls[url] = json.loads(record)['SiteUrl']
+
+        return list(urls.values())
+
+    def mark_dirty(self, site_url, list_id=''):
+        """Mark a web, or one of its document libraries, as changed since it was cached
+        :param site_url: URL of the web
+        :param list_id: (Optional) ID of the document library that changed
+        """
+        with closing(self.connect()) as connection, connection:
+            connection.execute('INSERT OR REPLACE INTO dirty VALUES (?, ?, ?)',
+                               (normalize_url(site_url), (list_id or '').lower(),
+                                time.time()))
+
+    def get_dirty(self):
+        """Return the dirty marks as dicts with the normalized url of the web, the
+        list_id of the library or an empty string for the whole web, and marked_at
+        """
+        with closing(self.connect()) as connection:
+            return [dict(zip(['url', 'list_id', 'marked_at'], row))
+                    for row in connection.execute('SELECT url, list_id, marked_at FROM dirty '
+                                                  'ORDER BY marked_at')]
+
+    def clear_dirty(self, site_url, marked_before):
+        """Remove the dirty marks of a web made up to the given time, so changes that
+        came in while the web was being fetched stay marked
+        """
+        with closing(self.connect()) as connection, connection:
+            connection.execute('DELETE FROM dirty WHERE url = ? AND marked_at <= ?',
+                               (normalize_url(site_url), marked_before))
+
+    def update_doc_libs(self, site_url, doc_libs):
+        """Replace the document libraries of a cached web in every tree holding it
+        :param doc_libs: List of document libraries of the web
+        :returns: List with the base_url, endpoint and changes of each updated tree, the
+            changes as returned by diff_trees()
+        """
+        updated = []
+        with closing(self.connect()) as connection, connection:
+            rows = connection.execute(
+                'SELECT webs.tree, webs.position, webs.record, trees.base_url, '
+                'trees.endpoint FROM webs JOIN trees ON webs.tree = trees.key '
+                'WHERE webs.url = ?', (normalize_url(site_url),)).fetchall()
+            for tree, position, record, base_url, endpoint in rows:
+                old_record = json.loads(record)
+                new_record = dict(old_record, DocLibs=doc_libs)
+                connection.execute('UPDATE webs SET record = ? WHERE tree = ? AND '
+                                   'position = ?', (json.dumps(new_record), tree, position))
+                updated.append({'base_url': base_url, 'endpoint': endpoint,
+                                'changes': diff_trees([old_record], [new_record])})
+
+        return updated
+
+    def find_web(self, url, max_staleness=None):
+        """Return the cached web the URL belongs to, the web with the longest URL that
+        the URL starts with, or None if no fresh tree has one
+        :param url: URL of a web, library, folder or file
+        """
+        prefixes = url_prefixes(url)
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                'SELECT webs.url, webs.record, trees.refreshed_at FROM webs '
+                'JOIN trees ON webs.tree = trees.key WHERE webs.url IN ({0}) '
+                'ORDER BY trees.refreshed_at DESC'.format(','.join('?' * len(prefixes))),
+                prefixes).fetchall()
+
+        # The most recently refreshed tree wins when several trees hold the web
+        rows = [row for row in rows if self.is_fresh(row[2], max_staleness)]
+        if not rows:
+            return None
+
+        return json.loads(max(rows, key=lambda row: len(row[0]))[1])
+
+    def is_fresh(self, refreshed_at, max_staleness):
+        return max_staleness is None or refreshed_at >= time.time() - max_staleness
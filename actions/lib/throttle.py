@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# SharePoint answers with these when a tenant or farm is throttling requests
+THROTTLED_STATUS_CODES = (429, 503)
+# Transient failures worth trying again, 500 is left out since SharePoint uses it
+# for errors in the request itself
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+
+# Number of times a request is retried before giving up
+DEFAULT_MAX_RETRIES = 5
+# Base and maximum delay in seconds between retries without a Retry-After header
+DEFAULT_RETRY_BACKOFF = 1
+DEFAULT_RETRY_MAX_DELAY = 60
+
+
+def retry_delay(headers, attempt, backoff=DEFAULT_RETRY_BACKOFF,
+                max_delay=DEFAULT_RETRY_MAX_DELAY):
+    """Return the number of seconds to wait before retrying a request. The Retry-After
+    header is used when the response has one, otherwise the delay is a random value up
+    to an exponentially growing limit so clients that were throttled together don't
+    all retry at the same time.
+    :param headers: Headers of the failed response or None if no response was received
+    :param attempt: Number of the attempt that failed, starting at 0
+    :param backoff: Delay limit of the first retry in seconds
+    :param max_delay: Maximum delay in seconds
+    :returns: Seconds to wait
+    """
+    retry_after = (headers or {}).get('retry-after')
+    if retry_after:
+        try:
+            return min(max_delay, max(0, float(retry_after)))
+        except ValueError:
+            pass
+        try:
+            return min(max_delay, max(0, parsedate_to_datetime(retry_after).timestamp() -
+                                      time.time()))
+        except (TypeError, ValueError):
+            pass
+
+    return random.uniform(0, min(max_delay, backoff * 2 ** attempt))
+
+
+class AimdLimiter(object):
+    def __init__(self, max_limit, min_limit=1, increase=1.0, decrease=0.5):
+        """Limits the number of requests in flight with additive increase, multiplicative
+        decrease (AIMD). Every throttled response cuts the limit by the decrease factor
+        and every other response raises it by about increase per limit responses, so the
+        limit settles at the highest rate SharePoint accepts.
+        :param max_limit: Maximum and starting number of requests in flight
+        :param min_limit: Minimum number of requests in flight
+        :param increase: Amount the limit grows by after a full limit of clean responses
+        :param decrease: Factor the limit is multiplied by when a request is throttled
+        """
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until another request can be sent
+        :returns: Time the request was allowed, to be passed to release()
+        """
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self, started, throttled=False):
+        """Mark a request as finished and adjust the limit
+        :param started: Value returned by acquire() for the request
+        :param throttled: Boolean, whether SharePoint throttled the request
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                # Requests sent before the last decrease were sent at the old rate so
+                # they don't cut the limit again
+                if started >= self.last_decrease:
+                    self.limit = max(self.min_limit, self.limit * self.decrease)
+                    self.last_decrease = time.monotonic()
+            else:
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            self.condition.notify_all()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import fcntl
+import hashlib
+import json
+import os
+import time
+from urllib.parse import urlparse
+
+# Tokens are refreshed this many seconds before they expire
+DEFAULT_REFRESH_MARGIN = 300
+# Azure AD access tokens are valid for an hour unless the response says otherwise
+DEFAULT_EXPIRES_IN = 3599
+
+
+def token_scope(site_url):
+    """Return the scope of the access token for a site. Tokens are issued for the
+    SharePoint host, so every site on the host shares one token.
+    :param site_url: URL of a site, e.g. https://tenant.sharepoint.com/sites/a
+    :returns: Scope such as https://tenant.sharepoint.com/.default
+    """
+    url = urlparse(site_url.strip())
+    return "{0}://{1}/.default".format(url.scheme, url.netloc.lower())
+
+
+def token_cache_key(tenent_id, client_id, cert_thumbprint, scope):
+    """Return the key an access token is cached under
+    :param tenent_id: Tenent ID of Azure
+    :param client_id: Client ID of the App in Azure
+    :param cert_thumbprint: Thumbprint of the certificate used to sign the assertion
+    :param scope: Scope the token was requested for
+    :returns: Hex digest identifying the token
+    """
+    identity = "|".join([tenent_id or '', client_id or '', cert_thumbprint or '',
+                         scope or ''])
+    return hashlib.sha256(identity.encode('utf-8')).hexdigest()
+
+
+class TokenCache(object):
+    def __init__(self, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        """Base class for access token caches
+        :param refresh_margin: Seconds before expiry at which a token is no longer returned
+        """
+        self.refresh_margin = refresh_margin
+
+    def get(self, key):
+        """Return the cached access token for the key or None if it is missing or
+        about to expire
+        """
+        entry = self.load(key)
+        if not entry or entry['expires_at'] - self.refresh_margin <= time.time():
+            return None
+
+        return entry['access_token']
+
+    def set(self, key, access_token, expires_in=DEFAULT_EXPIRES_IN):
+        """Store an access token that expires in the given number of seconds
+        """
+        self.save(key, {'access_token': access_token,
+                        'expires_at': time.time() + int(expires_in)})
+
+    def load(self, key):
+        raise NotImplementedError()
+
+    def save(self, key, entry):
+        raise NotImplementedError()
+
+
+class DatastoreTokenCache(TokenCache):
+    def __init__(self, action_service, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        """Token cache backed by the StackStorm key-value datastore. Tokens are stored
+        encrypted under a key per app and scope so a refreshed token replaces the old one.
+        :param action_service: Action service of the running action
+        """
+        super(DatastoreTokenCache, self).__init__(refresh_margin)
+        self.action_service = action_service
+
+    def load(self, key):
+        value = self.action_service.get_value('token_cache.' + key, local=True,
+                                              decrypt=True)
+        return json.loads(value) if value else None
+
+    def save(self, key, entry):
+        self.action_service.set_value('token_cache.' + key, json.dumps(entry),
+                                      local=True, encrypt=True)
+
+
+class FileTokenCache(TokenCache):
+    def __init__(self, file_path, refresh_margin=DEFAULT_REFRESH_MARGIN):
+        """Token cache backed by a local JSON file. The file is locked while it is
+        read or written so concurrent action executions can share it.
+        :param file_path: Path to the cache file, created with owner only permissions
+        """
+        super(FileTokenCache, self).__init__(refresh_margin)
+        self.file_path = file_path
+
+    def open(self):
+        fd = os.open(self.file_path, os.O_RDWR | os.O_CREAT, 0o600)
+        return os.fdopen(fd, 'r+')
+
+    def read_entries(self, file):
+        file.seek(0)
+        data = file.read()
+        return json.loads(data) if data else {}
+
+    def load(self, key):
+        with self.open() as file:
+            fcntl.flock(file, fcntl.LOCK_SH)
+            return self.read_entries(file).get(key)
+
+    def save(self, key, entry):
+        with self.open() as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            entries = self.read_entries(file)
+
+            # Drop expired tokens so the file doesn't grow forever
+            now = time.time()
+            entries = dict((k, v) for k, v in entries.items() if v['expires_at'] > now)
+            entries[key] = entry
+
+            file.seek(0)
+            file.truncate()
+            json.dump(entries, file)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# SharePoint keeps a webhook subscription for at most 180 days
+MAX_EXPIRATION_DAYS = 180
+DEFAULT_EXPIRATION_DAYS = 90
+# Subscriptions expiring within this many days are renewed
+DEFAULT_RENEW_DAYS = 30
+
+DEFAULT_SUBSCRIPTIONS_FILE = '/tmp/stackstorm_sharepoint_webhooks.json'
+
+# Endpoints of a list and its webhook subscriptions, appended to the URL of the web
+LIST_URI = "/_api/web/lists('{0}')"
+SUBSCRIPTIONS_URI = LIST_URI + '/subscriptions'
+SUBSCRIPTION_URI = SUBSCRIPTIONS_URI + "('{1}')"
+
+# Subscriptions are plain JSON objects without OData type metadata
+WEBHOOK_HEADERS = {'content-type': 'application/json'}
+
+
+def format_expiration(timestamp):
+    """Return a Unix timestamp as the UTC ISO 8601 time SharePoint expects
+    """
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def parse_expiration(value):
+    """Return the Unix timestamp of an ISO 8601 time returned by SharePoint, e.g.
+    2022-04-21T16:17:57.0000000Z
+    """
+    value = value.rstrip('Z').split('.')[0]
+    parsed = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+    return parsed.replace(tzinfo=timezone.utc).timestamp()
+
+
+def expiration_time(days, now=None):
+    """Return the Unix timestamp a subscription made now for the given days expires at,
+    capped at the longest SharePoint allows
+    """
+    now = time.time() if now is None else now
+    return now + min(days, MAX_EXPIRATION_DAYS) * 86400
+
+
+def parse_notifications(body):
+    """Return the notifications in the body of a webhook request
+    :param body: Request body as bytes
+    :returns: List of dicts with the subscriptionId, clientState, resource, siteUrl and
+        webId of each notification
+    :raises ValueError: if the body isn't a notification payload
+    """
+    payload = json.loads(body.decode('utf-8'))
+    if not isinstance(payload, dict) or not isinstance(payload.get('value'), list):
+        raise ValueError('Not a webhook notification payload')
+
+    return payload['value']
+
+
+def create_subscription(action, site_url, list_id, notification_url, expiration, auth_token,
+                        client_state=None):
+    """Subscribe a URL to the webhook notifications of a document library
+    :param action: SharepointBaseAction used to send the request
+    :param site_url: URL of the web the library is in
+    :param list_id: ID of the document library
+    :param notification_url: URL SharePoint sends the notifications to
+    :param expiration: Time the subscription expires, an ISO 8601 string
+    :param client_state: (Optional) string SharePoint sends back with every
+        notification so they can be told apart from forged ones
+    :returns: The subscription, including its id and expirationDateTime
+    """
+    payload = {'resource': site_url + LIST_URI.format(list_id),
+               'notificationUrl': notification_url,
+               'expirationDateTime': expiration}
+    if client_state:
+        payload['clientState'] = client_state
+
+    result = action.post_request(site_url, site_url + SUBSCRIPTIONS_URI.format(list_id),
+                                 auth_token, payload, WEBHOOK_HEADERS)
+    result.raise_for_status()
+    return action.parse_json(result)
+
+
+def update_subscription(action, site_url, list_id, subscription_id, expiration, auth_token):
+    """Move the expiration of a webhook subscription to the given ISO 8601 time
+    """
+    headers = dict(WEBHOOK_HEADERS, **{'X-HTTP-Method': 'PATCH'})
+    result = action.post_request(site_url, site_url + SUBSCRIPTION_URI.format(
+        list_id, subscription_id), auth_token, {'expirationDateTime': expiration}, headers)
+    result.raise_for_status()
+
+
+def delete_subscription(action, site_url, list_id, subscription_id, auth_token):
+    """Remove a webhook subscription, one that is already gone is ignored
+    """
+    headers = dict(WEBHOOK_HEADERS, **{'X-HTTP-Method': 'DELETE'})
+    result = action.post_request(site_url, site_url + SUBSCRIPTION_URI.format(
+        list_id, subscription_id), auth_token, headers=headers)
+    if result.status_code != 404:
+        result.raise_for_status()
+
+
+def create_webhook_server(host, port, on_notifications):
+    """Return an HTTP server that receives SharePoint webhook requests. The validation
+    token SharePoint sends when a subscription is created is echoed back, and the
+    notifications of other requests are passed to on_notifications after answering,
+    since SharePoint only waits 5 seconds for the response.
+    :param host: Address to listen on
+    :param port: Port to listen on, 0 picks a free port
+    :param on_notifications: Function called with the list of notifications
+    """
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            query = dict((name.lower(), values)
+                         for name, values in parse_qs(urlparse(self.path).query).items())
+            if 'validationtoken' in query:
+                self.respond(200, query['validationtoken'][0])
+                return
+
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            try:
+                notifications = parse_notifications(body)
+            except ValueError:
+                self.respond(400, 'Invalid notification payload')
+                return
+
+            self.respond(200, '')
+            on_notifications(notifications)
+
+        def respond(self, status, text):
+            body = text.encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # The sensor logs the notifications it handles
+            pass
+
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from lib.base_action import SharepointBaseAction
+from lib.output_file import json_to_ndjson, ndjson_to_json
+
+
+class OutputFileConvert(SharepointBaseAction):
+    def __init__(self, config):
+        """Creates a new BaseAction given a StackStorm config object (kwargs works too)
+        :param config: StackStorm configuration object for the pack
+        :returns: a new BaseAction
+        """
+        super(OutputFileConvert, self).__init__(config)
+
+    def run(self, input_file, output_file, output_file_format):
+        """
+        Convert an output file between the JSON array and JSON Lines formats
+
+        Args:
+        - input_file: Path to the output file to convert
+        - output_file: Path to write the converted file to
+        - output_file_format: "json" or "ndjson" format to convert the file to
+
+        Returns:
+        - String: Path to the converted file and the number of records in it
+        """
+        if output_file_format == 'ndjson':
+            count = json_to_ndjson(input_file, output_file)
+        elif output_file_format == 'json':
+            count = ndjson_to_json(input_file, output_file)
+        else:
+            raise ValueError('Unknown output file format: {0}'.format(output_file_format))
+
+        return 'Converted {0} records to: {1}'.format(count, output_file)
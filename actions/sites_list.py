@@ -12,13 +12,39 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from urllib.parse import urljoin
-from lib.base_action import SharepointBaseAction
+from urllib.parse import urljoin, urlparse, quote
+from lib.base_action import SharepointBaseAction, DOC_LIBS_URI, WEB_FIELDS, normalize_url
+from lib.delta import DeltaCheckpoint, checkpoint_key
+from lib.odata import unwrap_result
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Number of site groups or search pages fetched from SharePoint at the same time
+DEFAULT_MAX_CONCURRENCY = 10
+# Number of search results per page, SharePoint doesn't return more than 500
+DEFAULT_ROW_LIMIT = 500
+
+# Maximum length of the encoded sites filter clauses in a single search query,
+# this keeps the request URL under the 2048 characters SharePoint accepts
+MAX_FILTER_LENGTH = 1500
+
+# Search for site collections and only return the property that is parsed.
+# Duplicate trimming is turned off so sites with similar content aren't dropped.
+SEARCH_URI = '/_api/search/query?querytext=\'{0}\'' \
+             '&selectproperties=\'SiteName\'&trimduplicates=false'
+SEARCH_QUERY = 'contentclass:STS_Site'
+
+# Time of the last change to the root web of a site, used to skip unchanged sites
+LAST_MODIFIED_URI = '/_api/site/rootweb?$select=LastItemModifiedDate'
+ROOTWEB_URI = '/_api/site/rootweb'
+# Root web fields always selected, delta runs compare the saved LastItemModifiedDate
+ROOTWEB_FIELDS = WEB_FIELDS + ['LastItemModifiedDate']
+
 
 class SitesList(SharepointBaseAction):
+    # Name of the action in the metrics file
+    metrics_name = 'sites_list'
+
     def __init__(self, config):
         """Creates a new BaseAction given a StackStorm config object (kwargs works too)
         :param config: StackStorm configuration object for the pack
@@ -28,55 +54,221 @@ class SitesList(SharepointBaseAction):
 
     # Return a list of SharePoint top level site objects from the
     # given list of URLs
-    def get_site_objects(self, base_url, ntlm_auth, site_urls):
-        # Make another API call with the site url to get the site object
-        site_objs = []
+    def get_site_objects(self, base_url, ntlm_auth, site_urls,
+                         max_concurrency=DEFAULT_MAX_CONCURRENCY, host_concurrency=0):
+        return list(self.iter_site_objects(base_url, ntlm_auth, site_urls,
+                                           max_concurrency, host_concurrency))
+
+    # Yield the SharePoint top level site objects for the given list of URLs in order
+    def iter_site_objects(self, base_url, ntlm_auth, site_urls,
+                          max_concurrency=DEFAULT_MAX_CONCURRENCY, host_concurrency=0,
+                          executor=None):
+        return self.iter_site_groups(self.get_site_objects_group, base_url, ntlm_auth,
+                                     site_urls, max_concurrency, host_concurrency, executor)
+
+    # Call func for groups of the given sites that are on the same host and yield the
+    # value it returns for each site in order
+    def iter_site_groups(self, func, base_url, ntlm_auth, site_urls,
+                         max_concurrency=DEFAULT_MAX_CONCURRENCY, host_concurrency=0,
+                         executor=None):
+        # Sites on a different host than the base_url are batched against their own host
+        base_host = urlparse(base_url).netloc.lower()
+
+        def call(sites):
+            url = urlparse(sites[0])
+            if url.netloc.lower() == base_host:
+                batch_url = base_url
+            else:
+                batch_url = url.scheme + '://' + url.netloc
+            return func(base_url, batch_url, ntlm_auth, sites)
+
+        # Each site needs two requests in the $batch request of its window
+        return self.imap_site_groups(call, site_urls, self.batch_size // 2, max_concurrency,
+                                     host_concurrency, executor)
+
+    # Return a dict of site URL to site object for a group of sites on the same host
+    def get_site_objects_group(self, base_url, batch_url, ntlm_auth, site_urls):
+        # Request the site object and document libraries of every site in $batch requests
+        rootweb_uri = self.select_fields(ROOTWEB_URI, ROOTWEB_FIELDS)
+        endpoints = []
         for site in site_urls:
-            base = self.rest_request(site + '/_api/site/rootweb',
-                                     ntlm_auth).json()['d']
+            endpoints += [site + rootweb_uri, site + DOC_LIBS_URI]
+        responses = self.batch_request(batch_url, endpoints, ntlm_auth)
+
+        site_objs = {}
+        for index, site in enumerate(site_urls):
+            rootweb = responses[index * 2]
+            rootweb.raise_for_status()
+            base = self.parse_json(rootweb)
 
             # Add some additional properties that may be useful
-            base['DocLibs'] = self.get_doc_libs(site, ntlm_auth)
+            base['DocLibs'] = self.parse_doc_libs(responses[index * 2 + 1])
             base['SiteUrl'] = site
             base['Endpoint'] = '' if site == base_url else site.split(base_url)[1]
             base['Guid'] = base['Id'] + base['ServerRelativeUrl']
             base['ParentGuid'] = None
 
-            site_objs.append(base)
+            site_objs[site] = base
 
         return site_objs
 
-    # Return a list of SharePoint top level site URLs
-    def get_sites_list(self, base_url, ntlm_auth, sites_filter):
-        endpoint_uri = '/_api/search/query?querytext=\'contentclass:STS_Site\''
+    # Return a dict of site URL to the last modified date of its root web for a group
+    # of sites on the same host
+    def get_last_modified_group(self, base_url, batch_url, ntlm_auth, site_urls):
+        responses = self.batch_request(batch_url,
+                                       [site + LAST_MODIFIED_URI for site in site_urls],
+                                       ntlm_auth, use_cache=False)
+
+        dates = {}
+        for site, response in zip(site_urls, responses):
+            response.raise_for_status()
+            dates[site] = self.parse_json(response)['LastItemModifiedDate']
+
+        return dates
+
+    def iter_site_objects_delta(self, base_url, ntlm_auth, site_urls, checkpoint_file,
+                                sites_filter=None, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                                host_concurrency=0):
+        """Yield the site objects for the given list of URLs in order. Only sites whose root
+        web was modified since the site objects were saved to the checkpoint file are
+        fetched again. The checkpoint is only saved once every site has been yielded.
+        """
+        checkpoint = DeltaCheckpoint(checkpoint_file)
+        key = checkpoint_key('sites_list', normalize_url(base_url),
+                             sorted(normalize_url(site) for site in sites_filter or []),
+                             self.fields or [])
+        previous = (checkpoint.load(key) or {}).get('sites', {})
+
+        changed = site_urls
+        if previous:
+            dates = self.iter_site_groups(self.get_last_modified_group, base_url, ntlm_auth,
+                                          site_urls, max_concurrency, host_concurrency)
+            changed = [site for site, date in zip(site_urls, dates)
+                       if previous.get(normalize_url(site), {}).get('LastItemModifiedDate')
+                       != date]
+        fetched = self.iter_site_objects(base_url, ntlm_auth, changed, max_concurrency,
+                                         host_concurrency)
+
+        changed = set(changed)
+        sites = {}
+        for site in site_urls:
+            site_obj = next(fetched) if site in changed else previous[normalize_url(site)]
+            sites[normalize_url(site)] = site_obj
+            yield site_obj
+
+        checkpoint.save(key, {'sites': sites})
 
-        result = self.rest_request(urljoin(base_url, endpoint_uri), ntlm_auth)
-        row_count = (result.json()['d']['query']['PrimaryQueryResult']['RelevantResults']
-                     ['TotalRows'])
-        start_row = 0
+    # Return the KQL search queries for the given sites filter. The filter is split over
+    # several queries when the clauses would make the request URL too long.
+    def get_search_queries(self, sites_filter):
+        if not sites_filter:
+            return [SEARCH_QUERY]
+
+        queries = []
+        clauses = []
+        length = 0
+        for site in sites_filter:
+            clause = 'Path:"{0}"'.format(site.strip().rstrip('/'))
+            clause_length = len(self.quote_query(clause)) + len(self.quote_query(' OR '))
+            if clauses and length + clause_length > MAX_FILTER_LENGTH:
+                queries.append(clauses)
+                clauses = []
+                length = 0
+            clauses.append(clause)
+            length += clause_length
+        queries.append(clauses)
+
+        return ['{0} AND ({1})'.format(SEARCH_QUERY, ' OR '.join(clauses))
+                for clauses in queries]
+
+    # Return the query escaped so it can be used as the querytext string parameter
+    def quote_query(self, query):
+        return quote(query.replace("'", "''"), safe=':/')
+
+    # Return the site URLs from a page of search results
+    def parse_search_page(self, result):
         site_urls = []
-        while(start_row < row_count):
-            endpoint_page = endpoint_uri + '&rowlimit=500&startrow=' + str(start_row)
+        parents = result['PrimaryQueryResult']['RelevantResults']['Table']['Rows']
+
+        # Parse the response to get a list of the base site URLs
+        for site in parents:
+            # Save the name of the site from the SiteName key
+            for cell in site['Cells']:
+                if cell['Key'] == 'SiteName':
+                    site_urls.append(cell['Value'])
+
+        return site_urls
+
+    # Return a page of search results starting at the given row
+    def get_search_page(self, base_url, ntlm_auth, query, start_row, row_limit):
+        endpoint_page = SEARCH_URI.format(self.quote_query(query)) + \
+            '&rowlimit={0}&startrow={1}'.format(row_limit, start_row)
+
+        result = self.rest_request(urljoin(base_url, endpoint_page), ntlm_auth)
+        # An error response has no search results, raise it instead of a KeyError
+        result.raise_for_status()
+        return unwrap_result(self.parse_json(result), 'query')
+
+    # Return a list of SharePoint top level site URLs
+    def get_sites_list(self, base_url, ntlm_auth, sites_filter,
+                       max_concurrency=DEFAULT_MAX_CONCURRENCY, row_limit=DEFAULT_ROW_LIMIT):
+        queries = self.get_search_queries(sites_filter)
+
+        # The first page also returns the total number of rows so it doubles as the
+        # count request, the rest of the pages are then fetched concurrently
+        first_pages = self.map_concurrent(self.get_search_page,
+                                          [(base_url, ntlm_auth, query, 0, row_limit)
+                                           for query in queries],
+                                          max_concurrency)
 
-            result = self.rest_request(urljoin(base_url, endpoint_page), ntlm_auth)
-            parents = (result.json()['d']['query']['PrimaryQueryResult']['RelevantResults']
-                       ['Table']['Rows']['results'])
+        args_list = self.get_page_args(base_url, ntlm_auth, queries, first_pages, row_limit)
+        pages = self.map_concurrent(self.get_search_page, args_list, max_concurrency)
 
-            # Parse the response to get a list of the base site URLs
-            for site in parents:
-                # Save the name of the site from the SiteName key
-                for cell in site['Cells']['results']:
-                    if cell['Key'] == 'SiteName':
-                        if cell['Value'].lower() in sites_filter:
-                            site_urls.append(cell['Value'])
+        return self.filter_site_urls(first_pages + pages, sites_filter)
 
-            start_row += 500
+    # Return the get_search_page arguments for every page after the first of each query
+    def get_page_args(self, base_url, ntlm_auth, queries, first_pages, row_limit):
+        args_list = []
+        for query, first_page in zip(queries, first_pages):
+            row_count = first_page['PrimaryQueryResult']['RelevantResults']['TotalRows']
+            args_list += [(base_url, ntlm_auth, query, start_row, row_limit)
+                          for start_row in range(row_limit, row_count, row_limit)]
+        return args_list
+
+    # Return the unique site URLs in the search pages that are in the sites filter
+    def filter_site_urls(self, pages, sites_filter):
+        # Search matches paths by prefix so only keep the sites that are in the filter
+        filter_urls = set(normalize_url(site) for site in sites_filter or [])
+        site_urls = []
+        seen = set()
+        for page in pages:
+            for site in self.parse_search_page(page):
+                url = normalize_url(site)
+                if url in seen or (filter_urls and url not in filter_urls):
+                    continue
+                seen.add(url)
+                site_urls.append(site)
 
         return site_urls
 
+    # Yield the records the action returns for the sites found by search
+    def iter_sites(self, base_url, ntlm_auth, site_urls, sites_filter,
+                   max_concurrency=DEFAULT_MAX_CONCURRENCY, host_concurrency=0,
+                   delta_checkpoint_file=None):
+        if delta_checkpoint_file:
+            return self.iter_site_objects_delta(base_url, ntlm_auth, site_urls,
+                                                delta_checkpoint_file, sites_filter,
+                                                max_concurrency, host_concurrency)
+        return self.iter_site_objects(base_url, ntlm_auth, site_urls, max_concurrency,
+                                      host_concurrency)
+
     def run(self, base_url, domain, output_file, output_file_append,
             output_type, password, username, token_auth, rsa_private_key,
-            cert_thumbprint, tenent_id, client_id, sites_filter):
+            cert_thumbprint, tenent_id, client_id, sites_filter,
+            max_concurrency=DEFAULT_MAX_CONCURRENCY, host_concurrency=0,
+            search_row_limit=DEFAULT_ROW_LIMIT, output_file_format='json',
+            delta_checkpoint_file=None, fields=None, metrics=False, metrics_file=None,
+            metrics_format='prometheus', access_token=None):
         """
         Return a list of subsites on the given base site
 
@@ -88,34 +280,56 @@ class SitesList(SharepointBaseAction):
             given file or overwrite it
         - output_type: "console" or "file" specifies whether to send output to
             console or save it in a specified file
+        - output_file_format: "json" or "ndjson" format of the output file
         - password: Password to login to sharepoint
         - username: Username to login to sharepoint
+        - sites_filter: List of sharepoint site URLs to return information for, all sites
+            are returned if it is empty
+        - max_concurrency: Number of site groups or search pages to fetch from SharePoint
+            at the same time
+        - host_concurrency: Maximum number of site groups to fetch from a single host at
+            the same time, 0 for no limit
+        - search_row_limit: Number of search results to request per page
+        - delta_checkpoint_file: (Optional) file the site objects are saved to, so later
+            runs only fetch the sites that were modified since
+        - fields: (Optional) list of root web fields to return, all fields are returned
+            if it is empty
+        - metrics: Boolean, whether to return the count, size, status codes and latency
+            of the requests sent to each endpoint in a _metrics section
+        - metrics_file: (Optional) file to write the request metrics to
+        - metrics_format: "prometheus" or "statsd" format of the metrics file
+        - access_token: (Optional) bearer token to send instead of authenticating with
+            NTLM or the Azure AD app
 
         Returns:
         - List: List of Sharepoint sites and subsites if output_type is "console"
         - String: Path to the output file if output_type is "file"
+        - Dict: The result above and the request metrics if metrics is true
         """
-        self.token_auth = token_auth
-
-        if self.token_auth:
-            user_auth = self.create_token_auth_cred(rsa_private_key,
-                                                    cert_thumbprint,
-                                                    tenent_id,
-                                                    client_id,
-                                                    base_url)
-        else:
-            user_auth = self.create_ntlm_auth_cred(domain, username, password)
+        # Keep enough pooled connections open for every worker
+        self.pool_size = max(self.pool_size, max_concurrency)
+        self.fields = [field.strip() for field in fields or [] if field.strip()]
+
+        user_auth = self.create_auth_cred(token_auth, domain, username, password,
+                                          rsa_private_key, cert_thumbprint, tenent_id,
+                                          client_id, base_url, access_token)
 
-        # Convert to a set to remove dulicates
-        my_set = set(sites_filter)
-        sites_filter = list(my_set)
-        sites_filter = [site.lower() for site in sites_filter]
+        # Remove duplicates while keeping the order of the filter
+        sites_filter = list(dict((normalize_url(site), site)
+                                 for site in sites_filter or []).values())
 
-        sites_list = self.get_sites_list(base_url, user_auth, sites_filter)
-        site_objs = self.get_site_objects(base_url, user_auth, sites_list)
+        sites_list = self.get_sites_list(base_url, user_auth, sites_filter,
+                                         max_concurrency, search_row_limit)
+        site_objs = self.iter_sites(base_url, user_auth, sites_list, sites_filter,
+                                    max_concurrency, host_concurrency, delta_checkpoint_file)
 
-        # If the output type is file then return a string with the path to the file
+        # If the output type is file then return a string with the path to the file.
+        # Sites are written to the file as they are fetched instead of all at the end.
         if output_type == 'file':
-            self.save_sites_list_to_file(site_objs, output_file,
-                                         output_file_append)
-        return site_objs
+            result = self.save_sites_list_to_file(site_objs, output_file,
+                                                  output_file_append, output_file_format)
+        else:
+            result = list(site_objs)
+
+        return self.add_metrics(result, self.metrics_name, metrics, metrics_file,
+                                metrics_format)
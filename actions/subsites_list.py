@@ -12,8 +12,29 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
+import requests
+from concurrent.futures import wait, FIRST_COMPLETED
 from urllib.parse import urljoin
-from lib.base_action import SharepointBaseAction
+from lib.base_action import SharepointBaseAction, DOC_LIBS_URI, normalize_url, worker_pool
+from lib.delta import (DeltaCheckpoint, checkpoint_key, find_parent, find_web,
+                       replace_subtree, CHANGE_TYPE_DELETE)
+from lib.output_file import (read_ndjson, truncate_records, write_records,
+                             OUTPUT_FORMATS)
+from lib.site_cache import get_site_tree_cache, site_tree_key, DEFAULT_MAX_STALENESS
+
+# Number of subsites fetched from SharePoint at the same time
+DEFAULT_MAX_CONCURRENCY = 10
+
+# Appending the following to the endpoint to get a list of subsites
+SUBWEBS_URI = '/_api/web/getsubwebsfilteredforcurrentuser' \
+              '(nwebtemplatefilter=-1,nconfigurationfilter=0)'
+
+# Site collection endpoints used to find the webs that changed since the last run
+CHANGE_TOKEN_URI = '/_api/site?$select=CurrentChangeToken'
+GET_CHANGES_URI = '/_api/site/getchanges'
+OPEN_WEB_URI = "/_api/site/openWebById('{0}')?$select=ServerRelativeUrl"
+PARENT_WEB_URI = '/_api/web/parentweb?$select=Id,ServerRelativeUrl'
 
 
 class SubsitesList(SharepointBaseAction):
@@ -26,48 +47,475 @@ class SubsitesList(SharepointBaseAction):
 
     # Create and return a GUID for the Parent site
     def get_parent_site(self, base_url, ntlm_auth, subsite=''):
-        endpoint_uri = '/_api/web/parentweb'
-        parent = self.rest_request(urljoin(base_url, subsite + endpoint_uri), ntlm_auth)
-        return parent.json()['d']['Id'] + parent.json()['d']['ServerRelativeUrl']
-
-    def get_sites_list(self, base_url, ntlm_auth, endpoint=''):
-        # Appending the following to the endpoint to get a list of subsites
-        endpoint_uri = '/_api/web/getsubwebsfilteredforcurrentuser' \
-                       '(nwebtemplatefilter=-1,nconfigurationfilter=0)'
-        site_list = []
-
-        result = self.rest_request(urljoin(base_url, endpoint + endpoint_uri), ntlm_auth)
-        # Verify that a result was returned by the request
+        parent = self.parse_json(self.rest_request(urljoin(base_url, subsite + PARENT_WEB_URI),
+                                                   ntlm_auth))
+        return parent['Id'] + parent['ServerRelativeUrl']
+
+    # Return the raw list of subsites directly under the given endpoint
+    def get_subwebs(self, base_url, ntlm_auth, endpoint=''):
+        result = self.rest_request(urljoin(base_url, endpoint + self.select_fields(SUBWEBS_URI)),
+                                   ntlm_auth)
+        return self.parse_subwebs(result)
+
+    # Return the subsites from a subwebs response. A web whose subwebs can't be listed,
+    # e.g. because of a 403, has none so it doesn't stop the rest of the crawl.
+    def parse_subwebs(self, result):
+        if not result.ok:
+            return []
         try:
-            if len(result.json()['d']['results']) == 0:
-                return site_list
-        except:
-            return site_list
+            subwebs = self.parse_json(result)
+        except ValueError:
+            return []
+        return subwebs if isinstance(subwebs, list) else []
 
-        for element in result.json()['d']['results']:
-            subsite = element['ServerRelativeUrl']
+    # Return the subsites directly under the endpoint along with the GUID of the
+    # endpoint web which is the parent of all of them
+    def get_root_subwebs(self, base_url, ntlm_auth, endpoint=''):
+        subwebs = self.get_subwebs(base_url, ntlm_auth, endpoint)
 
+        # Every subsite in the list shares the same parent so a single lookup is enough.
+        # If the response has no parent each subsite falls back to looking up its own.
+        # Request errors, like throttling that outlasted the retries, are raised.
+        try:
+            parent_guid = self.get_parent_site(base_url, ntlm_auth,
+                                               subwebs[0]['ServerRelativeUrl'])
+        except (KeyError, IndexError, ValueError):
+            parent_guid = None
+
+        return parent_guid, subwebs
+
+    # Add the extra properties to a group of sibling subsites and return each of them
+    # along with its own subsites. Sites that can't be resolved are returned as None.
+    def get_site_objects(self, base_url, ntlm_auth, elements, parent_guid=None):
+        sites = []
+        for element in elements:
             try:
                 # Need to save a new GUID field because sharepoint site IDs are not unique
                 element['Guid'] = element['Id'] + element['ServerRelativeUrl']
-                element['ParentGuid'] = self.get_parent_site(base_url, ntlm_auth, subsite)
-            except:
+                # The parent is the web whose subsite listing returned this element so its
+                # GUID is passed down by the crawl instead of being requested again
+                if parent_guid is None:
+                    element['ParentGuid'] = self.get_parent_site(base_url, ntlm_auth,
+                                                                 element['ServerRelativeUrl'])
+                else:
+                    element['ParentGuid'] = parent_guid
+            except (KeyError, IndexError, ValueError):
+                element = None
+            sites.append(element)
+
+        # Request the document libraries and subsites of every site in $batch requests
+        subwebs_uri = self.select_fields(SUBWEBS_URI)
+        endpoints = []
+        for site in sites:
+            if site is not None:
+                site['SiteUrl'] = urljoin(base_url, site['ServerRelativeUrl'])
+                endpoints += [site['SiteUrl'] + DOC_LIBS_URI,
+                              urljoin(base_url, site['ServerRelativeUrl'] + subwebs_uri)]
+        responses = iter(self.batch_request(base_url, endpoints, ntlm_auth))
+
+        results = []
+        for site in sites:
+            if site is None:
+                results.append((None, []))
                 continue
 
-            site_url = urljoin(base_url, subsite)
             # Add a list of each sites Document Libraries
-            element['DocLibs'] = self.get_doc_libs(site_url, ntlm_auth)
-            element['SiteUrl'] = site_url
+            site['DocLibs'] = self.parse_doc_libs(next(responses))
+            results.append((site, self.parse_subwebs(next(responses))))
+
+        return results
+
+    def get_sites_list(self, base_url, ntlm_auth, endpoint='',
+                       max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        return list(self.iter_sites_list(base_url, ntlm_auth, endpoint, max_concurrency))
+
+    def iter_sites_list(self, base_url, ntlm_auth, endpoint='',
+                        max_concurrency=DEFAULT_MAX_CONCURRENCY, frontier=None,
+                        progress=None, executor=None):
+        """Yield the subsites of the endpoint in depth-first order as they are fetched.
+        Sibling subtrees are fetched concurrently. Every web gets a node in a tree that
+        mirrors the hierarchy and a site is yielded once it and every site before it
+        in depth-first order are known, so the order doesn't depend on the order the
+        requests finish in. Yielded nodes are dropped from the tree to keep memory flat.
+        :param frontier: (Optional) frontier returned by get_frontier() for a previous
+            crawl, the crawl continues from there instead of from the endpoint
+        :param progress: (Optional) dict the crawl keeps its state in, pass it to
+            get_frontier() while the generator is paused to get the remaining work
+        :param executor: (Optional) executor to fetch the groups on instead of a new pool,
+            at most max_concurrency groups are submitted to it at a time
+        """
+        # Siblings are processed in groups that fit in a single $batch request
+        # since each site needs two requests (doc libs and subsites)
+        group_size = max(1, self.batch_size // 2)
+        max_workers = max(1, max_concurrency)
+
+        # Groups waiting to be fetched. This is a stack so groups deeper in the tree
+        # and earlier in depth-first order are fetched first, which lets sites be
+        # yielded as early as possible instead of piling up in memory.
+        groups = []
+
+        # URLs of the webs the crawl has reached, a web listed again under another
+        # parent or spelled differently is skipped so it isn't crawled twice
+        seen = set()
+
+        # Each node keeps a copy of the subweb it was listed as, the workers add the
+        # site properties to the original
+        def new_nodes(entries):
+            entries = [(element, parent_guid) for element, parent_guid in entries
+                       if self.first_visit(seen, base_url, element)]
+            nodes = [{'site': None, 'subsites': [], 'done': False,
+                      'element': dict(element), 'parent_guid': parent_guid}
+                     for element, parent_guid in entries]
+            # Siblings with the same parent are grouped, up to group_size at a time
+            starts = []
+            for start in range(len(entries)):
+                if not starts or start - starts[-1] >= group_size or \
+                        entries[start][1] != entries[starts[-1]][1]:
+                    starts.append(start)
+            for start, end in reversed(list(zip(starts, starts[1:] + [len(entries)]))):
+                groups.append(([element for element, _ in entries[start:end]],
+                               entries[start][1], nodes[start:end]))
+            return nodes
+
+        def add_subsites(node, subwebs, parent_guid):
+            node['subsites'] = new_nodes([(element, parent_guid) for element in subwebs])
+
+        if frontier is None:
+            parent_guid, subwebs = self.get_root_subwebs(base_url, ntlm_auth, endpoint)
+            entries = [(element, parent_guid) for element in subwebs]
+        else:
+            entries = [(element, parent_guid) for element, parent_guid in frontier]
+        root = {'site': None, 'subsites': new_nodes(entries), 'done': True}
+        # Nodes still to be yielded, the top of the stack is next in depth-first order
+        cursor = list(reversed(root['subsites']))
+        if progress is not None:
+            progress['cursor'] = cursor
+
+        with worker_pool(max_workers, executor) as executor:
+            pending = {}
+            while cursor:
+                while groups and len(pending) < max_workers:
+                    elements, parent_guid, nodes = groups.pop()
+                    future = executor.submit(self.get_site_objects, base_url, ntlm_auth,
+                                             elements, parent_guid)
+                    pending[future] = nodes
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    nodes = pending.pop(future)
+                    for node, (site, subwebs) in zip(nodes, future.result()):
+                        node['site'] = site
+                        if site is not None:
+                            add_subsites(node, subwebs, site['Guid'])
+                        node['done'] = True
+
+                # Yield every site that is ready in depth-first order
+                while cursor and cursor[-1]['done']:
+                    node = cursor.pop()
+                    cursor.extend(reversed(node['subsites']))
+                    if node['site'] is not None:
+                        yield node['site']
+                    node['site'] = None
+                    node['subsites'] = []
+
+    # Return whether the crawl reaches the web for the first time and remember it
+    def first_visit(self, seen, base_url, element):
+        if 'ServerRelativeUrl' not in element:
+            return True
+
+        url = normalize_url(urljoin(base_url, element['ServerRelativeUrl']))
+        if url in seen:
+            return False
+        seen.add(url)
+        return True
+
+    def get_frontier(self, progress):
+        """Return the work left in a crawl by iter_sites_list as a JSON serializable list
+        of subweb and parent GUID pairs in depth-first order, or None if the crawl hasn't
+        started. Every subsite that hasn't been yielded is either in the list or below a
+        subweb in the list.
+        :param progress: Dict passed to iter_sites_list
+        """
+        cursor = progress.get('cursor')
+        if cursor is None:
+            return None
+
+        return [[node['element'], node['parent_guid']] for node in reversed(cursor)]
+
+    def save_resumable(self, base_url, ntlm_auth, endpoint, resume_from, file_path,
+                       file_append, file_format, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """Crawl the subsites of the endpoint into a file, saving the progress to the
+        resume_from checkpoint file every time records are written. If a previous crawl
+        into the same file didn't finish, the file is cut back to the last checkpoint
+        and the crawl continues from the frontier saved with it. The checkpoint is
+        removed once the crawl finishes.
+        :param file_path: Path to the output file
+        :param file_append: Boolean, whether a new crawl appends to the file
+        :param file_format: "json" or "ndjson" format of the output file
+        :returns: Number of records in the file from this crawl, including earlier runs
+        """
+        checkpoint = DeltaCheckpoint(resume_from)
+        key = checkpoint_key('subsites_list.resume', normalize_url(base_url),
+                             normalize_url(endpoint), self.fields or [],
+                             os.path.abspath(file_path))
+        entry = checkpoint.load(key)
+        # Without the output file there is nothing to continue
+        if entry and not os.path.exists(file_path):
+            entry = None
+
+        frontier = None
+        emitted = 0
+        if entry:
+            truncate_records(file_path, entry['offset'], file_format)
+            frontier = entry['frontier']
+            emitted = entry['emitted']
+            file_append = True
+
+        progress = {}
+
+        def on_flush(count, offset):
+            checkpoint.save(key, {'frontier': self.get_frontier(progress),
+                                  'emitted': emitted + count,
+                                  'offset': offset})
+
+        # A frontier of None means the previous crawl hadn't started
+        sites = self.iter_sites_list(base_url, ntlm_auth, endpoint, max_concurrency,
+                                     frontier, progress)
+        count = write_records(sites, file_path, file_append, file_format, on_flush=on_flush)
+        checkpoint.remove(key)
+
+        return emitted + count
+
+    def run_resumable(self, base_url, ntlm_auth, endpoint, resume_from, output_file,
+                      output_file_append, output_type, output_file_format,
+                      max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """Crawl the subsites of the endpoint with save_resumable and return the result
+        of the action. Console output is collected in a JSON Lines file next to the
+        checkpoint so the sites found before a failure aren't lost either.
+        """
+        if output_type == 'file':
+            if not output_file:
+                raise ValueError('output_file path must be specified to save output to file.')
+            if output_file_format not in OUTPUT_FORMATS:
+                raise ValueError('Unknown output file format: {0}'.format(output_file_format))
+            self.save_resumable(base_url, ntlm_auth, endpoint, resume_from, output_file,
+                                output_file_append, output_file_format, max_concurrency)
+            return 'Output saved to: ' + output_file
+
+        records_file = resume_from + '.records'
+        self.save_resumable(base_url, ntlm_auth, endpoint, resume_from, records_file,
+                            False, 'ndjson', max_concurrency)
+        sites = list(read_ndjson(records_file))
+        os.remove(records_file)
+        return sites
+
+    # Return the current change token of the site collection the endpoint belongs to
+    def get_change_token(self, base_url, ntlm_auth, endpoint=''):
+        result = self.rest_request(urljoin(base_url, endpoint + CHANGE_TOKEN_URI), ntlm_auth,
+                                   use_cache=False)
+        result.raise_for_status()
+        return self.parse_json(result)['CurrentChangeToken']['StringValue']
+
+    # Return the web and list changes made in the site collection between two change tokens
+    def get_changes(self, base_url, ntlm_auth, endpoint, start_token, end_token):
+        changes = []
+        # SharePoint returns the changes in pages, each page starts after the
+        # last change of the one before it
+        while start_token != end_token:
+            query = {'query': {
+                '__metadata': {'type': 'SP.ChangeQuery'},
+                'Web': True,
+                'List': True,
+                'Add': True,
+                'Update': True,
+                'DeleteObject': True,
+                'Rename': True,
+                'ChangeTokenStart': {'__metadata': {'type': 'SP.ChangeToken'},
+                                     'StringValue': start_token},
+                'ChangeTokenEnd': {'__metadata': {'type': 'SP.ChangeToken'},
+                                   'StringValue': end_token}
+            }}
+            result = self.post_request(urljoin(base_url, endpoint or '/'),
+                                       urljoin(base_url, endpoint + GET_CHANGES_URI),
+                                       ntlm_auth, query)
+            result.raise_for_status()
+
+            page = self.parse_json(result)
+            if not page:
+                break
+            changes += page
+            start_token = page[-1]['ChangeToken']['StringValue']
+
+        return changes
+
+    # Return the subsite entry of a changed web as listed by its parent web, or None if
+    # the web was deleted or isn't a subsite of the endpoint
+    def get_changed_web(self, base_url, ntlm_auth, endpoint, web_id):
+        result = self.post_request(urljoin(base_url, endpoint or '/'),
+                                   urljoin(base_url, endpoint + OPEN_WEB_URI.format(web_id)),
+                                   ntlm_auth)
+        # Only a web that can't be found is gone, any other error stops the delta run so
+        # the web isn't dropped from the inventory and the change token isn't saved
+        if result.status_code == 404:
+            return None
+        result.raise_for_status()
+
+        url = self.parse_json(result)['ServerRelativeUrl'].rstrip('/')
+        if not url.lower().startswith(endpoint.rstrip('/').lower() + '/'):
+            return None
+
+        # List the web from its parent so it has the same properties as a crawled web
+        for element in self.get_subwebs(base_url, ntlm_auth, url.rsplit('/', 1)[0]):
+            if element['Id'].lower() == web_id.lower():
+                return element
+
+        return None
 
-            site_list.append(element)
-            # Check for any subsites and add them to the list
-            site_list += self.get_sites_list(base_url, ntlm_auth, subsite)
+    # Return a web and all of its subsites in depth-first order
+    def get_subtree(self, base_url, ntlm_auth, element, parent_guid=None,
+                    max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        site = self.get_site_objects(base_url, ntlm_auth, [element], parent_guid)[0][0]
+        if site is None:
+            return []
 
-        return site_list
+        return [site] + self.get_sites_list(base_url, ntlm_auth, site['ServerRelativeUrl'],
+                                            max_concurrency)
+
+    def apply_changes(self, base_url, ntlm_auth, endpoint, records, changes,
+                      max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """Update the subsites found by a previous run with the changes made since then.
+        Webs that were updated are fetched again, the subtrees of webs that were added,
+        moved or renamed are crawled again and the subtrees of deleted webs are removed.
+        The document libraries of webs with list changes are refreshed.
+        :param records: List of subsites from the previous run in depth-first order
+        :param changes: List of SP.ChangeWeb and SP.ChangeList objects
+        :returns: The updated list of subsites in depth-first order
+        """
+        # The last change to a web decides whether it still exists
+        deleted = {}
+        list_changes = set()
+        for change in changes:
+            web_id = change['WebId'].lower()
+            # Only list changes have a ListId, the change types aren't in the response
+            # unless the verbose metadata level is used
+            if 'ListId' not in change:
+                deleted[web_id] = change['ChangeType'] == CHANGE_TYPE_DELETE
+            else:
+                list_changes.add(web_id)
+
+        changed_ids = [web_id for web_id in deleted if not deleted[web_id]]
+        elements = dict(zip(changed_ids, self.map_concurrent(
+            self.get_changed_web,
+            [(base_url, ntlm_auth, endpoint, web_id) for web_id in changed_ids],
+            max_concurrency)))
+
+        def get_url(web_id):
+            if elements.get(web_id):
+                return elements[web_id]['ServerRelativeUrl']
+            index = find_web(records, web_id)
+            return records[index]['ServerRelativeUrl'] if index is not None else ''
+
+        # Fetch subtrees from the top of the tree down and skip changed webs inside a
+        # subtree that was already fetched again
+        fetched = []
+        refreshed = set()
+
+        def is_fetched(web_id):
+            url = get_url(web_id).lower()
+            return web_id in refreshed or any(url.startswith(prefix) for prefix in fetched)
+
+        for web_id in sorted(deleted, key=lambda web_id: get_url(web_id).count('/')):
+            if is_fetched(web_id):
+                continue
+
+            element = elements.get(web_id)
+            index = find_web(records, web_id)
+            if element and index is not None and \
+                    records[index]['ServerRelativeUrl'] == element['ServerRelativeUrl']:
+                # The web wasn't moved or renamed so its subsites are still in place
+                site = self.get_site_objects(base_url, ntlm_auth, [element],
+                                             records[index]['ParentGuid'])[0][0]
+                if site is not None:
+                    records[index] = site
+                refreshed.add(web_id)
+                continue
+
+            subtree = []
+            if element:
+                parent = find_parent(records, element['ServerRelativeUrl'])
+                parent_guid = records[parent]['Guid'] if parent is not None else None
+                subtree = self.get_subtree(base_url, ntlm_auth, element, parent_guid,
+                                           max_concurrency)
+                fetched.append(element['ServerRelativeUrl'].rstrip('/').lower() + '/')
+                refreshed.add(web_id)
+            replace_subtree(records, web_id, subtree)
+
+        # Refresh the document libraries of the other webs whose lists changed
+        sites = []
+        for web_id in list_changes:
+            index = find_web(records, web_id)
+            if index is not None and not is_fetched(web_id):
+                sites.append(records[index])
+        libs = self.get_doc_libs_batch(base_url, [site['SiteUrl'] for site in sites],
+                                       ntlm_auth)
+        for site, doc_libs in zip(sites, libs):
+            site['DocLibs'] = doc_libs
+
+        return records
+
+    def iter_sites_delta(self, base_url, ntlm_auth, endpoint, checkpoint_file,
+                         max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """Yield the subsites of the endpoint in depth-first order by updating the subsites
+        saved in the checkpoint file with the changes made since the last run. The first
+        run, or a run whose change token SharePoint no longer has changes for, crawls every
+        subsite. The checkpoint is only saved once every subsite has been yielded.
+        """
+        checkpoint = DeltaCheckpoint(checkpoint_file)
+        key = checkpoint_key('subsites_list', normalize_url(base_url),
+                             normalize_url(endpoint), self.fields or [])
+        entry = checkpoint.load(key)
+
+        # The token is read first so changes made while this run is going are picked up
+        # by the next run
+        change_token = self.get_change_token(base_url, ntlm_auth, endpoint)
+
+        records = None
+        if entry:
+            try:
+                changes = self.get_changes(base_url, ntlm_auth, endpoint,
+                                           entry['change_token'], change_token)
+            except requests.HTTPError:
+                # The change log only goes back so far, older tokens need a full crawl
+                changes = None
+            if changes is not None:
+                records = self.apply_changes(base_url, ntlm_auth, endpoint,
+                                             entry['records'], changes, max_concurrency)
+
+        if records is None:
+            records = []
+            for site in self.iter_sites_list(base_url, ntlm_auth, endpoint,
+                                             max_concurrency):
+                records.append(site)
+                yield site
+        else:
+            for site in records:
+                yield site
+
+        checkpoint.save(key, {'change_token': change_token, 'records': records})
+
+    # Return the subsites of the endpoint saved by the site tree sensor, or None if they
+    # aren't cached or were saved more than max_staleness seconds ago
+    def load_cached_tree(self, base_url, endpoint, max_staleness=DEFAULT_MAX_STALENESS):
+        return get_site_tree_cache(self.config).load_tree(
+            site_tree_key(base_url, endpoint, self.fields), max_staleness)
 
     def run(self, base_url, domain, endpoint, output_file, output_file_append,
             output_type, password, username, token_auth, rsa_private_key,
-            cert_thumbprint, tenent_id, client_id):
+            cert_thumbprint, tenent_id, client_id,
+            max_concurrency=DEFAULT_MAX_CONCURRENCY, output_file_format='json',
+            delta_checkpoint_file=None, fields=None, metrics=False, metrics_file=None,
+            metrics_format='prometheus', resume_from=None, access_token=None,
+            use_cache=False, max_staleness=DEFAULT_MAX_STALENESS):
         """
         Return a list of subsites on the given base site
 
@@ -80,29 +528,69 @@ class SubsitesList(SharepointBaseAction):
             given file or overwrite it
         - output_type: "console" or "file" specifies whether to send output to
             console or save it in a specified file
+        - output_file_format: "json" or "ndjson" format of the output file
         - password: Password to login to sharepoint
         - username: Username to login to sharepoint
+        - max_concurrency: Number of subsites to fetch from SharePoint at the same time
+        - delta_checkpoint_file: (Optional) file the subsites are saved to along with the
+            change token of the site collection, so later runs only fetch the webs
+            that changed since
+        - fields: (Optional) list of web fields to return, all fields are returned if
+            it is empty
+        - metrics: Boolean, whether to return the count, size, status codes and latency
+            of the requests sent to each endpoint in a _metrics section
+        - metrics_file: (Optional) file to write the request metrics to
+        - metrics_format: "prometheus" or "statsd" format of the metrics file
+        - resume_from: (Optional) checkpoint file the crawl progress is saved to. If a
+            previous crawl with the same file didn't finish it continues from there.
+        - access_token: (Optional) bearer token to send instead of authenticating with
+            NTLM or the Azure AD app
+        - use_cache: Boolean, whether to return the subsites saved by the site tree sensor
+            instead of crawling SharePoint when they are fresh enough
+        - max_staleness: Maximum age in seconds of cached subsites that are returned
 
         Returns:
         - List: List of Sharepoint sites and subsites if output_type is "console"
         - String: Path to the output file if output_type is "file"
+        - Dict: The result above and the request metrics if metrics is true
         """
-        self.token_auth = token_auth
-
-        if self.token_auth:
-            user_auth = self.create_token_auth_cred(rsa_private_key,
-                                                    cert_thumbprint,
-                                                    tenent_id,
-                                                    client_id,
-                                                    base_url)
-        else:
-            user_auth = self.create_ntlm_auth_cred(domain, username, password)
+        # Keep enough pooled connections open for every worker
+        self.pool_size = max(self.pool_size, max_concurrency)
+        self.fields = [field.strip() for field in fields or [] if field.strip()]
+        if resume_from and delta_checkpoint_file:
+            raise ValueError('resume_from can not be used with delta_checkpoint_file.')
 
-        site_objs = self.get_sites_list(base_url, user_auth, endpoint)
+        # A fresh enough tree from the site tree sensor is returned without
+        # authenticating or sending a single request
+        site_objs = self.load_cached_tree(base_url, endpoint, max_staleness) \
+            if use_cache else None
 
-        # If the output type is file then return a string with the path to the file
+        if site_objs is None:
+            user_auth = self.create_auth_cred(token_auth, domain, username, password,
+                                              rsa_private_key, cert_thumbprint, tenent_id,
+                                              client_id, base_url, access_token)
+
+            if resume_from:
+                result = self.run_resumable(base_url, user_auth, endpoint, resume_from,
+                                            output_file, output_file_append, output_type,
+                                            output_file_format, max_concurrency)
+                return self.add_metrics(result, 'subsites_list', metrics, metrics_file,
+                                        metrics_format)
+
+            if delta_checkpoint_file:
+                site_objs = self.iter_sites_delta(base_url, user_auth, endpoint,
+                                                  delta_checkpoint_file, max_concurrency)
+            else:
+                site_objs = self.iter_sites_list(base_url, user_auth, endpoint,
+                                                 max_concurrency)
+
+        # If the output type is file then return a string with the path to the file.
+        # Sites are written to the file as they are found instead of all at the end.
         if output_type == 'file':
-            return self.save_sites_list_to_file(site_objs, output_file,
-                                                output_file_append)
+            result = self.save_sites_list_to_file(site_objs, output_file,
+                                                  output_file_append, output_file_format)
+        else:
+            result = list(site_objs)
 
-        return site_objs
+        return self.add_metrics(result, 'subsites_list', metrics, metrics_file,
+                                metrics_format)
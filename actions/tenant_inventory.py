@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from urllib.parse import urlparse
+from lib.base_action import worker_pool
+from sites_list import SitesList, DEFAULT_MAX_CONCURRENCY, DEFAULT_ROW_LIMIT
+from subsites_list import SubsitesList, SUBWEBS_URI
+
+
+class TenantInventory(SitesList):
+    metrics_name = 'tenant_inventory'
+
+    def __init__(self, config):
+        """Creates a new BaseAction given a StackStorm config object (kwargs works too)
+        :param config: StackStorm configuration object for the pack
+        :returns: a new BaseAction
+        """
+        super(TenantInventory, self).__init__(config)
+
+    # Yield lists of consecutive sites on the same host, each small enough for the
+    # subwebs of every site to be requested in a single $batch request
+    def iter_site_chunks(self, site_objs):
+        chunk = []
+        for site in site_objs:
+            if chunk and (len(chunk) >= self.batch_size or
+                          urlparse(site['SiteUrl']).netloc.lower() !=
+                          urlparse(chunk[0]['SiteUrl']).netloc.lower()):
+                yield chunk
+                chunk = []
+            chunk.append(site)
+        if chunk:
+            yield chunk
+
+    def iter_chunk(self, subsites, ntlm_auth, sites, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                   executor=None):
+        """Yield each site of a chunk followed by its subsites in depth-first order. The
+        subwebs of every site are requested in one $batch request and the subsites of the
+        whole chunk are then crawled together, so small site collections don't each wait
+        for their own requests.
+        :param subsites: SubsitesList action sharing this action's transport
+        :param sites: List of site objects on the same host
+        :param executor: (Optional) executor to crawl the subsites on instead of a new pool
+        """
+        url = urlparse(sites[0]['SiteUrl'])
+        host_url = url.scheme + '://' + url.netloc
+        responses = self.batch_request(host_url,
+                                       [site['SiteUrl'].rstrip('/') +
+                                        self.select_fields(SUBWEBS_URI) for site in sites],
+                                       ntlm_auth)
+
+        # The top level subwebs of every site continue the crawl under that site
+        frontier = []
+        for site, response in zip(sites, responses):
+            frontier += [[element, site['Guid']]
+                         for element in subsites.parse_subwebs(response)]
+
+        # Subsites come in depth-first order, so a subsite whose parent isn't in the
+        # current site is the first one of a later site
+        pending = list(reversed(sites))
+        guids = set()
+        for subsite in subsites.iter_sites_list(host_url, ntlm_auth, '', max_concurrency,
+                                                frontier, executor=executor):
+            while subsite['ParentGuid'] not in guids and pending:
+                site = pending.pop()
+                guids = {site['Guid']}
+                yield site
+            guids.add(subsite['Guid'])
+            yield subsite
+
+        while pending:
+            yield pending.pop()
+
+    def iter_inventory(self, base_url, ntlm_auth, site_urls,
+                       max_concurrency=DEFAULT_MAX_CONCURRENCY, host_concurrency=0):
+        """Yield every site in site_urls followed by all of its subsites in depth-first
+        order. Sites and subsites are the same records sites_list and subsites_list
+        return, including their document libraries.
+        """
+        subsites = self.create_shared_action(SubsitesList)
+
+        # The site objects are prefetched on the same workers that crawl the subsites, so
+        # the whole inventory runs on max_concurrency worker threads
+        with worker_pool(max(1, max_concurrency)) as executor:
+            site_objs = self.iter_site_objects(base_url, ntlm_auth, site_urls,
+                                               max_concurrency, host_concurrency, executor)
+            for sites in self.iter_site_chunks(site_objs):
+                for site in self.iter_chunk(subsites, ntlm_auth, sites, max_concurrency,
+                                            executor):
+                    yield site
+
+    # Yield every site followed by its subsites, there are no delta runs of the inventory
+    def iter_sites(self, base_url, ntlm_auth, site_urls, sites_filter,
+                   max_concurrency=DEFAULT_MAX_CONCURRENCY, host_concurrency=0,
+                   delta_checkpoint_file=None):
+        return self.iter_inventory(base_url, ntlm_auth, site_urls, max_concurrency,
+                                   host_concurrency)
+
+    def run(self, base_url, domain, output_file, output_file_append,
+            output_type, password, username, token_auth, rsa_private_key,
+            cert_thumbprint, tenent_id, client_id, sites_filter,
+            max_concurrency=DEFAULT_MAX_CONCURRENCY, host_concurrency=0,
+            search_row_limit=DEFAULT_ROW_LIMIT, output_file_format='json', fields=None,
+            metrics=False, metrics_file=None, metrics_format='prometheus', access_token=None):
+        """
+        Return every site collection of the tenant with all of its subsites and document
+        libraries, using one set of sessions, one token and one concurrency limit for the
+        whole inventory
+
+        Args:
+        - base_url: URL of the base Sharepoint site
+        - domain: Domain for the given username
+        - output_file: (Optional) file to save sites output to
+        - output_file_append: Boolean, whether to append the sites list to the
+            given file or overwrite it
+        - output_type: "console" or "file" specifies whether to send output to
+            console or save it in a specified file
+        - output_file_format: "json" or "ndjson" format of the output file
+        - password: Password to login to sharepoint
+        - username: Username to login to sharepoint
+        - sites_filter: List of sharepoint site URLs to return information for, all sites
+            are returned if it is empty
+        - max_concurrency: Number of site groups, search pages or subsites to fetch from
+            SharePoint at the same time
+        - host_concurrency: Maximum number of site groups to fetch from a single host at
+            the same time, 0 for no limit
+        - search_row_limit: Number of search results to request per page
+        - fields: (Optional) list of web fields to return, all fields are returned
+            if it is empty
+        - metrics: Boolean, whether to return the count, size, status codes and latency
+            of the requests sent to each endpoint in a _metrics section
+        - metrics_file: (Optional) file to write the request metrics to
+        - metrics_format: "prometheus" or "statsd" format of the metrics file
+        - access_token: (Optional) bearer token to send instead of authenticating with
+            NTLM or the Azure AD app
+
+        Returns:
+        - List: List of Sharepoint sites and subsites if output_type is "console"
+        - String: Path to the output file if output_type is "file"
+        - Dict: The result above and the request metrics if metrics is true
+        """
+        # Everything but the records of each site is done the way sites_list does it
+        return super(TenantInventory, self).run(
+            base_url, domain, output_file, output_file_append, output_type, password,
+            username, token_auth, rsa_private_key, cert_thumbprint, tenent_id, client_id,
+            sites_filter, max_concurrency, host_concurrency, search_row_limit,
+            output_file_format, fields=fields, metrics=metrics, metrics_file=metrics_file,
+            metrics_format=metrics_format, access_token=access_token)
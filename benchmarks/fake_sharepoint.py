@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local stand-in for the SharePoint REST endpoints used by this pack, serving a
+synthetic tenant so crawls can be benchmarked without a live farm.
+
+    python benchmarks/fake_sharepoint.py --sites 100 --depth 2 --branching 3
+"""
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+# Navigation properties SharePoint lists as __deferred in verbose web responses
+WEB_DEFERRED = ['AllProperties', 'AssociatedMemberGroup', 'AssociatedOwnerGroup',
+                'ContentTypes', 'CurrentUser', 'Features', 'Fields', 'Folders', 'Lists',
+                'ParentWeb', 'RoleAssignments', 'RootFolder', 'SiteGroups', 'SiteUsers',
+                'Webs', 'WorkflowAssociations']
+LIST_DEFERRED = ['ContentTypes', 'DefaultView', 'Fields', 'Forms', 'Items',
+                 'ParentWeb', 'RoleAssignments', 'RootFolder', 'Views']
+
+# Fixed dates so delta runs against an unchanged tenant find nothing to fetch
+CREATED = '2020-01-01T00:00:00Z'
+LAST_MODIFIED = '2022-01-01T00:00:00Z'
+
+
+class SyntheticTenant(object):
+    def __init__(self, site_count=10, depth=2, branching=3, doc_libs=2):
+        """Tenant with site collections at /sites/siteN, each holding a tree of subwebs
+        :param site_count: Number of site collections
+        :param depth: Levels of subwebs under each site collection
+        :param branching: Number of subwebs under each web above the last level
+        :param doc_libs: Number of document libraries in every web
+        """
+        self.doc_libs = doc_libs
+        self.webs = {}
+        self.children = {}
+        self.ids = {}
+        self.site_urls = []
+
+        self.add_web('/', 'Root', None)
+        for site in range(site_count):
+            url = '/sites/site{0}'.format(site)
+            self.site_urls.append(url)
+            self.add_tree(url, 'Site {0}'.format(site), None, depth, branching)
+
+    def add_tree(self, url, title, parent, depth, branching):
+        self.add_web(url, title, parent)
+        if depth > 0:
+            for index in range(branching):
+                self.add_tree('{0}/web{1}'.format(url, index),
+                              '{0} web {1}'.format(title, index), url, depth - 1, branching)
+
+    def add_web(self, url, title, parent):
+        web_id = str(uuid.uuid5(uuid.NAMESPACE_URL, url))
+        self.webs[url.lower()] = {
+            'AllowRssFeeds': True,
+            'Configuration': 0,
+            'Created': CREATED,
+            'CustomMasterUrl': url.rstrip('/') + '/_catalogs/masterpage/seattle.master',
+            'Description': 'Synthetic web ' + title,
+            'EnableMinimalDownload': False,
+            'Id': web_id,
+            'Language': 1033,
+            'LastItemModifiedDate': LAST_MODIFIED,
+            'MasterUrl': url.rstrip('/') + '/_catalogs/masterpage/seattle.master',
+            'QuickLaunchEnabled': True,
+            'RecycleBinEnabled': True,
+            'ServerRelativeUrl': url,
+            'SyndicationEnabled': True,
+            'Title': title,
+            'UIVersion': 15,
+            'UIVersionConfigurationEnabled': False,
+            'WebTemplate': 'STS'
+        }
+        self.children[url.lower()] = []
+        self.ids[web_id] = url.lower()
+        if parent is not None:
+            self.children[parent.lower()].append(url.lower())
+
+    def get_web(self, url):
+        return self.webs.get((url.rstrip('/') or '/').lower())
+
+    def get_site_url(self, url):
+        parts = url.rstrip('/').lower().split('/')
+        if len(parts) >= 3 and parts[1] == 'sites':
+            return '/'.join(parts[:3])
+        return '/'
+
+    def get_lists(self, web):
+        return [{'BaseTemplate': 101,
+                 'Created': CREATED,
+                 'Description': '',
+                 'DocumentTemplateUrl': '{0}/Library{1}/Forms/template.dotx'.format(
+                     web['ServerRelativeUrl'].rstrip('/'), index),
+                 'Hidden': False,
+                 'Id': str(uuid.uuid5(uuid.NAMESPACE_URL,
+                                      '{0}#{1}'.format(web['ServerRelativeUrl'], index))),
+                 'ItemCount': 100 * index,
+                 'LastItemModifiedDate': LAST_MODIFIED,
+                 'Title': 'Library {0}'.format(index)}
+                for index in range(self.doc_libs)]
+
+    def count_webs(self, url):
+        return 1 + sum(self.count_webs(child) for child in self.children[url.lower()])
+
+
+class FakeSharePoint(object):
+    def __init__(self, tenant, latency=0.0, processing_time=0.0, throttle_rate=0.0,
+                 throttle_concurrency=0, retry_after=1):
+        """Answers SharePoint REST requests for a synthetic tenant
+        :param latency: Seconds added to every HTTP request, like a network round trip
+        :param processing_time: Seconds added to every REST call, including each call in
+            a $batch request
+        :param throttle_rate: Fraction of REST calls answered with 429
+        :param throttle_concurrency: Requests in flight above which requests are answered
+            with 429, 0 for no limit
+        :param retry_after: Retry-After header of throttled responses in seconds
+        """
+        self.tenant = tenant
+        self.latency = latency
+        self.processing_time = processing_time
+        self.throttle_rate = throttle_rate
+        self.throttle_concurrency = throttle_concurrency
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {'http_requests': 0, 'rest_calls': 0, 'batch_requests': 0,
+                          'throttled': 0, 'bytes_sent': 0, 'max_in_flight': 0}
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] += value
+
+    def begin_request(self):
+        """Mark an HTTP request as started
+        :returns: Boolean, whether the request is over the concurrency limit
+        """
+        with self.lock:
+            self.in_flight += 1
+            self.stats['http_requests'] += 1
+            self.stats['max_in_flight'] = max(self.stats['max_in_flight'], self.in_flight)
+            return bool(self.throttle_concurrency) and \
+                self.in_flight > self.throttle_concurrency
+
+    def end_request(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def is_throttled(self):
+        return self.throttle_rate > 0 and random.random() < self.throttle_rate
+
+    def throttled_response(self, accept):
+        self.count('throttled')
+        status, headers, body = self.error(429, 'Too many requests', accept)
+        headers['Retry-After'] = str(self.retry_after)
+        return status, headers, body
+
+    def handle(self, method, target, headers, body, base_url):
+        """Answer an HTTP request
+        :param target: Path and query of the request
+        :param headers: Dict of request headers with lower case names
+        :param base_url: Scheme and host the client used, for absolute URLs
+        :returns: Tuple of status code, dict of response headers and body string
+        """
+        over_limit = self.begin_request()
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            accept = headers.get('accept', 'application/json;odata=verbose')
+            if over_limit:
+                return self.throttled_response(accept)
+
+            if urlsplit(target).path.lower().endswith('/_api/$batch'):
+                return self.batch(headers.get('content-type', ''), body, base_url)
+            if self.is_throttled():
+                return self.throttled_response(accept)
+            return self.call(method, target, accept, body, base_url)
+        finally:
+            self.end_request()
+
+    def batch(self, content_type, body, base_url):
+        self.count('batch_requests')
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not match:
+            return 400, {'Content-Type': 'text/plain'}, 'Missing boundary'
+
+        boundary = 'batchresponse_' + str(uuid.uuid4())
+        parts = []
+        for part in body.split('--' + match.group(1))[1:-1]:
+            request_line = re.search(r'^(GET|POST) (\S+) HTTP/1\.1', part, re.MULTILINE)
+            accept = re.search(r'^Accept: (.+?)\r?$', part, re.MULTILINE | re.IGNORECASE)
+            accept = accept.group(1) if accept else 'application/json;odata=verbose'
+            if self.is_throttled():
+                status, headers, text = self.throttled_response(accept)
+            else:
+                url = urlsplit(request_line.group(2))
+                target = url.path + ('?' + url.query if url.query else '')
+                status, headers, text = self.call(request_line.group(1), target, accept,
+                                                  '', base_url)
+            header_lines = ''.join('{0}: {1}\r\n'.format(name, value)
+                                   for name, value in headers.items())
+            parts.append('--{0}\r\n'
+                         'Content-Type: application/http\r\n'
+                         'Content-Transfer-Encoding: binary\r\n'
+                         '\r\n'
+                         'HTTP/1.1 {1} {2}\r\n'
+                         '{3}'
+                         '\r\n'
+                         '{4}\r\n'.format(boundary, status, 'OK' if status < 400 else 'Error',
+                                          header_lines, text))
+        parts.append('--{0}--\r\n'.format(boundary))
+
+        return 200, {'Content-Type': 'multipart/mixed; boundary=' + boundary}, ''.join(parts)
+
+    def call(self, method, target, accept, body, base_url):
+        """Answer a single REST call, on its own or from a $batch request
+        """
+        self.count('rest_calls')
+        if self.processing_time:
+            time.sleep(self.processing_time)
+
+        url = urlsplit(target)
+        path = unquote(url.path)
+        query = dict((name, values[0]) for name, values in parse_qs(url.query).items())
+        index = path.lower().find('/_api/')
+        if index < 0:
+            return self.error(404, 'Not found', accept)
+
+        web = self.tenant.get_web(path[:index])
+        if web is None:
+            return self.error(404, 'Web not found', accept)
+
+        api = path[index + len('/_api/'):].lower()
+        select = query.get('$select')
+        web_uri = base_url + web['ServerRelativeUrl'].rstrip('/') + '/_api/web'
+
+        if api == 'search/query' and method == 'GET':
+            return self.search(query, accept, base_url)
+        if api == 'site/rootweb' and method == 'GET':
+            rootweb = self.tenant.get_web(self.tenant.get_site_url(web['ServerRelativeUrl']))
+            return self.entity(self.web_entity(rootweb, select, base_url, accept), accept)
+        if api == 'web/parentweb' and method == 'GET':
+            url = web['ServerRelativeUrl'].rsplit('/', 1)[0]
+            parent = self.tenant.get_web(url) if web['ServerRelativeUrl'] != '/' else None
+            if parent is None:
+                return self.error(404, 'Web has no parent', accept)
+            return self.entity(self.web_entity(parent, select, base_url, accept), accept)
+        if api.startswith('web/getsubwebsfilteredforcurrentuser') and method == 'GET':
+            subwebs = [self.web_entity(self.tenant.webs[child], select, base_url, accept)
+                       for child in self.tenant.children[web['ServerRelativeUrl'].lower()]]
+            return self.collection(subwebs, accept)
+        if api == 'web/lists' and method == 'GET':
+            lists = [self.annotate(self.project(doc_lib, select), 'SP.List',
+                                   "{0}/lists(guid'{1}')".format(web_uri, doc_lib['Id']),
+                                   accept, LIST_DEFERRED if not select else [])
+                     for doc_lib in self.tenant.get_lists(web)]
+            return self.collection(lists, accept)
+        if api == 'web' and method == 'GET':
+            return self.entity(self.web_entity(web, select, base_url, accept), accept)
+        if api == 'site' and method == 'GET':
+            site_id = str(uuid.uuid5(uuid.NAMESPACE_OID, web['ServerRelativeUrl']))
+            token = {'StringValue': '1;1;{0};637000000000000000;1000'.format(site_id)}
+            site = {'Id': site_id, 'CurrentChangeToken': token,
+                    'ServerRelativeUrl': web['ServerRelativeUrl']}
+            return self.entity(self.annotate(self.project(site, select), 'SP.Site',
+                                             base_url + '/_api/site', accept), accept)
+        if api == 'site/getchanges' and method == 'POST':
+            return self.collection([], accept)
+        match = re.match(r"site/openwebbyid\('([^']+)'\)$", api)
+        if match and method == 'POST':
+            url = self.tenant.ids.get(match.group(1).lower())
+            if url is None:
+                return self.error(404, 'Web not found', accept)
+            return self.entity(self.web_entity(self.tenant.webs[url], select, base_url,
+                                               accept), accept)
+        if api == 'contextinfo' and method == 'POST':
+            info = {'FormDigestTimeoutSeconds': 1800,
+                    'FormDigestValue': '0x{0},{1}'.format(uuid.uuid4().hex, CREATED),
+                    'WebFullUrl': base_url + web['ServerRelativeUrl']}
+            return self.entity({'GetContextWebInformation': self.annotate(
+                info, 'SP.ContextWebInformation', None, accept)}, accept)
+
+        return self.error(404, 'Unknown endpoint ' + api, accept)
+
+    def search(self, query, accept, base_url):
+        querytext = query.get('querytext', '').strip("'").replace("''", "'")
+        paths = [path.rstrip('/').lower() for path in re.findall(r'Path:"([^"]+)"', querytext)]
+
+        site_urls = []
+        for url in self.tenant.site_urls:
+            absolute = (base_url + url).lower()
+            if not paths or any(absolute == path or absolute.startswith(path + '/')
+                                for path in paths):
+                site_urls.append(base_url + url)
+
+        start_row = int(query.get('startrow', 0))
+        row_limit = int(query.get('rowlimit', 10))
+        verbose = self.metadata(accept) == 'verbose'
+
+        def collection(items):
+            return {'results': items} if verbose else items
+
+        rows = []
+        for url in site_urls[start_row:start_row + row_limit]:
+            cells = [self.annotate({'Key': key, 'Value': value, 'ValueType': 'Edm.String'},
+                                   'SP.KeyValue', None, accept)
+                     for key, value in [('Rank', '16.0'), ('SiteName', url),
+                                        ('OriginalPath', url)]]
+            rows.append(self.annotate({'Cells': collection(cells)},
+                                      'SP.SimpleDataRow', None, accept))
+
+        table = {'Rows': collection(rows)}
+        relevant = {'RowCount': len(rows), 'Table': table, 'TotalRows': len(site_urls),
+                    'TotalRowsIncludingDuplicates': len(site_urls)}
+        result = {'ElapsedTime': 10,
+                  'PrimaryQueryResult': {'QueryId': str(uuid.uuid4()),
+                                         'RelevantResults': relevant}}
+        result = self.annotate(result, 'Microsoft.Office.Server.Search.REST.SearchResult',
+                               None, accept)
+        if verbose:
+            result = {'query': result}
+        return self.entity(result, accept)
+
+    def web_entity(self, web, select, base_url, accept):
+        uri = base_url + web['ServerRelativeUrl'].rstrip('/') + '/_api/web'
+        data = dict(web, Url=base_url + web['ServerRelativeUrl'])
+        return self.annotate(self.project(data, select), 'SP.Web', uri, accept,
+                             WEB_DEFERRED if not select else [])
+
+    def project(self, data, select):
+        if not select:
+            return dict(data)
+        fields = [field.strip() for field in select.split(',')]
+        return dict((field, data[field]) for field in fields if field in data)
+
+    def metadata(self, accept):
+        match = re.search(r'odata=(\w+)', accept)
+        return match.group(1).lower() if match else 'minimalmetadata'
+
+    def annotate(self, data, type_name, uri, accept, deferred=()):
+        metadata = self.metadata(accept)
+        if metadata == 'verbose':
+            entity = {'__metadata': dict({'type': type_name},
+                                         **({'id': uri, 'uri': uri} if uri else {}))}
+            for name in deferred:
+                entity[name] = {'__deferred': {'uri': '{0}/{1}'.format(uri, name)}}
+            entity.update(data)
+            return entity
+        if metadata == 'minimalmetadata':
+            entity = {'odata.type': type_name}
+            if uri:
+                entity['odata.id'] = uri
+                entity['odata.editLink'] = uri
+            entity.update(data)
+            return entity
+        return data
+
+    def entity(self, data, accept):
+        if self.metadata(accept) == 'verbose':
+            data = {'d': data}
+        return self.json_response(200, data, accept)
+
+    def collection(self, items, accept):
+        metadata = self.metadata(accept)
+        if metadata == 'verbose':
+            data = {'d': {'results': items}}
+        elif metadata == 'minimalmetadata':
+            data = {'odata.metadata': '$metadata', 'value': items}
+        else:
+            data = {'value': items}
+        return self.json_response(200, data, accept)
+
+    def error(self, status, message, accept):
+        error = {'code': '-1, Microsoft.SharePoint.Client.ClientServiceException',
+                 'message': {'lang': 'en-US', 'value': message}}
+        key = 'error' if self.metadata(accept) == 'verbose' else 'odata.error'
+        return self.json_response(status, {key: error}, accept)
+
+    def json_response(self, status, data, accept):
+        content_type = 'application/json;odata={0};charset=utf-8'.format(self.metadata(accept))
+        return status, {'Content-Type': content_type}, json.dumps(data)
+
+
+class FakeSharePointHandler(BaseHTTPRequestHandler):
+    # Keep-alive connections like SharePoint, so pooled sessions behave the same
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.respond('GET')
+
+    def do_POST(self):
+        self.respond('POST')
+
+    def respond(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        sharepoint = self.server.sharepoint
+
+        if self.path == '/_bench/stats':
+            status, headers, text = 200, {'Content-Type': 'application/json'}, \
+                json.dumps(sharepoint.stats)
+        elif self.path == '/_bench/reset':
+            sharepoint.reset()
+            status, headers, text = 204, {}, ''
+        else:
+            headers = dict((name.lower(), value) for name, value in self.headers.items())
+            base_url = 'http://' + self.headers.get('Host', '{0}:{1}'.format(
+                *self.server.server_address[:2]))
+            status, headers, text = sharepoint.handle(method, self.path, headers, body,
+                                                      base_url)
+
+        data = text.encode('utf-8')
+        sharepoint.count('bytes_sent', len(data))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def create_server(sharepoint, host='127.0.0.1', port=0):
+    """Return an HTTP server answering requests with the given FakeSharePoint. Port 0
+    picks a free port, read it from server.server_address.
+    """
+    server = ThreadingHTTPServer((host, port), FakeSharePointHandler)
+    server.daemon_threads = True
+    server.sharepoint = sharepoint
+    return server
+
+
+def add_arguments(parser):
+    """Add the tenant and server options to an argparse parser
+    """
+    parser.add_argument('--sites', type=int, default=10, help='Number of site collections')
+    parser.add_argument('--depth', type=int, default=2, help='Levels of subwebs per site')
+    parser.add_argument('--branching', type=int, default=3, help='Subwebs under each web')
+    parser.add_argument('--doc-libs', type=int, default=2, help='Document libraries per web')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds added to every HTTP request')
+    parser.add_argument('--processing-time', type=float, default=0.0,
+                        help='Seconds added to every REST call, including calls in a batch')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='Fraction of REST calls answered with 429')
+    parser.add_argument('--throttle-concurrency', type=int, default=0,
+                        help='Requests in flight above which requests get 429, 0 for none')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After of throttled responses in seconds')
+
+
+def server_arguments(args):
+    """Return the command line options matching the parsed tenant and server options
+    """
+    return ['--sites', str(args.sites), '--depth', str(args.depth),
+            '--branching', str(args.branching), '--doc-libs', str(args.doc_libs),
+            '--latency', str(args.latency), '--processing-time', str(args.processing_time),
+            '--throttle-rate', str(args.throttle_rate),
+            '--throttle-concurrency', str(args.throttle_concurrency),
+            '--retry-after', str(args.retry_after)]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    tenant = SyntheticTenant(args.sites, args.depth, args.branching, args.doc_libs)
+    sharepoint = FakeSharePoint(tenant, args.latency, args.processing_time,
+                                args.throttle_rate, args.throttle_concurrency,
+                                args.retry_after)
+    server = create_server(sharepoint, args.host, args.port)
+
+    # The benchmark runner reads the URL from the first line of output
+    print('http://{0}:{1}'.format(*server.server_address[:2]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure how long it takes to import each action and select an auth backend.
+
+StackStorm starts a new Python process for every execution of a python-script action,
+so this startup cost is paid on every run. Every measurement runs in a fresh process.
+
+    python benchmarks/import_time.py --repeat 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ACTIONS_DIR = os.path.join(ROOT_DIR, 'actions')
+
+ACTIONS = ['doc_lib_list', 'sites_list', 'subsites_list', 'tenant_inventory', 'find_web',
+           'output_file_convert']
+AUTH_BACKENDS = ['ntlm', 'certificate', 'bearer']
+
+# Libraries that are only needed by some auth backends
+AUTH_MODULES = ['msal', 'requests_ntlm', 'cryptography']
+
+# Runs in the child process, imports the action and loads the libraries of the backend
+MEASURE_CODE = """
+import json, sys, time
+started = time.perf_counter()
+import {action}
+imported = time.perf_counter()
+from lib.auth import get_auth_backend
+backend = get_auth_backend('{backend}')
+if '{backend}' == 'ntlm':
+    import requests_ntlm
+elif '{backend}' == 'certificate':
+    import msal.oauth2cli
+authenticated = time.perf_counter()
+print(json.dumps({{'import_time': imported - started,
+                  'auth_time': authenticated - imported,
+                  'modules': len(sys.modules),
+                  'loaded': [name for name in {auth_modules!r} if name in sys.modules]}}))
+"""
+
+
+def measure(action, backend):
+    """Import the action and the libraries of the auth backend in a new process
+    :returns: Dict with the import and auth times in seconds and the modules loaded
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([ACTIONS_DIR] + [path for path in
+                                        [env.get('PYTHONPATH')] if path])
+    code = MEASURE_CODE.format(action=action, backend=backend, auth_modules=AUTH_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return json.loads(output)
+
+
+def run_benchmark(action, backend, repeat):
+    runs = [measure(action, backend) for _ in range(repeat)]
+    return {'action': action,
+            'backend': backend,
+            'import_time': statistics.median(run['import_time'] for run in runs),
+            'auth_time': statistics.median(run['auth_time'] for run in runs),
+            'total_time': statistics.median(run['import_time'] + run['auth_time']
+                                            for run in runs),
+            'modules': runs[-1]['modules'],
+            'loaded': runs[-1]['loaded']}
+
+
+def print_results(results):
+    columns = [('action', 20, ''), ('backend', 12, ''), ('import_time', 12, '.4f'),
+               ('auth_time', 10, '.4f'), ('total_time', 11, '.4f'), ('modules', 8, '')]
+    print(' '.join('{0:>{1}}'.format(name, width) for name, width, _ in columns) +
+          ' loaded')
+    for result in results:
+        print(' '.join('{0:>{1}{2}}'.format(result[name], width, spec)
+                       for name, width, spec in columns) +
+              ' ' + (','.join(result['loaded']) or '-'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--actions', nargs='+', choices=ACTIONS, default=ACTIONS,
+                        help='Actions to import')
+    parser.add_argument('--backends', nargs='+', choices=AUTH_BACKENDS,
+                        default=AUTH_BACKENDS, help='Auth backends to select')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of processes started for each measurement, the median '
+                             'is shown')
+    parser.add_argument('--json', dest='json_file',
+                        help='Also save the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = [run_benchmark(action, backend, args.repeat)
+               for action in args.actions for backend in args.backends]
+
+    print_results(results)
+    if args.json_file:
+        with open(args.json_file, 'w') as json_file:
+            json.dump({'options': vars(args), 'results': results}, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark the pack's actions against a synthetic SharePoint tenant.
+
+Starts benchmarks/fake_sharepoint.py in its own process, runs each action against it
+and reports the wall time, number of requests and peak memory of every action.
+
+    python benchmarks/run_benchmarks.py --sites 200 --latency 0.02 --repeat 3
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import requests
+
+import fake_sharepoint
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT_DIR, 'actions'))
+
+from doc_lib_list import DocLibList  # noqa: E402
+from sites_list import SitesList  # noqa: E402
+from subsites_list import SubsitesList  # noqa: E402
+from tenant_inventory import TenantInventory  # noqa: E402
+
+BENCHMARKS = ['doc_lib_list', 'doc_lib_list_sites', 'sites_list', 'sites_list_delta',
+              'subsites_list', 'subsites_list_delta', 'tenant_inventory']
+
+# Bearer token sent to the fake server, which doesn't check it
+BENCHMARK_TOKEN = 'benchmark-token'
+
+
+class Benchmark(object):
+    def __init__(self, name, base_url, args, work_dir):
+        """Runs one of the pack's actions against the fake server the way StackStorm
+        would, with token authentication so no NTLM handshake or Azure AD is needed
+        :param name: Name of the benchmark, one of BENCHMARKS
+        :param base_url: URL of the fake server
+        :param args: Parsed command line options
+        :param work_dir: Directory for output and checkpoint files
+        """
+        self.name = name
+        self.base_url = base_url
+        self.args = args
+        self.work_dir = work_dir
+        self.checkpoint_file = os.path.join(work_dir, name + '.checkpoint.json')
+        self.output_file = os.path.join(work_dir, name + '.' + args.output_file_format)
+
+    def create_action(self, action_cls):
+        config = {'batch_size': self.args.batch_size,
+                  'odata_metadata': self.args.odata_metadata,
+                  'adaptive_concurrency': not self.args.no_adaptive_concurrency,
+                  'response_cache': 'none',
+                  'token_cache': 'none'}
+        return action_cls(config)
+
+    def output_args(self):
+        return (self.output_file if self.args.output_type == 'file' else None, False,
+                self.args.output_type)
+
+    def setup(self):
+        """Prepare the benchmark, delta benchmarks save their checkpoint here so the
+        measured runs only check for changes
+        """
+        for path in [self.checkpoint_file, self.output_file]:
+            if os.path.exists(path):
+                os.remove(path)
+        if self.name.endswith('_delta'):
+            self.execute()
+
+    def execute(self):
+        """Run the action once
+        :returns: Number of records returned
+        """
+        output_file, append, output_type = self.output_args()
+        checkpoint_file = self.checkpoint_file if self.name.endswith('_delta') else None
+
+        if self.name == 'doc_lib_list':
+            action = self.create_action(DocLibList)
+            result = action.run('', output_file, append, output_type, None,
+                                self.base_url + '/sites/site0', None, True, None, None, None,
+                                None, self.args.output_file_format,
+                                access_token=BENCHMARK_TOKEN)
+        elif self.name == 'doc_lib_list_sites':
+            action = self.create_action(DocLibList)
+            site_urls = [self.base_url + '/sites/site{0}'.format(index)
+                         for index in range(self.args.sites)]
+            result = action.run('', output_file, append, output_type, None, None, None, True,
+                                None, None, None, None, self.args.output_file_format,
+                                site_urls=site_urls,
+                                max_concurrency=self.args.max_concurrency,
+                                access_token=BENCHMARK_TOKEN)
+        elif self.name.startswith('sites_list'):
+            action = self.create_action(SitesList)
+            result = action.run(self.base_url, '', output_file, append, output_type, None,
+                                None, True, None, None, None, None, [],
+                                self.args.max_concurrency, 0, 500,
+                                self.args.output_file_format, checkpoint_file,
+                                self.args.fields, access_token=BENCHMARK_TOKEN)
+        elif self.name == 'tenant_inventory':
+            action = self.create_action(TenantInventory)
+            result = action.run(self.base_url, '', output_file, append, output_type, None,
+                                None, True, None, None, None, None, [],
+                                self.args.max_concurrency, 0, 500,
+                                self.args.output_file_format, self.args.fields,
+                                access_token=BENCHMARK_TOKEN)
+        else:
+            action = self.create_action(SubsitesList)
+            result = action.run(self.base_url, '', '/sites/site0', output_file, append,
+                                output_type, None, None, True, None, None, None, None,
+                                self.args.max_concurrency, self.args.output_file_format,
+                                checkpoint_file, self.args.fields,
+                                access_token=BENCHMARK_TOKEN)
+        action.close_sessions()
+
+        if output_type == 'file':
+            return count_records(self.output_file, self.args.output_file_format)
+        return len(result)
+
+
+def count_records(path, output_file_format):
+    with open(path) as output_file:
+        if output_file_format == 'ndjson':
+            return sum(1 for line in output_file if line.strip())
+        return len(json.load(output_file))
+
+
+def start_server(args):
+    """Start the fake server in its own process so its memory and CPU use aren't
+    counted against the actions
+    :returns: Tuple of the server process and its URL
+    """
+    command = [sys.executable, os.path.join(os.path.dirname(__file__), 'fake_sharepoint.py')]
+    process = subprocess.Popen(command + fake_sharepoint.server_arguments(args),
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    return process, process.stdout.readline().strip()
+
+
+def server_stats(base_url, reset=False):
+    if reset:
+        requests.post(base_url + '/_bench/reset')
+        return None
+    return requests.get(base_url + '/_bench/stats').json()
+
+
+def run_benchmark(benchmark, repeat):
+    """Run a benchmark repeat times for timing and once more with tracemalloc for memory
+    :returns: Dict of results
+    """
+    times = []
+    for _ in range(repeat):
+        benchmark.setup()
+        server_stats(benchmark.base_url, reset=True)
+        started = time.perf_counter()
+        records = benchmark.execute()
+        times.append(time.perf_counter() - started)
+        stats = server_stats(benchmark.base_url)
+
+    # tracemalloc slows Python down so memory is measured on a separate run
+    benchmark.setup()
+    tracemalloc.start()
+    try:
+        benchmark.execute()
+        peak_memory = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'benchmark': benchmark.name,
+            'records': records,
+            'wall_time': statistics.median(times),
+            'wall_times': times,
+            'http_requests': stats['http_requests'],
+            'rest_calls': stats['rest_calls'],
+            'batch_requests': stats['batch_requests'],
+            'throttled': stats['throttled'],
+            'bytes_received': stats['bytes_sent'],
+            'max_in_flight': stats['max_in_flight'],
+            'peak_memory': peak_memory}
+
+
+def print_results(results):
+    columns = [('benchmark', 20, ''), ('records', 8, ''), ('wall_time', 10, '.3f'),
+               ('http_requests', 14, ''), ('rest_calls', 11, ''), ('throttled', 10, ''),
+               ('bytes_received', 15, ''), ('peak_memory', 12, '')]
+    print(' '.join('{0:>{1}}'.format(name, width) for name, width, _ in columns))
+    for result in results:
+        print(' '.join('{0:>{1}{2}}'.format(result[name], width, spec)
+                       for name, width, spec in columns))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    fake_sharepoint.add_arguments(parser)
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                        help='Benchmarks to run')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='Number of timed runs of each benchmark, the median is shown')
+    parser.add_argument('--max-concurrency', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=50)
+    parser.add_argument('--odata-metadata', default='verbose',
+                        choices=['verbose', 'minimalmetadata', 'nometadata'])
+    parser.add_argument('--no-adaptive-concurrency', action='store_true')
+    parser.add_argument('--fields', nargs='*', default=None,
+                        help='Web fields to select in sites_list and subsites_list')
+    parser.add_argument('--output-type', default='console', choices=['console', 'file'])
+    parser.add_argument('--output-file-format', default='json', choices=['json', 'ndjson'])
+    parser.add_argument('--json', dest='json_file',
+                        help='Also save the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    process, base_url = start_server(args)
+    work_dir = tempfile.mkdtemp(prefix='sharepoint_benchmarks_')
+    try:
+        results = [run_benchmark(Benchmark(name, base_url, args, work_dir), args.repeat)
+                   for name in args.benchmarks]
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(work_dir)
+
+    print_results(results)
+    if args.json_file:
+        with open(args.json_file, 'w') as json_file:
+            json.dump({'options': vars(args), 'results': results}, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
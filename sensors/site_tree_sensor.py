@@ -0,0 +1,187 @@
+#!/usr/bin/python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import sys
+import time
+
+from st2reactor.sensor.base import PollingSensor
+
+# The sensor crawls with the code of the actions
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'actions'))
+
+from lib.base_action import normalize_url  # noqa: E402
+from lib.site_cache import get_site_tree_cache, site_tree_key  # noqa: E402
+from doc_lib_list import DocLibList  # noqa: E402
+from subsites_list import SubsitesList, DEFAULT_MAX_CONCURRENCY  # noqa: E402
+
+# Triggers dispatched for each kind of change found in a refreshed tree
+CHANGE_TRIGGERS = {
+    'webs_added': 'sharepoint.web_added',
+    'webs_removed': 'sharepoint.web_removed',
+    'doc_libs_added': 'sharepoint.doc_lib_added',
+    'doc_libs_removed': 'sharepoint.doc_lib_removed',
+}
+
+
+class SiteTreeSensor(PollingSensor):
+    def __init__(self, sensor_service, config=None, poll_interval=None):
+        """Keeps the subsites and document libraries of the endpoints in the
+        site_tree_sensor pack config warm in the site tree cache, so actions run with
+        use_cache answer without crawling SharePoint. Every poll crawls the endpoints
+        again, or only fetches what changed if a delta checkpoint file is set, and
+        dispatches a trigger for every web and document library that appeared or
+        disappeared since the last poll. Webs the webhook sensor marked dirty only get
+        their document libraries fetched again, and with a refresh_interval the full
+        crawls are only run that often.
+        """
+        super(SiteTreeSensor, self).__init__(sensor_service=sensor_service, config=config,
+                                             poll_interval=poll_interval)
+        self._logger = self.sensor_service.get_logger(name=self.__class__.__name__)
+        self.sensor_config = {}
+        self.fields = []
+        self.cache = None
+
+    def setup(self):
+        self.sensor_config = (self.config or {}).get('site_tree_sensor') or {}
+        self.fields = [field.strip() for field in self.sensor_config.get('fields') or []
+                       if field.strip()]
+        self.cache = get_site_tree_cache(self.config)
+
+    def poll(self):
+        base_url = self.sensor_config.get('base_url')
+        if not base_url:
+            self._logger.debug('No base_url in the site_tree_sensor config, nothing to poll')
+            return
+
+        try:
+            self.refresh_dirty()
+        except Exception:
+            self._logger.exception('Failed to refresh the webs marked dirty')
+
+        # One endpoint failing doesn't keep the others from being refreshed
+        refresh_interval = self.sensor_config.get('refresh_interval', 0)
+        for endpoint in self.sensor_config.get('endpoints') or ['']:
+            refreshed_at = self.cache.get_refreshed_at(site_tree_key(base_url, endpoint,
+                                                                     self.fields))
+            if refreshed_at is not None and refreshed_at > time.time() - refresh_interval:
+                continue
+            try:
+                self.refresh_tree(base_url, endpoint)
+            except Exception:
+                self._logger.exception('Failed to refresh the site tree of %s%s',
+                                       base_url, endpoint)
+
+    def create_action(self, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        """Return a subsites_list action that authenticates with the sensor's credentials
+        :returns: The action and its credential
+        """
+        action = SubsitesList(self.config)
+        # Tokens are cached in the datastore like the actions do
+        action.action_service = self.sensor_service
+        action.fields = self.fields
+        action.pool_size = max(action.pool_size, max_concurrency)
+
+        return action, action.create_auth_cred_from_config(self.sensor_config)
+
+    def refresh_tree(self, base_url, endpoint):
+        """Crawl the subsites of the endpoint, save them to the cache and dispatch the
+        changes since the tree was saved before
+        :returns: The changes returned by SiteTreeCache.save_tree()
+        """
+        max_concurrency = self.sensor_config.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)
+        action, auth = self.create_action(max_concurrency)
+        checkpoint_file = self.sensor_config.get('delta_checkpoint_file')
+        crawled_at = time.time()
+        try:
+            if checkpoint_file:
+                sites = action.iter_sites_delta(base_url, auth, endpoint, checkpoint_file,
+                                                max_concurrency)
+            else:
+                sites = action.iter_sites_list(base_url, auth, endpoint, max_concurrency)
+            records = list(sites)
+        finally:
+            action.close_sessions()
+
+        key = site_tree_key(base_url, endpoint, self.fields)
+        # Everything in the first crawl of a tree is new, which isn't worth a trigger
+        cached = self.cache.get_refreshed_at(key) is not None
+        changes = self.cache.save_tree(key, base_url, endpoint, records, crawled_at)
+        if cached:
+            self.dispatch_changes(base_url, endpoint, changes)
+
+        return changes
+
+    def refresh_dirty(self):
+        """Fetch the document libraries of the webs marked dirty again, update them in
+        every cached tree and dispatch the changes. A web that can't be fetched stays
+        dirty until a later poll or the next crawl of its tree.
+        """
+        marks = self.cache.get_dirty()
+        if not marks:
+            return
+
+        cached_urls = dict((normalize_url(url), url) for url in self.cache.get_site_urls())
+        marked_at = {}
+        for mark in marks:
+            marked_at[mark['url']] = max(mark['marked_at'], marked_at.get(mark['url'], 0))
+        # Marks of webs that are no longer cached have nothing to refresh
+        for url in [url for url in marked_at if url not in cached_urls]:
+            self.cache.clear_dirty(url, marked_at.pop(url))
+        if not marked_at:
+            return
+
+        max_concurrency = self.sensor_config.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)
+        action, auth = self.create_action(max_concurrency)
+        try:
+            doc_lib_list = action.create_shared_action(DocLibList)
+            records = list(doc_lib_list.iter_doc_libs(
+                [cached_urls[url] for url in marked_at], auth, max_concurrency))
+        finally:
+            action.close_sessions()
+
+        for record in records:
+            if 'Error' in record:
+                self._logger.warning('Failed to refresh the document libraries of %s: %s',
+                                     record['SiteUrl'], record['Error'])
+                continue
+            for update in self.cache.update_doc_libs(record['SiteUrl'], record['DocLibs']):
+                self.dispatch_changes(update['base_url'], update['endpoint'],
+                                      update['changes'])
+            self.cache.clear_dirty(record['SiteUrl'],
+                                   marked_at[normalize_url(record['SiteUrl'])])
+
+    def dispatch_changes(self, base_url, endpoint, changes):
+        for change, trigger in CHANGE_TRIGGERS.items():
+            for item in changes[change]:
+                payload = {'base_url': base_url, 'endpoint': endpoint}
+                if change.startswith('webs'):
+                    payload['web'] = item
+                else:
+                    web, doc_lib = item
+                    payload.update({'site_url': web['SiteUrl'], 'web_guid': web['Guid'],
+                                    'doc_lib': doc_lib})
+                self.sensor_service.dispatch(trigger=trigger, payload=payload)
+
+    def cleanup(self):
+        pass
+
+    def add_trigger(self, trigger):
+        pass
+
+    def update_trigger(self, trigger):
+        pass
+
+    def remove_trigger(self, trigger):
+        pass
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import sys
+import threading
+import time
+
+import requests
+from st2reactor.sensor.base import PollingSensor
+
+# The sensor talks to SharePoint with the code of the actions
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'actions'))
+
+from lib.base_action import normalize_url  # noqa: E402
+from lib.json_store import JsonStore, store_key  # noqa: E402
+from lib.site_cache import get_site_tree_cache  # noqa: E402
+from lib.webhooks import (create_subscription, create_webhook_server,  # noqa: E402
+                          delete_subscription, expiration_time, format_expiration,
+                          parse_expiration, update_subscription, DEFAULT_EXPIRATION_DAYS,
+                          DEFAULT_RENEW_DAYS, DEFAULT_SUBSCRIPTIONS_FILE)
+from doc_lib_list import DocLibList, DEFAULT_MAX_CONCURRENCY  # noqa: E402
+
+DEFAULT_LISTEN_HOST = '0.0.0.0'
+DEFAULT_LISTEN_PORT = 8484
+
+
+class WebhookSensor(PollingSensor):
+    def __init__(self, sensor_service, config=None, poll_interval=None):
+        """Subscribes to the webhooks of the document libraries of the watched sites and
+        receives their notifications on a local HTTP endpoint. A notification marks the
+        web of the library dirty in the site tree cache, so the site tree sensor only
+        fetches that web again and actions stop answering from its stale entry, and
+        dispatches a doc_lib_changed trigger. Every poll subscribes to new libraries,
+        renews subscriptions that are about to expire and removes the subscriptions of
+        deleted libraries. Credentials come from the site_tree_sensor pack config.
+        """
+        super(WebhookSensor, self).__init__(sensor_service=sensor_service, config=config,
+                                            poll_interval=poll_interval)
+        self._logger = self.sensor_service.get_logger(name=self.__class__.__name__)
+        self.sensor_config = {}
+        self.credentials = {}
+        self.cache = None
+        self.subscriptions = None
+        self.server = None
+
+    def setup(self):
+        pack_config = self.config or {}
+        self.sensor_config = pack_config.get('webhook_sensor') or {}
+        self.credentials = pack_config.get('site_tree_sensor') or {}
+        self.cache = get_site_tree_cache(self.config)
+        self.subscriptions = JsonStore(self.sensor_config.get(
+            'subscriptions_file', DEFAULT_SUBSCRIPTIONS_FILE))
+
+        self.server = create_webhook_server(
+            self.sensor_config.get('listen_host', DEFAULT_LISTEN_HOST),
+            self.sensor_config.get('listen_port', DEFAULT_LISTEN_PORT),
+            self.handle_notifications)
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+
+    def poll(self):
+        if not self.sensor_config.get('notification_url'):
+            self._logger.debug('No notification_url in the webhook_sensor config, '
+                               'nothing to subscribe to')
+            return
+
+        try:
+            self.sync_subscriptions()
+        except Exception:
+            self._logger.exception('Failed to update the webhook subscriptions')
+
+    def get_site_urls(self):
+        """Return the sites whose document libraries are watched, every web in the site
+        tree cache if no site_urls are configured
+        """
+        return self.sensor_config.get('site_urls') or self.cache.get_site_urls()
+
+    def sync_subscriptions(self):
+        """Subscribe to the document libraries of the watched sites that have no
+        subscription yet, renew the ones expiring within renew_days and remove the
+        subscriptions of libraries and sites that are gone. The subscriptions of a site
+        whose libraries can't be listed are left alone.
+        """
+        action = DocLibList(self.config)
+        # Tokens are cached in the datastore like the actions do
+        action.action_service = self.sensor_service
+        max_concurrency = self.sensor_config.get('max_concurrency', DEFAULT_MAX_CONCURRENCY)
+        action.pool_size = max(action.pool_size, max_concurrency)
+        auth = action.create_auth_cred_from_config(self.credentials)
+
+        site_urls = self.get_site_urls()
+        watched = set(normalize_url(site) for site in site_urls)
+        renew_days = self.sensor_config.get('renew_days', DEFAULT_RENEW_DAYS)
+        renew_before = time.time() + renew_days * 86400
+        entries = self.subscriptions.read_entries()
+        listed = set()
+        active = set()
+        try:
+            for record in action.iter_doc_libs(site_urls, auth, max_concurrency):
+                if 'Error' in record:
+                    self._logger.warning('Failed to list the document libraries of %s: %s',
+                                         record['SiteUrl'], record['Error'])
+                    continue
+                listed.add(normalize_url(record['SiteUrl']))
+                for doc_lib in record['DocLibs']:
+                    key = subscription_key(record['SiteUrl'], doc_lib['Id'])
+                    active.add(key)
+                    entry = entries.get(key)
+                    if entry is None or entry['expires_at'] < renew_before:
+                        self.subscribe(action, auth, key, record['SiteUrl'], doc_lib['Id'],
+                                       entry)
+
+            for key, entry in entries.items():
+                site = normalize_url(entry['site_url'])
+                if key not in active and (site in listed or site not in watched):
+                    self.unsubscribe(action, auth, key, entry)
+        finally:
+            action.close_sessions()
+
+    def subscribe(self, action, auth, key, site_url, list_id, entry=None):
+        """Renew the subscription in entry, or create a new one if there is none or it
+        can't be renewed, and save it to the subscriptions file
+        """
+        expires_at = expiration_time(self.sensor_config.get('expiration_days',
+                                                            DEFAULT_EXPIRATION_DAYS))
+        if entry is not None:
+            try:
+                update_subscription(action, site_url, list_id, entry['subscription_id'],
+                                    format_expiration(expires_at), auth)
+                self.subscriptions.save(key, dict(entry, expires_at=expires_at))
+                return
+            except requests.HTTPError:
+                # SharePoint dropped the subscription, e.g. because it expired
+                self._logger.info('Subscription %s of %s could not be renewed, '
+                                  'subscribing again', entry['subscription_id'], site_url)
+
+        subscription = create_subscription(
+            action, site_url, list_id, self.sensor_config['notification_url'],
+            format_expiration(expires_at), auth, self.sensor_config.get('client_state'))
+        self.subscriptions.save(key, {'site_url': site_url,
+                                      'list_id': list_id,
+                                      'subscription_id': subscription['id'],
+                                      'expires_at': parse_expiration(
+                                          subscription['expirationDateTime'])})
+
+    def unsubscribe(self, action, auth, key, entry):
+        try:
+            delete_subscription(action, entry['site_url'], entry['list_id'],
+                                entry['subscription_id'], auth)
+        except requests.RequestException:
+            self._logger.exception('Failed to remove subscription %s of %s',
+                                   entry['subscription_id'], entry['site_url'])
+            return
+        self.subscriptions.remove(key)
+
+    def handle_notifications(self, notifications):
+        """Mark the web of the library each notification is about dirty and dispatch a
+        doc_lib_changed trigger. Notifications for unknown subscriptions or with the
+        wrong client state are dropped.
+        """
+        try:
+            entries = dict((entry['subscription_id'].lower(), entry)
+                           for entry in self.subscriptions.read_entries().values())
+            client_state = self.sensor_config.get('client_state')
+            for notification in notifications:
+                subscription_id = str(notification.get('subscriptionId', '')).lower()
+                entry = entries.get(subscription_id)
+                if entry is None or (client_state and
+                                     notification.get('clientState') != client_state):
+                    self._logger.warning('Dropped a notification for unknown subscription %s',
+                                         subscription_id)
+                    continue
+
+                self.cache.mark_dirty(entry['site_url'], entry['list_id'])
+                self.sensor_service.dispatch(trigger='sharepoint.doc_lib_changed', payload={
+                    'site_url': entry['site_url'],
+                    'list_id': entry['list_id'],
+                    'subscription_id': entry['subscription_id']})
+        except Exception:
+            self._logger.exception('Failed to handle webhook notifications')
+
+    def cleanup(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def add_trigger(self, trigger):
+        pass
+
+    def update_trigger(self, trigger):
+        pass
+
+    def remove_trigger(self, trigger):
+        pass
+
+
+def subscription_key(site_url, list_id):
+    """Return the key the subscription to a document library is saved under
+    """
+    return store_key('webhook', normalize_url(site_url), list_id.lower())
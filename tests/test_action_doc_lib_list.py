@@ -15,7 +15,15 @@
 
 from test_action_lib_base_action import SharePointBaseActionTestCase
 from doc_lib_list import DocLibList
+from lib.base_action import DOC_LIBS_URI
+from lib.odata_batch import BatchResponse
+from lib.site_cache import SiteTreeCache
+import json
 import mock
+import os
+import requests
+import shutil
+import tempfile
 
 
 class SharepointSitesListTest(SharePointBaseActionTestCase):
@@ -27,7 +35,7 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
         self.assertIsInstance(action, DocLibList)
 
     @mock.patch('lib.base_action.SharepointBaseAction.get_doc_libs')
-    @mock.patch('lib.base_action.SharepointBaseAction.create_ntlm_auth_cred')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
     def test_run(self, mock_auth, mock_get_doc_libs):
         action = self.get_action_instance({})
 
@@ -56,11 +64,12 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
                             test_client_id)
 
         self.assertEqual(result, expected_result)
-        mock_auth.assert_called_with(test_domain, test_user, test_pass)
+        self.assert_auth_params(mock_auth, domain=test_domain, username=test_user,
+                                password=test_pass)
         mock_get_doc_libs.assert_called_with(test_site_url, test_auth)
 
     @mock.patch('lib.base_action.SharepointBaseAction.get_doc_libs')
-    @mock.patch('lib.base_action.SharepointBaseAction.create_token_auth_cred')
+    @mock.patch('lib.auth.CertificateBackend.create_credential')
     def test_run_token(self, mock_auth, mock_get_doc_libs):
         action = self.get_action_instance({})
 
@@ -89,15 +98,13 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
                             test_client_id)
 
         self.assertEqual(result, expected_result)
-        mock_auth.assert_called_with(test_rsa_private_key,
-                                     test_cert_thumbprint,
-                                     test_tenent_id,
-                                     test_client_id,
-                                     test_site_url)
+        self.assert_auth_params(mock_auth, rsa_private_key=test_rsa_private_key,
+                                cert_thumbprint=test_cert_thumbprint, tenent_id=test_tenent_id,
+                                client_id=test_client_id, site_url=test_site_url)
         mock_get_doc_libs.assert_called_with(test_site_url, test_auth)
 
     @mock.patch('lib.base_action.SharepointBaseAction.get_doc_libs')
-    @mock.patch('lib.base_action.SharepointBaseAction.create_ntlm_auth_cred')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
     @mock.patch('lib.base_action.SharepointBaseAction.save_sites_list_to_file')
     def test_run_file(self, mock_save, mock_auth, mock_get_doc_libs):
         action = self.get_action_instance({})
@@ -128,6 +135,120 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
                             test_client_id)
 
         self.assertEqual(result, expected_result)
-        mock_auth.assert_called_with(test_domain, test_user, test_pass)
+        self.assert_auth_params(mock_auth, domain=test_domain, username=test_user,
+                                password=test_pass)
         mock_get_doc_libs.assert_called_with(test_site_url, test_auth)
-        mock_save.assert_called_with(test_doc_libs, test_output_file, test_output_file_append)
+        mock_save.assert_called_with(test_doc_libs, test_output_file, test_output_file_append,
+                                     'json')
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    def test_iter_doc_libs(self, mock_batch_request):
+        action = self.get_action_instance({'batch_size': 2})
+        sites = ['https://a.com/1', 'https://b.com/1', 'https://a.com/2', 'https://a.com/3']
+
+        def batch_request(batch_url, endpoints, auth):
+            return [BatchResponse(url, 403 if url.startswith('https://b.com') else 200, {},
+                                  json.dumps({'d': {'results': [url.split('/_api')[0]]}}))
+                    for url in endpoints]
+
+        mock_batch_request.side_effect = batch_request
+
+        result = list(action.iter_doc_libs(sites, 'auth', 2))
+
+        # A site that fails gets an error without failing the others
+        self.assertEqual([record['SiteUrl'] for record in result], sites)
+        self.assertEqual(result[0], {'SiteUrl': 'https://a.com/1',
+                                     'DocLibs': ['https://a.com/1']})
+        self.assertIn('403', result[1]['Error'])
+        self.assertEqual(result[3]['DocLibs'], ['https://a.com/3'])
+        # Sites are grouped by host within windows of batch_size sites
+        self.assertEqual(sorted(call[0][0] for call in mock_batch_request.call_args_list),
+                         ['https://a.com/1', 'https://a.com/2', 'https://b.com/1'])
+        mock_batch_request.assert_any_call('https://a.com/2',
+                                           ['https://a.com/2' + DOC_LIBS_URI,
+                                            'https://a.com/3' + DOC_LIBS_URI], 'auth')
+
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    def test_get_doc_libs_group_batch_failed(self, mock_batch_request, mock_request):
+        action = self.get_action_instance({})
+        mock_batch_request.side_effect = requests.HTTPError('403 Client Error')
+        response = mock.MagicMock()
+        response.json.return_value = {'d': {'results': ['doc1']}}
+        mock_request.side_effect = [response, requests.ConnectionError('refused')]
+
+        result = action.get_doc_libs_group(['https://a.com/1', 'https://a.com/2'], 'auth')
+
+        # Every site is requested on its own when the $batch request fails
+        self.assertEqual(result, {
+            'https://a.com/1': {'SiteUrl': 'https://a.com/1', 'DocLibs': ['doc1']},
+            'https://a.com/2': {'SiteUrl': 'https://a.com/2', 'Error': 'refused'}})
+        mock_request.assert_called_with('https://a.com/2' + DOC_LIBS_URI, 'auth')
+
+    @mock.patch('doc_lib_list.DocLibList.iter_doc_libs')
+    @mock.patch('lib.auth.CertificateBackend.create_credential')
+    def test_run_site_urls(self, mock_auth, mock_iter_doc_libs):
+        action = self.get_action_instance({})
+        mock_auth.return_value = 'token'
+        mock_iter_doc_libs.return_value = iter(['result1', 'result2'])
+
+        result = action.run('dom', None, False, 'console', None, None, None, True, 'rsa',
+                            'thumb', 'tenant', 'client',
+                            site_urls=['https://a.com/1/', 'https://A.com/1', 'https://a.com/2'],
+                            max_concurrency=4)
+
+        self.assertEqual(result, ['result1', 'result2'])
+        self.assert_auth_params(mock_auth, rsa_private_key='rsa', cert_thumbprint='thumb',
+                                tenent_id='tenant', client_id='client', site_url='https://a.com/1')
+        mock_iter_doc_libs.assert_called_with(['https://a.com/1', 'https://a.com/2'], 'token',
+                                              4)
+
+    @mock.patch('doc_lib_list.DocLibList.get_doc_libs_group')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run_use_cache(self, mock_auth, mock_get_doc_libs_group):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        cache_file = os.path.join(temp_dir, 'site_tree.sqlite')
+        SiteTreeCache(cache_file).save_tree('tree', 'https://a.com', '', [
+            {'Guid': '1/1', 'SiteUrl': 'https://a.com/1', 'DocLibs': ['doc1']}])
+        action = self.get_action_instance({'site_tree_cache_file': cache_file})
+        mock_auth.return_value = 'auth'
+        mock_get_doc_libs_group.return_value = {
+            'https://a.com/1/2': {'SiteUrl': 'https://a.com/1/2', 'DocLibs': ['doc2']}}
+
+        # Cached sites are answered without authenticating
+        result = action.run('dom', None, False, 'console', 'pass', 'https://A.com/1/',
+                            'user', False, None, None, None, None, use_cache=True)
+
+        self.assertEqual(result, ['doc1'])
+        mock_auth.assert_not_called()
+
+        # Only the sites that aren't cached are requested, a cached parent web doesn't
+        # stand in for its subsite
+        result = action.run('dom', None, False, 'console', 'pass', None, 'user', False,
+                            None, None, None, None,
+                            site_urls=['https://a.com/1/2', 'https://a.com/1'],
+                            use_cache=True)
+
+        self.assertEqual(result, [
+            {'SiteUrl': 'https://a.com/1/2', 'DocLibs': ['doc2']},
+            {'SiteUrl': 'https://a.com/1', 'DocLibs': ['doc1']}])
+        mock_get_doc_libs_group.assert_called_once_with(['https://a.com/1/2'], 'auth')
+
+        # Webs marked dirty by the webhook sensor are requested again
+        SiteTreeCache(cache_file).mark_dirty('https://a.com/1', 'list1')
+
+        with mock.patch.object(action, 'get_doc_libs') as mock_get_doc_libs:
+            mock_get_doc_libs.return_value = ['doc3']
+            result = action.run('dom', None, False, 'console', 'pass', 'https://a.com/1',
+                                'user', False, None, None, None, None, use_cache=True)
+
+        self.assertEqual(result, ['doc3'])
+        mock_get_doc_libs.assert_called_with('https://a.com/1', 'auth')
+
+    def test_run_no_site(self):
+        action = self.get_action_instance({})
+
+        with self.assertRaises(ValueError):
+            action.run('dom', None, False, 'console', 'pass', None, 'user', False, None,
+                       None, None, None)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from test_action_lib_base_action import SharePointBaseActionTestCase
+from find_web import FindWeb
+from lib.site_cache import SiteTreeCache
+import os
+import shutil
+import tempfile
+
+
+class SharepointFindWebTest(SharePointBaseActionTestCase):
+    __test__ = True
+    action_cls = FindWeb
+
+    def setUp(self):
+        super(SharepointFindWebTest, self).setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.cache_file = os.path.join(temp_dir, 'site_tree.sqlite')
+
+    def test_init(self):
+        action = self.get_action_instance({})
+        self.assertIsInstance(action, FindWeb)
+
+    def test_run(self):
+        web = {'Guid': '1/a', 'SiteUrl': 'https://test.com/a', 'DocLibs': []}
+        SiteTreeCache(self.cache_file).save_tree('tree', 'https://test.com', '', [web])
+        action = self.get_action_instance({'site_tree_cache_file': self.cache_file})
+
+        result = action.run('https://test.com/a/Shared%20Documents/file.docx')
+
+        self.assertEqual(result, web)
+
+    def test_run_not_cached(self):
+        action = self.get_action_instance({'site_tree_cache_file': self.cache_file})
+
+        with self.assertRaises(ValueError):
+            action.run('https://test.com/a')
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import subprocess
+import sys
+import unittest
+
+from lib.auth import (BearerBackend, CertificateBackend, NtlmBackend, get_auth_backend,
+                      select_auth_backend)
+
+
+class AuthTestCase(unittest.TestCase):
+    def test_get_auth_backend(self):
+        self.assertIsInstance(get_auth_backend('ntlm'), NtlmBackend)
+        self.assertIsInstance(get_auth_backend('certificate'), CertificateBackend)
+        self.assertIsInstance(get_auth_backend('bearer'), BearerBackend)
+        self.assertFalse(get_auth_backend('ntlm').bearer)
+        self.assertTrue(get_auth_backend('certificate').bearer)
+
+        with self.assertRaises(ValueError):
+            get_auth_backend('basic')
+
+    def test_select_auth_backend(self):
+        self.assertIsInstance(select_auth_backend({'access_token': 'token', 'token_auth': True}),
+                              BearerBackend)
+        self.assertIsInstance(select_auth_backend({'access_token': None, 'token_auth': True}),
+                              CertificateBackend)
+        self.assertIsInstance(select_auth_backend({'access_token': None, 'token_auth': False}),
+                              NtlmBackend)
+
+    @mock.patch('requests_ntlm.HttpNtlmAuth')
+    def test_ntlm(self, mock_auth):
+        result = NtlmBackend().create_credential(None, {'domain': 'dom',
+                                                        'username': 'user',
+                                                        'password': 'pass'})
+
+        self.assertEqual(result, mock_auth.return_value)
+        mock_auth.assert_called_with('dom\\user', 'pass')
+
+    @mock.patch('msal.oauth2cli.JwtAssertionCreator')
+    def test_certificate(self, mock_creator):
+        mock_creator.return_value.create_normal_assertion.return_value = 'assertion'
+
+        result = CertificateBackend().create_assertion('rsa', 'thumb', 'https://token', 'client')
+
+        self.assertEqual(result, 'assertion')
+        mock_creator.assert_called_with('rsa', algorithm='RS256', sha1_thumbprint='thumb',
+                                        headers={})
+        mock_creator.return_value.create_normal_assertion.assert_called_with(
+            audience='https://token', issuer='client')
+
+    def test_bearer(self):
+        result = BearerBackend().create_credential(None, {'access_token': 'token'})
+
+        self.assertEqual(result, 'token')
+
+    def test_lazy_imports(self):
+        # Actions run in a fresh process, so check what importing one loads there
+        code = ('import json, sys; import sites_list; '
+                'print(json.dumps([name in sys.modules for name in '
+                '["msal", "requests_ntlm"]]))')
+        output = subprocess.check_output([sys.executable, '-c', code])
+
+        self.assertEqual(json.loads(output), [False, False])
@@ -13,10 +13,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
 import mock
+import os
+import requests
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from st2tests.base import BaseActionTestCase
-from lib.base_action import SharepointBaseAction
+from lib.base_action import SharepointBaseAction, normalize_url
+from lib.odata_batch import BatchRequestError, BatchResponse
+from lib.response_cache import ResponseCache
+from lib.token_cache import DatastoreTokenCache, FileTokenCache
 from st2common.runners.base_action import Action
 # Using this to run tests. Otherwise get an error for no run method.
 from sites_list import SitesList
@@ -26,11 +37,21 @@ class SharePointBaseActionTestCase(BaseActionTestCase):
     __test__ = True
     action_cls = SitesList
 
+    def assert_auth_params(self, mock_create_credential, **params):
+        """Check the auth parameters the last credential was created with
+        """
+        auth_params = mock_create_credential.call_args[0][1]
+        self.assertEqual(dict((name, auth_params[name]) for name in params), params)
+
     def test_init(self):
         action = self.get_action_instance({})
         self.assertIsInstance(action, SharepointBaseAction)
         self.assertIsInstance(action, Action)
 
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url(' https://Test.com/sites/My%20Site/ '),
+                         'https://test.com/sites/my site')
+
     @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
     def test_get_doc_libs(self, mock_request):
         action = self.get_action_instance({})
@@ -43,7 +64,7 @@ class SharePointBaseActionTestCase(BaseActionTestCase):
         endpoint_uri = '/_api/web/lists?$filter=BaseTemplate eq ' \
                        '101&$select=Title,Id,DocumentTemplateUrl'
 
-        expected_result = 'doc_lib'
+        expected_result = ['doc_lib']
 
         rest_result = {
             'd': {
@@ -59,16 +80,279 @@ class SharePointBaseActionTestCase(BaseActionTestCase):
         self.assertEqual(result, expected_result)
         mock_request.assert_called_with(test_base_url + endpoint_uri, test_auth)
 
-    @mock.patch('lib.base_action.requests.request')
-    def test_rest_request(self, mock_request):
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_get_doc_libs_error(self, mock_request):
+        action = self.get_action_instance({})
+
+        mock_request.return_value = mock.MagicMock()
+        mock_request.return_value.raise_for_status.side_effect = \
+            requests.exceptions.HTTPError('403 Client Error')
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            action.get_doc_libs('https://test.com/api', 'user')
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    def test_get_doc_libs_batch(self, mock_batch_request):
+        action = self.get_action_instance({})
+
+        test_batch_url = 'https://test.com'
+        test_sites = ['https://test.com/site1', 'https://test.com/site2']
+        test_auth = 'user'
+        endpoint_uri = '/_api/web/lists?$filter=BaseTemplate eq ' \
+                       '101&$select=Title,Id,DocumentTemplateUrl'
+
+        response1 = mock.MagicMock()
+        response1.json.return_value = {'d': {'results': ['doc1']}}
+        response2 = mock.MagicMock()
+        response2.json.return_value = {'d': {'results': ['doc2']}}
+        mock_batch_request.return_value = [response1, response2]
+
+        result = action.get_doc_libs_batch(test_batch_url, test_sites, test_auth)
+
+        self.assertEqual(result, [['doc1'], ['doc2']])
+        mock_batch_request.assert_called_with(test_batch_url,
+                                              [test_sites[0] + endpoint_uri,
+                                               test_sites[1] + endpoint_uri],
+                                              test_auth)
+        response1.raise_for_status.assert_called_with()
+
+    @mock.patch('lib.base_action.SharepointBaseAction.get_form_digest')
+    @mock.patch('lib.base_action.uuid.uuid4')
+    @mock.patch('lib.base_action.parse_batch_response')
+    @mock.patch('lib.base_action.build_batch_body')
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_batch_request(self, mock_request, mock_build, mock_parse, mock_uuid,
+                           mock_get_digest):
+        action = self.get_action_instance({'batch_size': 2})
+        mock_get_digest.return_value = 'digest'
+
+        test_endpoints = ['url1', 'url2', 'url3']
+        test_auth = 'user'
+
+        mock_uuid.return_value = 'abc'
+        mock_build.return_value = 'body'
+        mock_request.return_value.headers = {'content-type': 'multipart/mixed; boundary=x'}
+        mock_request.return_value.text = 'text'
+        test_responses = [BatchResponse(url, 200, {}, '') for url in test_endpoints]
+        mock_parse.side_effect = [test_responses[:2], test_responses[2:]]
+
+        result = action.batch_request('https://test.com/', test_endpoints, test_auth)
+
+        self.assertEqual(result, test_responses)
+        # The endpoints are split into batches of batch_size
+        mock_build.assert_has_calls([mock.call(['url1', 'url2'], 'batch_abc',
+                                               accept='application/json;odata=verbose',
+                                               headers=[{}, {}]),
+                                     mock.call(['url3'], 'batch_abc',
+                                               accept='application/json;odata=verbose',
+                                               headers=[{}])])
+        mock_parse.assert_has_calls([
+            mock.call(['url1', 'url2'], 'multipart/mixed; boundary=x', 'text'),
+            mock.call(['url3'], 'multipart/mixed; boundary=x', 'text')])
+        mock_request.assert_called_with(
+            'https://test.com/_api/$batch', test_auth, 'POST', 'body',
+            headers={'content-type': 'multipart/mixed; boundary=batch_abc',
+                     'X-RequestDigest': 'digest'})
+        mock_get_digest.assert_called_with('https://test.com/', test_auth)
+        self.assertEqual(mock_request.call_count, 2)
+
+    @mock.patch('lib.base_action.SharepointBaseAction.send_batch')
+    def test_batch_request_memo(self, mock_send_batch):
+        action = self.get_action_instance({'batch_size': 4})
+        mock_send_batch.side_effect = lambda batch_url, urls, headers, auth: \
+            [BatchResponse(url, 200, {}, '') for url in urls]
+
+        first = action.batch_request('https://test.com', ['https://test.com/a/',
+                                                          'https://test.com/B'], 'user')
+        # URLs that normalize to one already requested in this run share its response
+        second = action.batch_request('https://test.com', ['https://test.com/b',
+                                                           'https://test.com/c',
+                                                           'https://test.com/c/'], 'user')
+
+        self.assertEqual(second[0], first[1])
+        self.assertIs(second[1], second[2])
+        mock_send_batch.assert_called_with('https://test.com', ['https://test.com/c'], [{}],
+                                           'user')
+        self.assertEqual(mock_send_batch.call_count, 2)
+
+        # Requests that must be fresh skip the memo
+        action.batch_request('https://test.com', ['https://test.com/a'], 'user',
+                             use_cache=False)
+        mock_send_batch.assert_called_with('https://test.com', ['https://test.com/a'], [{}],
+                                           'user')
+
+    @mock.patch('lib.base_action.SharepointBaseAction.send_batch')
+    def test_batch_request_memo_error(self, mock_send_batch):
+        action = self.get_action_instance({'batch_size': 4})
+        mock_send_batch.side_effect = [requests.ConnectionError(),
+                                       [BatchResponse('https://test.com/a', 200, {}, '')]]
+
+        with self.assertRaises(requests.ConnectionError):
+            action.batch_request('https://test.com', ['https://test.com/a'], 'user')
+
+        # The failed request is sent again
+        result = action.batch_request('https://test.com', ['https://test.com/a'], 'user')
+        self.assertEqual(result[0].status_code, 200)
+
+    @mock.patch('lib.base_action.SharepointBaseAction.get_session')
+    def test_rest_request_memo(self, mock_get_session):
+        action = self.get_action_instance({})
+        action.token_auth = False
+        mock_session = mock_get_session.return_value
+        mock_session.request.return_value = mock.MagicMock(status_code=200, content=b'')
+
+        first = action.rest_request('https://test.com/_api/web', 'user')
+        second = action.rest_request('https://test.com/_api/Web/', 'user')
+
+        self.assertIs(first, second)
+        self.assertEqual(mock_session.request.call_count, 1)
+
+        # Uncached GETs and other methods are always sent
+        action.rest_request('https://test.com/_api/web', 'user', use_cache=False)
+        action.rest_request('https://test.com/_api/web', 'user', 'POST')
+        self.assertEqual(mock_session.request.call_count, 3)
+
+    @mock.patch('lib.base_action.time.time')
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_get_form_digest(self, mock_request, mock_time):
+        action = self.get_action_instance({})
+        action.token_auth = False
+        mock_time.return_value = 1000
+
+        mock_request.return_value.json.return_value = {
+            'd': {'GetContextWebInformation': {'FormDigestValue': 'digest',
+                                               'FormDigestTimeoutSeconds': 1800}}}
+
+        self.assertEqual(action.get_form_digest('https://test.com/', 'user'), 'digest')
+        # The digest is reused until it is about to time out
+        self.assertEqual(action.get_form_digest('https://test.com', 'user'), 'digest')
+        self.assertEqual(mock_request.call_count, 1)
+        mock_request.assert_called_with('https://test.com/_api/contextinfo', 'user', 'POST')
+
+        mock_time.return_value = 1000 + 1800 - 60
+        action.get_form_digest('https://test.com', 'user')
+        self.assertEqual(mock_request.call_count, 2)
+
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_get_form_digest_token(self, mock_request):
+        action = self.get_action_instance({})
+        action.token_auth = True
+
+        self.assertIsNone(action.get_form_digest('https://test.com', 'token'))
+        mock_request.assert_not_called()
+
+    @mock.patch('lib.base_action.SharepointBaseAction.get_form_digest')
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_post_request(self, mock_request, mock_get_digest):
+        action = self.get_action_instance({})
+        mock_get_digest.return_value = 'digest'
+
+        result = action.post_request('https://test.com', 'https://test.com/_api/method',
+                                     'user', {'query': 1})
+
+        self.assertEqual(result, mock_request.return_value)
+        mock_get_digest.assert_called_with('https://test.com', 'user')
+        mock_request.assert_called_with('https://test.com/_api/method', 'user', 'POST',
+                                        '{"query": 1}',
+                                        headers={'X-RequestDigest': 'digest'})
+
+        # Token auth doesn't need a digest
+        mock_get_digest.return_value = None
+        action.post_request('https://test.com', 'https://test.com/_api/method', 'token')
+
+        mock_request.assert_called_with('https://test.com/_api/method', 'token', 'POST',
+                                        None, headers={})
+
+        # Extra headers are sent along with the digest
+        mock_get_digest.return_value = 'digest'
+        action.post_request('https://test.com', 'https://test.com/_api/method', 'user',
+                            headers={'X-HTTP-Method': 'DELETE'})
+
+        mock_request.assert_called_with('https://test.com/_api/method', 'user', 'POST',
+                                        None, headers={'X-HTTP-Method': 'DELETE',
+                                                       'X-RequestDigest': 'digest'})
+
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_batch_request_disabled(self, mock_request):
+        action = self.get_action_instance({'batch_size': 1})
+
+        mock_request.side_effect = ['res1', 'res2']
+
+        result = action.batch_request('https://test.com', ['url1', 'url2'], 'user')
+
+        self.assertEqual(result, ['res1', 'res2'])
+        mock_request.assert_has_calls([mock.call('url1', 'user', use_cache=True),
+                                       mock.call('url2', 'user', use_cache=True)])
+
+    def test_map_concurrent(self):
+        action = self.get_action_instance({})
+
+        def func(value, delay):
+            time.sleep(delay)
+            return value * 2
+
+        result = action.map_concurrent(func, [(1, 0.05), (2, 0.0), (3, 0.01)], 3)
+
+        # Results are returned in the order of the arguments
+        self.assertEqual(result, [2, 4, 6])
+
+    def test_map_concurrent_host_limit(self):
+        action = self.get_action_instance({})
+        lock = threading.Lock()
+        running = {'a': 0, 'b': 0}
+        peak = {'a': 0, 'b': 0}
+
+        def func(host):
+            with lock:
+                running[host] += 1
+                peak[host] = max(peak[host], running[host])
+            time.sleep(0.02)
+            with lock:
+                running[host] -= 1
+            return host
+
+        hosts = ['a', 'a', 'a', 'b', 'b', 'b']
+        result = action.map_concurrent(func, [(host,) for host in hosts], 6, hosts, 1)
+
+        self.assertEqual(result, hosts)
+        self.assertEqual(peak, {'a': 1, 'b': 1})
+
+    def test_imap_concurrent_executor(self):
+        action = self.get_action_instance({})
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            result = list(action.imap_concurrent(lambda value: value * 2, [(1,), (2,), (3,)],
+                                                 2, executor=executor))
+
+            # The given executor is left running for the next stage
+            self.assertEqual(result, [2, 4, 6])
+            self.assertEqual(executor.submit(lambda: 'next').result(), 'next')
+
+    def test_imap_site_groups(self):
+        action = self.get_action_instance({})
+        groups = []
+
+        def func(sites):
+            groups.append(sites)
+            return dict((site, site.upper()) for site in sites)
+
+        sites = ['https://a.com/1', 'https://b.com/1', 'https://A.com/2', 'https://a.com/3']
+        result = list(action.imap_site_groups(func, sites, 3, 2))
+
+        # Each window is split by host and the values come back in the order of the sites
+        self.assertEqual(result, [site.upper() for site in sites])
+        self.assertEqual(sorted(groups), [['https://a.com/1', 'https://A.com/2'],
+                                          ['https://a.com/3'], ['https://b.com/1']])
+
+    @mock.patch('lib.base_action.SharepointBaseAction.get_session')
+    def test_rest_request(self, mock_get_session):
         action = self.get_action_instance({})
         action.token_auth = False
 
         test_headers = {
             'accept': 'application/json;odata=verbose',
             'content-type': 'application/json;odata=verbose',
-            'odata': 'verbose',
-            'X-RequestForceAuthentication': 'true'
+            'odata': 'verbose'
         }
 
         test_endpoint = 'https://test.com/api/endpoint'
@@ -77,37 +361,346 @@ class SharePointBaseActionTestCase(BaseActionTestCase):
         test_method = 'POST'
         test_verify = False
 
-        expected_result = 'response'
+        expected_result = mock.MagicMock(status_code=200)
 
-        mock_request.return_value = expected_result
+        mock_session = mock.MagicMock()
+        mock_session.request.return_value = expected_result
+        mock_get_session.return_value = mock_session
 
         result = action.rest_request(test_endpoint, test_auth, test_method,
                                      test_payload, test_verify)
 
         self.assertEqual(result, expected_result)
-        mock_request.assert_called_with(test_method, test_endpoint,
-                                        auth=test_auth, data=test_payload,
-                                        headers=test_headers, verify=test_verify)
+        mock_get_session.assert_called_with(test_endpoint, test_auth)
+        mock_session.request.assert_called_with(test_method, test_endpoint,
+                                                data=test_payload, headers=test_headers,
+                                                verify=test_verify)
+
+    @mock.patch('lib.base_action.SharepointBaseAction.get_session')
+    def test_rest_request_odata_metadata(self, mock_get_session):
+        action = self.get_action_instance({'odata_metadata': 'nometadata'})
+        action.token_auth = False
+
+        action.rest_request('https://test.com/api/endpoint', 'user')
+
+        headers = mock_get_session.return_value.request.call_args[1]['headers']
+        self.assertEqual(headers['accept'], 'application/json;odata=nometadata')
+        # POST bodies keep their types in __metadata so they are still sent verbose
+        self.assertEqual(headers['content-type'], 'application/json;odata=verbose')
+
+    def test_select_fields(self):
+        action = self.get_action_instance({})
+
+        self.assertEqual(action.select_fields('/_api/web'), '/_api/web')
+
+        action.fields = ['Title', 'Id']
+        self.assertEqual(action.select_fields('/_api/web'),
+                         '/_api/web?$select=Id,ServerRelativeUrl,Title')
+        self.assertEqual(action.select_fields('/_api/web?$top=1', ['Url']),
+                         '/_api/web?$top=1&$select=Url,Title,Id')
+
+    def test_parse_json(self):
+        action = self.get_action_instance({})
+        response = mock.MagicMock()
+        response.json.return_value = {'d': {'__metadata': {'type': 'SP.Web'}, 'Id': '1'}}
+
+        self.assertEqual(action.parse_json(response), {'Id': '1'})
+
+    @mock.patch('lib.base_action.SharepointBaseAction.get_session')
+    def test_rest_request_token_force_auth(self, mock_get_session):
+        action = self.get_action_instance({'force_authentication': True})
+        action.token_auth = True
+
+        test_headers = {
+            'accept': 'application/json;odata=verbose',
+            'content-type': 'application/json;odata=verbose',
+            'odata': 'verbose',
+            'X-RequestForceAuthentication': 'true',
+            'Authorization': 'Bearer token'
+        }
+
+        test_endpoint = 'https://test.com/api/endpoint'
+
+        mock_session = mock.MagicMock()
+        mock_get_session.return_value = mock_session
+
+        action.rest_request(test_endpoint, 'token')
+
+        mock_session.request.assert_called_with('GET', test_endpoint,
+                                                data=None, headers=test_headers,
+                                                verify=False)
+
+    def test_get_response_cache(self):
+        self.assertIsNone(self.get_action_instance({}).get_response_cache())
+
+        action = self.get_action_instance({'response_cache': 'sqlite',
+                                           'response_cache_file': '/tmp/responses.sqlite'})
+        cache = action.get_response_cache()
+
+        # One cache is kept for the run and shared with the actions it creates
+        self.assertIsInstance(cache, ResponseCache)
+        self.assertIs(action.get_response_cache(), cache)
+        self.assertIs(action.create_shared_action(SharepointBaseAction).get_response_cache(),
+                      cache)
+
+    @mock.patch('lib.response_cache.time.time')
+    @mock.patch('lib.base_action.SharepointBaseAction.get_session')
+    def test_rest_request_cache(self, mock_get_session, mock_time):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        action = self.get_action_instance({
+            'response_cache': 'sqlite',
+            'response_cache_file': os.path.join(temp_dir, 'responses.sqlite'),
+            'response_cache_ttl': 60,
+            # Every call stands for a new run
+            'memo_size': 0})
+        action.token_auth = False
+        mock_time.return_value = 1000
+
+        test_endpoint = 'https://test.com/_api/web'
+        response = mock.MagicMock(status_code=200, headers={'ETag': '"1"'},
+                                  content=b'{"d": {"Title": "web"}}')
+        mock_session = mock_get_session.return_value
+        mock_session.request.return_value = response
+
+        self.assertIs(action.rest_request(test_endpoint, 'user'), response)
+
+        # Fresh responses skip the network
+        result = action.rest_request(test_endpoint, 'user')
+
+        self.assertEqual(result.json(), {'d': {'Title': 'web'}})
+        self.assertEqual(mock_session.request.call_count, 1)
+
+        # Expired responses are revalidated and a 304 returns the cached response
+        mock_time.return_value = 1060
+        mock_session.request.return_value = mock.MagicMock(status_code=304)
+
+        result = action.rest_request(test_endpoint, 'user')
+
+        self.assertEqual(result.json(), {'d': {'Title': 'web'}})
+        self.assertEqual(mock_session.request.call_args[1]['headers']['If-None-Match'],
+                         '"1"')
+
+        # Requests can skip the cache and other methods are never cached
+        action.rest_request(test_endpoint, 'user', use_cache=False)
+        action.rest_request(test_endpoint, 'user', 'POST')
+        action.rest_request(test_endpoint, 'other')
+
+        self.assertEqual(mock_session.request.call_count, 5)
+        self.assertNotIn('If-None-Match', mock_session.request.call_args[1]['headers'])
+
+    @mock.patch('lib.base_action.SharepointBaseAction.get_form_digest')
+    @mock.patch('lib.base_action.parse_batch_response')
+    @mock.patch('lib.base_action.build_batch_body')
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_batch_request_cache(self, mock_request, mock_build, mock_parse,
+                                 mock_get_digest):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        action = self.get_action_instance({
+            'batch_size': 2,
+            'response_cache': 'sqlite',
+            'response_cache_file': os.path.join(temp_dir, 'responses.sqlite'),
+            'response_cache_ttl': 0,
+            # Every call stands for a new run
+            'memo_size': 0})
+        action.token_auth = False
+        mock_get_digest.return_value = None
+        mock_request.return_value.headers = {'content-type': 'multipart/mixed; boundary=x'}
+
+        mock_parse.return_value = [BatchResponse('url1', 200, {'etag': '"1"'}, '{"d": 1}'),
+                                   BatchResponse('url2', 404, {}, 'error')]
+
+        result = action.batch_request('https://test.com', ['url1', 'url2'], 'user')
+
+        self.assertEqual([response.status_code for response in result], [200, 404])
+
+        # The cached response has expired so it is sent with its ETag
+        mock_parse.return_value = [BatchResponse('url1', 304, {}, ''),
+                                   BatchResponse('url2', 404, {}, 'error')]
+
+        result = action.batch_request('https://test.com', ['url1', 'url2'], 'user')
+
+        self.assertEqual(result[0].status_code, 200)
+        self.assertEqual(result[0].json(), {'d': 1})
+        self.assertEqual(result[1].status_code, 404)
+        mock_build.assert_called_with(['url1', 'url2'], mock.ANY, accept=mock.ANY,
+                                      headers=[{'If-None-Match': '"1"'}, {}])
+
+        # Fresh responses aren't requested at all
+        action.get_response_cache().ttl = 60
+        mock_parse.return_value = [BatchResponse('url1', 200, {}, '{"d": 2}'),
+                                   BatchResponse('url2', 404, {}, 'error')]
+        action.batch_request('https://test.com', ['url1', 'url2'], 'user')
+        mock_parse.return_value = [BatchResponse('url2', 404, {}, 'error')]
+
+        result = action.batch_request('https://test.com', ['url1', 'url2'], 'user')
+
+        self.assertEqual(result[0].json(), {'d': 2})
+        mock_build.assert_called_with(['url2'], mock.ANY, accept=mock.ANY, headers=[{}])
 
-    @mock.patch('lib.base_action.HttpNtlmAuth')
-    def test_create_ntlm_auth_cred(self, mock_auth):
+    @mock.patch('lib.base_action.time.sleep')
+    def test_send_request_retries(self, mock_sleep):
+        action = self.get_action_instance({'pool_size': 4})
+        mock_session = mock.MagicMock()
+
+        throttled = mock.MagicMock(status_code=429, headers={'retry-after': '3'})
+        ok = mock.MagicMock(status_code=200)
+        mock_session.request.side_effect = [throttled, requests.ConnectionError(), ok]
+
+        result = action.send_request(mock_session, 'GET', 'https://test.com/_api/web',
+                                     verify=False)
+
+        self.assertIs(result, ok)
+        self.assertEqual(mock_session.request.call_count, 3)
+        mock_session.request.assert_called_with('GET', 'https://test.com/_api/web',
+                                                verify=False)
+        # The Retry-After header is honored and the throttled request cut the limit
+        self.assertEqual(mock_sleep.call_args_list[0], mock.call(3))
+        self.assertLess(action.get_limiter().limit, 4)
+        self.assertEqual(action.get_limiter().in_flight, 0)
+
+    @mock.patch('lib.base_action.time.sleep')
+    def test_send_request_metrics(self, mock_sleep):
         action = self.get_action_instance({})
+        mock_session = mock.MagicMock()
+        throttled = mock.MagicMock(status_code=429, headers={}, content=b'')
+        ok = mock.MagicMock(status_code=200, content=b'{"d": {}}')
+        mock_session.request.side_effect = [throttled, requests.ConnectionError(), ok]
+
+        action.send_request(mock_session, 'GET',
+                            'https://test.com/_api/web/getsubwebsfilteredforcurrentuser()')
+
+        subwebs = action.metrics.as_dict()['endpoints']['subwebs']
+        self.assertEqual(subwebs['requests'], 3)
+        self.assertEqual(subwebs['bytes'], 9)
+        self.assertEqual(subwebs['status_codes'], {'429': 1, 'error': 1, '200': 1})
+        self.assertEqual(subwebs['latency_count'], 3)
+
+    def test_add_metrics(self):
+        action = self.get_action_instance({})
+        action.metrics.record('https://test.com/_api/site/rootweb', 200, 10, 0.1)
+
+        self.assertEqual(action.add_metrics(['site'], 'sites_list'), ['site'])
+
+        result = action.add_metrics(['site'], 'sites_list', True)
+        self.assertEqual(result['result'], ['site'])
+        self.assertEqual(result['_metrics']['total']['requests'], 1)
+
+        temp_dir = tempfile.mkdtemp()
+        try:
+            metrics_file = os.path.join(temp_dir, 'sharepoint.prom')
+            action.add_metrics(['site'], 'sites_list', metrics_file=metrics_file)
+            with open(metrics_file) as prom_file:
+                self.assertIn('sharepoint_requests_total{action="sites_list",'
+                              'endpoint="rootweb"} 1', prom_file.read())
+        finally:
+            shutil.rmtree(temp_dir)
 
-        test_domain = 'dom'
-        test_pass = 'pass'
-        test_user = 'user'
-        test_auth = 'auth'
+    @mock.patch('lib.base_action.time.sleep')
+    def test_send_request_gives_up(self, mock_sleep):
+        action = self.get_action_instance({'max_retries': 2,
+                                           'adaptive_concurrency': False})
+        mock_session = mock.MagicMock()
 
-        mock_auth.return_value = test_auth
+        throttled = mock.MagicMock(status_code=503, headers={})
+        throttled.raise_for_status.side_effect = requests.HTTPError('503')
+        mock_session.request.return_value = throttled
 
-        result = action.create_ntlm_auth_cred(test_domain, test_user, test_pass)
+        with self.assertRaises(requests.HTTPError):
+            action.send_request(mock_session, 'GET', 'https://test.com/_api/web')
 
-        self.assertEqual(result, test_auth)
-        mock_auth.assert_called_with(test_domain + '\\' + test_user, test_pass)
+        self.assertEqual(mock_session.request.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+        self.assertIsNone(action.get_limiter())
 
-    @mock.patch('lib.base_action.JwtAssertionCreator')
-    @mock.patch('lib.base_action.requests.request')
-    def test_create_token_auth_cred(self, mock_request, mock_auth):
+        # Errors that aren't transient are returned right away
+        mock_session.request.return_value = mock.MagicMock(status_code=500)
+
+        result = action.send_request(mock_session, 'GET', 'https://test.com/_api/web')
+
+        self.assertEqual(result.status_code, 500)
+        self.assertEqual(mock_session.request.call_count, 4)
+
+    @mock.patch('lib.base_action.time.sleep')
+    @mock.patch('lib.base_action.SharepointBaseAction.get_form_digest')
+    @mock.patch('lib.base_action.parse_batch_response')
+    @mock.patch('lib.base_action.build_batch_body')
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_send_batch_retries(self, mock_request, mock_build, mock_parse,
+                                mock_get_digest, mock_sleep):
+        action = self.get_action_instance({'max_retries': 1})
+        mock_get_digest.return_value = None
+        mock_request.return_value.headers = {'content-type': 'multipart/mixed; boundary=x'}
+
+        ok1 = BatchResponse('url1', 200, {}, '1')
+        throttled = BatchResponse('url2', 429, {'retry-after': '2'}, '')
+        ok2 = BatchResponse('url2', 200, {}, '2')
+        mock_parse.side_effect = [[ok1, throttled], [ok2]]
+
+        result = action.send_batch('https://test.com', ['url1', 'url2'], [{}, {'a': 'b'}],
+                                   'user')
+
+        # Only the throttled request is sent again
+        self.assertEqual(result, [ok1, ok2])
+        mock_build.assert_called_with(['url2'], mock.ANY, accept=mock.ANY,
+                                      headers=[{'a': 'b'}])
+        mock_sleep.assert_called_once_with(2)
+
+        # Requests still throttled after max_retries fail the batch
+        mock_parse.side_effect = [[ok1, throttled], [throttled]]
+
+        with self.assertRaises(BatchRequestError):
+            action.send_batch('https://test.com', ['url1', 'url2'], [{}, {}], 'user')
+
+    @mock.patch('lib.base_action.HTTPAdapter')
+    @mock.patch('lib.base_action.requests.Session')
+    def test_get_session(self, mock_session_cls, mock_adapter):
+        action = self.get_action_instance({'pool_size': 4})
+        action.token_auth = False
+
+        test_auth = mock.MagicMock(username='dom\\user', password='pass')
+        mock_session_cls.side_effect = [mock.MagicMock(), mock.MagicMock()]
+
+        # Requests to the same host with the same credential share a session
+        session1 = action.get_session('https://test.com/site1/_api/web', test_auth)
+        session2 = action.get_session('https://TEST.com/site2/_api/web', test_auth)
+        # A different host gets its own session
+        session3 = action.get_session('https://other.com/_api/web', test_auth)
+
+        self.assertIs(session1, session2)
+        self.assertIsNot(session1, session3)
+        self.assertEqual(session1.auth, test_auth)
+        self.assertEqual(len(action.sessions), 2)
+        mock_adapter.assert_called_with(pool_connections=1, pool_maxsize=4)
+
+    @mock.patch('lib.base_action.requests.Session')
+    def test_get_session_token(self, mock_session_cls):
+        action = self.get_action_instance({})
+        action.token_auth = True
+
+        mock_session_cls.side_effect = [mock.MagicMock(), mock.MagicMock()]
+
+        session1 = action.get_session('https://test.com/_api/web', 'token1')
+        session2 = action.get_session('https://test.com/_api/web', 'token2')
+
+        # Bearer tokens are sent as a header so the session has no auth object
+        self.assertIsNot(session1, session2)
+        self.assertEqual(len(action.sessions), 2)
+
+    def test_close_sessions(self):
+        action = self.get_action_instance({})
+        mock_session = mock.MagicMock()
+        action.sessions = {('https://test.com', 'abc'): mock_session}
+
+        action.close_sessions()
+
+        mock_session.close.assert_called_with()
+        self.assertEqual(action.sessions, {})
+
+    @mock.patch('msal.oauth2cli.JwtAssertionCreator')
+    @mock.patch('lib.auth.requests.request')
+    def test_create_auth_cred_certificate(self, mock_request, mock_auth):
         action = self.get_action_instance({})
 
         test_rsa_private_key = 'rsa_test'
@@ -116,7 +709,7 @@ class SharePointBaseActionTestCase(BaseActionTestCase):
         test_client_id = '456dfg'
         test_base_url = 'https://test.com/'
         jwt_token = 'test1234567'
-        test_scope = "{0}/.default".format(test_base_url)
+        test_scope = 'https://test.com/.default'
         expected_output = 'auth_token'
         token_endpoint = ("https://login.microsoftonline.com/{0}"
                           "/oauth2/v2.0/token".format(test_tenent_id))
@@ -137,11 +730,9 @@ class SharePointBaseActionTestCase(BaseActionTestCase):
         mock_rest_return.raise_for_status.return_value = True
         mock_rest_return.json.return_value = {'access_token': expected_output}
 
-        result = action.create_token_auth_cred(test_rsa_private_key,
-                                               test_cert_thumbprint,
-                                               test_tenent_id,
-                                               test_client_id,
-                                               test_base_url)
+        result = action.create_auth_cred(True, None, None, None, test_rsa_private_key,
+                                         test_cert_thumbprint, test_tenent_id,
+                                         test_client_id, test_base_url)
 
         self.assertEqual(result, expected_output)
         mock_auth.assert_called_with(test_rsa_private_key,
@@ -154,44 +745,182 @@ class SharePointBaseActionTestCase(BaseActionTestCase):
                                         token_endpoint,
                                         data=test_payload)
 
-    @mock.patch("lib.base_action.json")
-    @mock.patch("lib.base_action.open")
-    def test_save_sites_list_to_file_append(self, mock_open, mock_json):
+    @mock.patch('lib.base_action.SharepointBaseAction.get_token_cache')
+    @mock.patch('msal.oauth2cli.JwtAssertionCreator')
+    @mock.patch('lib.auth.requests.request')
+    def test_create_auth_cred_certificate_cached(self, mock_request, mock_auth, mock_get_cache):
+        action = self.get_action_instance({})
+
+        mock_cache = mock.MagicMock()
+        mock_cache.get.return_value = 'cached_token'
+        mock_get_cache.return_value = mock_cache
+
+        result = action.create_auth_cred(True, None, None, None, 'rsa_test', 'cert_test',
+                                         '123abc', '456dfg', 'https://test.com')
+
+        # A warm cache doesn't sign an assertion or call the identity endpoint
+        self.assertEqual(result, 'cached_token')
+        mock_auth.assert_not_called()
+        mock_request.assert_not_called()
+
+    @mock.patch('lib.auth.token_cache_key')
+    @mock.patch('lib.base_action.SharepointBaseAction.get_token_cache')
+    @mock.patch('msal.oauth2cli.JwtAssertionCreator')
+    @mock.patch('lib.auth.requests.request')
+    def test_create_auth_cred_certificate_cache_miss(self, mock_request, mock_auth,
+                                                     mock_get_cache, mock_cache_key):
+        action = self.get_action_instance({})
+
+        mock_cache = mock.MagicMock()
+        mock_cache.get.return_value = None
+        mock_get_cache.return_value = mock_cache
+        mock_cache_key.return_value = 'key'
+        mock_request.return_value.json.return_value = {'access_token': 'new_token',
+                                                       'expires_in': 1800}
+
+        result = action.create_auth_cred(True, None, None, None, 'rsa_test', 'cert_test',
+                                         '123abc', '456dfg', 'https://test.com')
+
+        self.assertEqual(result, 'new_token')
+        mock_cache_key.assert_called_with('123abc', '456dfg', 'cert_test',
+                                          'https://test.com/.default')
+        mock_cache.set.assert_called_with('key', 'new_token', 1800)
+
+    @mock.patch('msal.oauth2cli.JwtAssertionCreator')
+    @mock.patch('lib.auth.requests.request')
+    def test_create_auth_cred_certificate_same_host(self, mock_request, mock_auth):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        action = self.get_action_instance({
+            'token_cache': 'file',
+            'token_cache_file': os.path.join(temp_dir, 'tokens.json')})
+        mock_request.return_value.json.return_value = {'access_token': 'token',
+                                                       'expires_in': 3600}
+
+        # Sites on the same host share one token
+        for site_url in ['https://test.com/sites/a', 'https://test.com/sites/b',
+                         'https://TEST.com/sites/a/']:
+            self.assertEqual(action.create_auth_cred(True, None, None, None, 'rsa_test',
+                                                     'cert_test', '123abc', '456dfg',
+                                                     site_url), 'token')
+
+        self.assertEqual(mock_request.call_count, 1)
+        self.assertEqual(mock_request.call_args[1]['data']['scope'],
+                         'https://test.com/.default')
+
+    @mock.patch('lib.auth.CertificateBackend.create_credential')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_create_auth_cred(self, mock_ntlm_auth, mock_token_auth):
+        action = self.get_action_instance({})
+        args = ('dom', 'user', 'pass', 'rsa', 'thumb', 'tenant', 'client', 'https://test.com')
+
+        self.assertEqual(action.create_auth_cred(False, *args), mock_ntlm_auth.return_value)
+        self.assertFalse(action.token_auth)
+        self.assert_auth_params(mock_ntlm_auth, domain='dom', username='user', password='pass')
+        self.assertIs(mock_ntlm_auth.call_args[0][0], action)
+
+        self.assertEqual(action.create_auth_cred(True, *args), mock_token_auth.return_value)
+        self.assertTrue(action.token_auth)
+        self.assert_auth_params(mock_token_auth, rsa_private_key='rsa', cert_thumbprint='thumb',
+                                tenent_id='tenant', client_id='client',
+                                site_url='https://test.com')
+
+        # A pre-supplied token is sent as it is
+        action = self.get_action_instance({})
+        self.assertEqual(action.create_auth_cred(False, *args, access_token='token'), 'token')
+        self.assertTrue(action.token_auth)
+        self.assertEqual(mock_ntlm_auth.call_count, 1)
+        self.assertEqual(mock_token_auth.call_count, 1)
+
+    @mock.patch('lib.base_action.SharepointBaseAction.create_auth_cred')
+    def test_create_auth_cred_from_config(self, mock_auth):
+        action = self.get_action_instance({})
+
+        result = action.create_auth_cred_from_config({'base_url': 'https://test.com',
+                                                      'domain': 'dom',
+                                                      'username': 'user',
+                                                      'password': 'pass'})
+
+        self.assertEqual(result, mock_auth.return_value)
+        mock_auth.assert_called_with(False, 'dom', 'user', 'pass', None, None, None, None,
+                                     'https://test.com')
+
+    def test_get_token_cache(self):
+        action = self.get_action_instance({'token_cache': 'file',
+                                           'token_cache_file': '/tmp/tokens.json'})
+        cache = action.get_token_cache()
+        self.assertIsInstance(cache, FileTokenCache)
+        self.assertEqual(cache.file_path, '/tmp/tokens.json')
+
+        action = self.get_action_instance({'token_cache': 'datastore'})
+        action.action_service = mock.MagicMock()
+        self.assertIsInstance(action.get_token_cache(), DatastoreTokenCache)
+
+        action = self.get_action_instance({'token_cache': 'none'})
+        self.assertIsNone(action.get_token_cache())
+
+    def test_save_sites_list_to_file_append(self):
         action = self.get_action_instance({})
 
         test_site_objs = ['site1', 'site2']
-        test_file_path = '/path/to/sites_file.json'
+        test_file_path = os.path.join(tempfile.mkdtemp(), 'sites_file.json')
         test_file_append = True
         expected_result = 'Output saved to: ' + test_file_path
 
-        m = mock.mock_open(read_data='test data')
-        mock_open.return_value = m.return_value
-        mock_json.loads.return_value = ['site3', 'site4']
+        with open(test_file_path, 'w') as file:
+            json.dump(['site3', 'site4'], file)
 
         result = action.save_sites_list_to_file(test_site_objs, test_file_path, test_file_append)
 
         self.assertEqual(result, expected_result)
-        mock_json.loads.assert_called_with('test data')
-        mock_json.dump.assert_called_with(['site3', 'site4', 'site1', 'site2'], m.return_value)
-        mock_open.assert_has_calls(
-            [mock.call(test_file_path, 'r'),
-             mock.call(test_file_path, 'w')])
+        with open(test_file_path) as file:
+            self.assertEqual(json.load(file), ['site3', 'site4', 'site1', 'site2'])
+        shutil.rmtree(os.path.dirname(test_file_path))
 
-    @mock.patch("lib.base_action.json")
-    @mock.patch("lib.base_action.open")
-    def test_save_sites_list_to_file_overwrite(self, mock_open, mock_json):
+    def test_save_sites_list_to_file_overwrite(self):
         action = self.get_action_instance({})
 
         test_site_objs = ['site1', 'site2']
-        test_file_path = '/path/to/sites_file.json'
+        test_file_path = os.path.join(tempfile.mkdtemp(), 'sites_file.json')
         test_file_append = False
         expected_result = 'Output saved to: ' + test_file_path
 
-        m = mock.mock_open(read_data='test data')
-        mock_open.return_value = m.return_value
+        with open(test_file_path, 'w') as file:
+            json.dump(['site3', 'site4'], file)
 
         result = action.save_sites_list_to_file(test_site_objs, test_file_path, test_file_append)
 
         self.assertEqual(result, expected_result)
-        mock_json.dump.assert_called_with(['site1', 'site2'], m.return_value)
-        mock_open.assert_called_with(test_file_path, 'w')
+        with open(test_file_path) as file:
+            self.assertEqual(json.load(file), ['site1', 'site2'])
+        shutil.rmtree(os.path.dirname(test_file_path))
+
+    def test_save_sites_list_to_file_generator(self):
+        action = self.get_action_instance({})
+
+        test_file_path = os.path.join(tempfile.mkdtemp(), 'sites_file.json')
+
+        action.save_sites_list_to_file((site for site in ['site1', 'site2']), test_file_path,
+                                       False)
+
+        with open(test_file_path) as file:
+            self.assertEqual(json.load(file), ['site1', 'site2'])
+        shutil.rmtree(os.path.dirname(test_file_path))
+
+    @mock.patch("lib.base_action.write_records")
+    def test_save_sites_list_to_file_ndjson(self, mock_write):
+        action = self.get_action_instance({})
+
+        test_site_objs = ['site1', 'site2']
+        test_file_path = '/path/to/sites_file.ndjson'
+
+        result = action.save_sites_list_to_file(test_site_objs, test_file_path, True, 'ndjson')
+
+        self.assertEqual(result, 'Output saved to: ' + test_file_path)
+        mock_write.assert_called_with(test_site_objs, test_file_path, True, 'ndjson')
+
+    def test_save_sites_list_to_file_unknown_format(self):
+        action = self.get_action_instance({})
+
+        with self.assertRaises(ValueError):
+            action.save_sites_list_to_file(['site1'], '/path/to/sites_file.csv', False, 'csv')
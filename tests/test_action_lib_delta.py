@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.delta import (DeltaCheckpoint, checkpoint_key, find_parent, find_web,
+                       replace_subtree, subtree_end)
+
+
+def web(web_id, url):
+    return {'Id': web_id, 'ServerRelativeUrl': url}
+
+
+class DeltaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.checkpoint_file = os.path.join(self.temp_dir, 'checkpoint.json')
+        self.records = [web('a', '/a'), web('a1', '/a/1'), web('a11', '/a/1/1'),
+                        web('a2', '/a/2'), web('b', '/b')]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_checkpoint_key(self):
+        key = checkpoint_key('subsites_list', 'https://test.com', '/a')
+
+        self.assertTrue(key.startswith('subsites_list.'))
+        self.assertEqual(key, checkpoint_key('subsites_list', 'https://test.com', '/a'))
+        self.assertNotEqual(key, checkpoint_key('subsites_list', 'https://test.com', '/b'))
+        self.assertNotEqual(key, checkpoint_key('sites_list', 'https://test.com', '/a'))
+
+    def test_checkpoint(self):
+        checkpoint = DeltaCheckpoint(self.checkpoint_file)
+
+        self.assertIsNone(checkpoint.load('key1'))
+
+        checkpoint.save('key1', {'change_token': '1'})
+        checkpoint.save('key2', {'change_token': '2'})
+        checkpoint.save('key1', {'change_token': '3'})
+
+        self.assertEqual(checkpoint.load('key1'), {'change_token': '3'})
+        self.assertEqual(checkpoint.load('key2'), {'change_token': '2'})
+
+        checkpoint.remove('key1')
+        checkpoint.remove('key3')
+
+        self.assertIsNone(checkpoint.load('key1'))
+        self.assertEqual(checkpoint.load('key2'), {'change_token': '2'})
+
+    def test_subtree_end(self):
+        self.assertEqual(subtree_end(self.records, 0), 4)
+        self.assertEqual(subtree_end(self.records, 1), 3)
+        self.assertEqual(subtree_end(self.records, 4), 5)
+
+    def test_find_web(self):
+        self.assertEqual(find_web(self.records, 'A2'), 3)
+        self.assertIsNone(find_web(self.records, 'c'))
+
+    def test_find_parent(self):
+        self.assertEqual(find_parent(self.records, '/a/1/2'), 1)
+        self.assertEqual(find_parent(self.records, '/a/3'), 0)
+        self.assertIsNone(find_parent(self.records, '/c'))
+
+    def test_replace_subtree(self):
+        replace_subtree(self.records, 'a1', [web('a1', '/a/renamed')])
+
+        self.assertEqual([record['Id'] for record in self.records], ['a', 'a1', 'a2', 'b'])
+        self.assertEqual(self.records[1]['ServerRelativeUrl'], '/a/renamed')
+
+    def test_replace_subtree_remove(self):
+        replace_subtree(self.records, 'a', [])
+
+        self.assertEqual([record['Id'] for record in self.records], ['b'])
+
+    def test_replace_subtree_new(self):
+        replace_subtree(self.records, 'a3', [web('a3', '/a/3'), web('a31', '/a/3/1')])
+        replace_subtree(self.records, 'c', [web('c', '/c')])
+
+        self.assertEqual([record['Id'] for record in self.records],
+                         ['a', 'a1', 'a11', 'a2', 'a3', 'a31', 'b', 'c'])
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.delta import checkpoint_key
+from lib.json_store import JsonStore, store_key
+
+
+class JsonStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.store_file = os.path.join(self.temp_dir, 'store.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_store_key(self):
+        key = store_key('webhook', 'https://test.com', 'list')
+
+        self.assertTrue(key.startswith('webhook.'))
+        self.assertEqual(key, store_key('webhook', 'https://test.com', 'list'))
+        self.assertNotEqual(key, store_key('webhook', 'https://test.com', 'other'))
+        # Checkpoint keys stay the same as before they were built on the store
+        self.assertEqual(checkpoint_key('webhook', 'https://test.com', 'list'), key)
+
+    def test_store(self):
+        store = JsonStore(self.store_file)
+
+        self.assertEqual(store.read_entries(), {})
+
+        store.save('key1', {'value': 1})
+        store.save('key2', {'value': 2})
+        store.remove('key1')
+        store.remove('key3')
+
+        self.assertIsNone(store.load('key1'))
+        self.assertEqual(store.read_entries(), {'key2': {'value': 2}})
+
+    def test_failed_save(self):
+        store = JsonStore(self.store_file)
+        store.save('key', {'value': 1})
+
+        with mock.patch('lib.json_store.json.dump') as mock_dump:
+            mock_dump.side_effect = ValueError('not serializable')
+            with self.assertRaises(ValueError):
+                store.save('key', {'value': 2})
+
+        # The previous entry is left in place and no temp files remain
+        self.assertEqual(store.load('key'), {'value': 1})
+        self.assertEqual(sorted(os.listdir(self.temp_dir)), ['store.json', 'store.json.lock'])
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.memo import RequestMemo
+
+
+class RequestMemoTestCase(unittest.TestCase):
+    def test_get(self):
+        memo = RequestMemo()
+        func = mock.MagicMock(side_effect=['a', 'b'])
+
+        self.assertEqual(memo.get('key1', func, 1), 'a')
+        self.assertEqual(memo.get('key1', func, 1), 'a')
+        self.assertEqual(memo.get('key2', func, 2), 'b')
+
+        func.assert_has_calls([mock.call(1), mock.call(2)])
+        self.assertEqual(func.call_count, 2)
+
+    def test_get_in_flight(self):
+        memo = RequestMemo()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def lookup():
+            calls.append(1)
+            started.set()
+            self.assertTrue(release.wait(5))
+            return 'result'
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            first = executor.submit(memo.get, 'key', lookup)
+            self.assertTrue(started.wait(5))
+            # The second call waits for the running lookup instead of calling it again
+            second = executor.submit(memo.get, 'key', lookup)
+            release.set()
+
+            self.assertEqual([first.result(5), second.result(5)], ['result', 'result'])
+        self.assertEqual(len(calls), 1)
+
+    def test_get_error(self):
+        memo = RequestMemo()
+        func = mock.MagicMock(side_effect=[ValueError('failed'), 'result'])
+
+        with self.assertRaises(ValueError):
+            memo.get('key', func)
+
+        # Failures aren't kept so the lookup is tried again
+        self.assertEqual(memo.get('key', func), 'result')
+        self.assertEqual(func.call_count, 2)
+
+    def test_max_size(self):
+        memo = RequestMemo(2)
+        func = mock.MagicMock(side_effect=lambda key: key)
+
+        for key in ['a', 'b', 'a', 'c', 'a', 'b']:
+            memo.get(key, func, key)
+
+        # b is the least recently used when c is added so it is looked up again
+        self.assertEqual([call[0][0] for call in func.call_args_list], ['a', 'b', 'c', 'b'])
+
+    def test_disabled(self):
+        memo = RequestMemo(0)
+        func = mock.MagicMock(return_value='result')
+
+        memo.get('key', func)
+        memo.get('key', func)
+
+        self.assertEqual(func.call_count, 2)
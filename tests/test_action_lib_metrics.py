@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from lib.metrics import RequestMetrics, endpoint_name, write_metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_endpoint_name(self):
+        base = 'https://test.com/sites/a'
+        self.assertEqual(endpoint_name(base + "/_api/search/query?querytext='x'"), 'search')
+        self.assertEqual(endpoint_name(base + '/_api/site/rootweb?$select=Id'), 'rootweb')
+        self.assertEqual(endpoint_name(base + '/_api/web/parentweb'), 'parentweb')
+        self.assertEqual(endpoint_name(base + '/_api/web/getsubwebsfilteredforcurrentuser'
+                                              '(nwebtemplatefilter=-1,nconfigurationfilter=0)'),
+                         'subwebs')
+        self.assertEqual(endpoint_name(base + '/_api/web/lists?$filter=BaseTemplate%20eq%20101'),
+                         'lists')
+        self.assertEqual(endpoint_name(base + '/_api/$batch'), 'batch')
+        self.assertEqual(endpoint_name(base + '/_api/contextinfo'), 'contextinfo')
+        self.assertEqual(endpoint_name(base + '/_api/site?$select=CurrentChangeToken'),
+                         'changes')
+        self.assertEqual(endpoint_name(base + '/_api/site/getchanges'), 'changes')
+        self.assertEqual(endpoint_name(base + "/_api/site/openWebById('a')"), 'changes')
+        self.assertEqual(endpoint_name('https://login.microsoftonline.com/t/oauth2/v2.0/token'),
+                         'token')
+        self.assertEqual(endpoint_name(base + '/_api/web'), 'other')
+
+    def test_record(self):
+        metrics = RequestMetrics()
+        metrics.record('https://test.com/_api/site/rootweb', 200, 100, 0.07)
+        metrics.record('https://test.com/_api/site/rootweb', 429, 10, 3)
+        metrics.record('https://test.com/_api/site/rootweb', 200, 50)
+        metrics.record_cache_hit('https://test.com/_api/site/rootweb')
+
+        result = metrics.as_dict()
+        rootweb = result['endpoints']['rootweb']
+
+        self.assertEqual(rootweb['requests'], 3)
+        self.assertEqual(rootweb['bytes'], 160)
+        self.assertEqual(rootweb['cache_hits'], 1)
+        self.assertEqual(rootweb['status_codes'], {'200': 2, '429': 1})
+        # Responses inside a $batch request have no latency of their own
+        self.assertEqual(rootweb['latency_count'], 2)
+        self.assertAlmostEqual(rootweb['latency_sum'], 3.07)
+        self.assertEqual(rootweb['latency_max'], 3)
+        # Buckets are cumulative like Prometheus histograms
+        self.assertEqual(rootweb['latency_buckets']['0.05'], 0)
+        self.assertEqual(rootweb['latency_buckets']['0.1'], 1)
+        self.assertEqual(rootweb['latency_buckets']['5'], 2)
+        self.assertEqual(result['total'], {'requests': 3, 'bytes': 160, 'cache_hits': 1,
+                                           'latency_sum': rootweb['latency_sum']})
+
+    def test_to_prometheus(self):
+        metrics = RequestMetrics()
+        metrics.record('https://test.com/_api/web/lists', 200, 100, 0.2)
+
+        result = metrics.to_prometheus({'action': 'doc_lib_list'})
+
+        self.assertIn('# TYPE sharepoint_requests_total counter\n', result)
+        self.assertIn('sharepoint_requests_total{action="doc_lib_list",endpoint="lists"} 1\n',
+                      result)
+        self.assertIn('sharepoint_responses_total{action="doc_lib_list",endpoint="lists",'
+                      'code="200"} 1\n', result)
+        self.assertIn('sharepoint_request_duration_seconds_bucket{action="doc_lib_list",'
+                      'endpoint="lists",le="0.1"} 0\n', result)
+        self.assertIn('sharepoint_request_duration_seconds_bucket{action="doc_lib_list",'
+                      'endpoint="lists",le="0.25"} 1\n', result)
+        self.assertIn('sharepoint_request_duration_seconds_bucket{action="doc_lib_list",'
+                      'endpoint="lists",le="+Inf"} 1\n', result)
+        self.assertIn('sharepoint_request_duration_seconds_count{action="doc_lib_list",'
+                      'endpoint="lists"} 1\n', result)
+
+    def test_to_statsd(self):
+        metrics = RequestMetrics()
+        metrics.record('https://test.com/_api/web/lists', 200, 100, 0.2)
+        metrics.record('https://test.com/_api/web/lists', 200, 100, 0.4)
+
+        result = metrics.to_statsd('sharepoint.doc_lib_list').splitlines()
+
+        self.assertEqual(result, ['sharepoint.doc_lib_list.lists.requests:2|c',
+                                  'sharepoint.doc_lib_list.lists.bytes:200|c',
+                                  'sharepoint.doc_lib_list.lists.cache_hits:0|c',
+                                  'sharepoint.doc_lib_list.lists.status.200:2|c',
+                                  'sharepoint.doc_lib_list.lists.latency_avg_ms:300.000|g',
+                                  'sharepoint.doc_lib_list.lists.latency_max_ms:400.000|g'])
+
+    def test_write_metrics(self):
+        metrics = RequestMetrics()
+        metrics.record('https://test.com/_api/web/lists', 200, 100, 0.2)
+        metrics_file = os.path.join(self.temp_dir, 'sharepoint.prom')
+
+        write_metrics(metrics, metrics_file, 'statsd', 'subsites_list')
+
+        with open(metrics_file) as result_file:
+            self.assertTrue(result_file.read().startswith(
+                'sharepoint.subsites_list.lists.requests:1|c\n'))
+        self.assertEqual(stat.S_IMODE(os.stat(metrics_file).st_mode), 0o644)
+        self.assertEqual(os.listdir(self.temp_dir), ['sharepoint.prom'])
+
+        with self.assertRaises(ValueError):
+            write_metrics(metrics, metrics_file, 'json')
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from lib.odata import normalize_payload, odata_accept, unwrap_result
+
+
+class ODataTestCase(unittest.TestCase):
+    def test_odata_accept(self):
+        self.assertEqual(odata_accept(), 'application/json;odata=verbose')
+        self.assertEqual(odata_accept('nometadata'), 'application/json;odata=nometadata')
+        with self.assertRaises(ValueError):
+            odata_accept('full')
+
+    def test_normalize_payload_verbose_collection(self):
+        data = {'d': {'results': [
+            {'__metadata': {'type': 'SP.Web', 'uri': 'https://test.com/_api/web'},
+             'Id': '1234',
+             'Lists': {'__deferred': {'uri': 'https://test.com/_api/web/lists'}},
+             'ServerRelativeUrl': '/site'}
+        ]}}
+
+        result = normalize_payload(data)
+
+        self.assertEqual(result, [{'Id': '1234', 'ServerRelativeUrl': '/site'}])
+
+    def test_normalize_payload_verbose_entity(self):
+        data = {'d': {'__metadata': {'type': 'SP.Web'},
+                      'Id': '1234',
+                      'CurrentChangeToken': {'__metadata': {'type': 'SP.ChangeToken'},
+                                             'StringValue': '1;2;3'},
+                      'Rows': {'results': [{'Cells': {'results': [{'Key': 'a'}]}}]}}}
+
+        result = normalize_payload(data)
+
+        self.assertEqual(result, {'Id': '1234',
+                                  'CurrentChangeToken': {'StringValue': '1;2;3'},
+                                  'Rows': [{'Cells': [{'Key': 'a'}]}]})
+
+    def test_normalize_payload_minimal_metadata(self):
+        data = {'odata.metadata': 'https://test.com/_api/$metadata#SP.ApiData.Webs',
+                'value': [{'odata.type': 'SP.Web',
+                           'odata.id': 'https://test.com/_api/web',
+                           'Id': '1234',
+                           'Title@odata.type': 'Edm.String',
+                           'Title': 'site'}]}
+
+        result = normalize_payload(data)
+
+        self.assertEqual(result, [{'Id': '1234', 'Title': 'site'}])
+
+    def test_normalize_payload_no_metadata(self):
+        self.assertEqual(normalize_payload({'value': []}), [])
+        self.assertEqual(normalize_payload({'Id': '1234', 'results': 'text'}),
+                         {'Id': '1234', 'results': 'text'})
+        self.assertEqual(normalize_payload({'value': 'text'}), {'value': 'text'})
+
+    def test_unwrap_result(self):
+        self.assertEqual(unwrap_result({'query': {'a': 1}}, 'query'), {'a': 1})
+        self.assertEqual(unwrap_result({'a': 1}, 'query'), {'a': 1})
+        self.assertEqual(unwrap_result([], 'query'), [])
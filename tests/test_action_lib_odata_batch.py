@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from lib.odata_batch import (BatchRequestError, BatchResponse, build_batch_body,
+                             parse_batch_response)
+
+
+class ODataBatchTestCase(unittest.TestCase):
+    def test_build_batch_body(self):
+        test_urls = ['https://test.com/site1/_api/web',
+                     "https://test.com/_api/web/lists?$filter=BaseTemplate eq 101"]
+
+        result = build_batch_body(test_urls, 'batch_abc')
+
+        expected_result = ("--batch_abc\r\n"
+                           "Content-Type: application/http\r\n"
+                           "Content-Transfer-Encoding: binary\r\n"
+                           "\r\n"
+                           "GET https://test.com/site1/_api/web HTTP/1.1\r\n"
+                           "Accept: application/json;odata=verbose\r\n"
+                           "\r\n"
+                           "--batch_abc\r\n"
+                           "Content-Type: application/http\r\n"
+                           "Content-Transfer-Encoding: binary\r\n"
+                           "\r\n"
+                           "GET https://test.com/_api/web/lists?$filter=BaseTemplate%20eq%20101"
+                           " HTTP/1.1\r\n"
+                           "Accept: application/json;odata=verbose\r\n"
+                           "\r\n"
+                           "--batch_abc--\r\n")
+        self.assertEqual(result, expected_result)
+
+    def test_build_batch_body_headers(self):
+        result = build_batch_body(['https://test.com/_api/web', 'https://test.com/_api/site'],
+                                  'batch_abc', headers=[{'If-None-Match': '"1"'}, {}])
+
+        self.assertIn("GET https://test.com/_api/web HTTP/1.1\r\n"
+                      "Accept: application/json;odata=verbose\r\n"
+                      "If-None-Match: \"1\"\r\n"
+                      "\r\n", result)
+        self.assertIn("GET https://test.com/_api/site HTTP/1.1\r\n"
+                      "Accept: application/json;odata=verbose\r\n"
+                      "\r\n", result)
+
+    def test_parse_batch_response(self):
+        test_urls = ['https://test.com/site1/_api/web',
+                     'https://test.com/site2/_api/web']
+        test_content_type = 'multipart/mixed; boundary=batchresponse_123'
+        test_text = ("--batchresponse_123\r\n"
+                     "Content-Type: application/http\r\n"
+                     "Content-Transfer-Encoding: binary\r\n"
+                     "\r\n"
+                     "HTTP/1.1 200 OK\r\n"
+                     "CONTENT-TYPE: application/json;odata=verbose;charset=utf-8\r\n"
+                     "\r\n"
+                     '{"d": {"Id": "1"}}\r\n'
+                     "--batchresponse_123\r\n"
+                     "Content-Type: application/http\r\n"
+                     "Content-Transfer-Encoding: binary\r\n"
+                     "\r\n"
+                     "HTTP/1.1 404 Not Found\r\n"
+                     "CONTENT-TYPE: application/json;odata=verbose;charset=utf-8\r\n"
+                     "\r\n"
+                     '{"error": {"code": "-2147024894"}}\r\n'
+                     "--batchresponse_123--\r\n")
+
+        result = parse_batch_response(test_urls, test_content_type, test_text)
+
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0].url, test_urls[0])
+        self.assertEqual(result[0].status_code, 200)
+        self.assertEqual(result[0].headers['content-type'],
+                         'application/json;odata=verbose;charset=utf-8')
+        self.assertEqual(result[0].json(), {'d': {'Id': '1'}})
+        result[0].raise_for_status()
+
+        # The failure is attributed to the request that caused it
+        self.assertEqual(result[1].url, test_urls[1])
+        self.assertEqual(result[1].status_code, 404)
+        with self.assertRaises(BatchRequestError) as context:
+            result[1].raise_for_status()
+        self.assertIn(test_urls[1], str(context.exception))
+        self.assertIs(context.exception.response, result[1])
+
+    def test_parse_batch_response_count_mismatch(self):
+        test_text = ("--b\r\n\r\nHTTP/1.1 200 OK\r\n\r\n{}\r\n"
+                     "--b--\r\n")
+
+        with self.assertRaises(ValueError):
+            parse_batch_response(['url1', 'url2'], 'multipart/mixed; boundary=b', test_text)
+
+    def test_parse_batch_response_no_boundary(self):
+        with self.assertRaises(ValueError):
+            parse_batch_response(['url1'], 'application/json', '{}')
+
+    def test_batch_response_ok(self):
+        self.assertTrue(BatchResponse('url', 204, {}, '').ok)
+        self.assertFalse(BatchResponse('url', 429, {}, '').ok)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.output_file import (json_to_ndjson, ndjson_to_json, read_ndjson, truncate_records,
+                             write_json_array, write_ndjson, write_records)
+
+
+class OutputFileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.ndjson_file = os.path.join(self.temp_dir, 'sites.ndjson')
+        self.json_file = os.path.join(self.temp_dir, 'sites.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_write_ndjson(self):
+        write_ndjson([{'Id': '1'}, {'Id': '2'}], self.ndjson_file, False)
+        count = write_ndjson(iter([{'Id': '3'}]), self.ndjson_file, True)
+
+        self.assertEqual(count, 1)
+        with open(self.ndjson_file) as file:
+            self.assertEqual(file.read(), '{"Id": "1"}\n{"Id": "2"}\n{"Id": "3"}\n')
+
+        # Overwriting replaces the existing records
+        write_ndjson([{'Id': '4'}], self.ndjson_file, False)
+        self.assertEqual(list(read_ndjson(self.ndjson_file)), [{'Id': '4'}])
+
+    def test_convert_round_trip(self):
+        records = [{'Id': '1', 'DocLibs': []}, {'Id': '2', 'DocLibs': [{'Title': 'Docs'}]}]
+        with open(self.json_file, 'w') as file:
+            json.dump(records, file)
+
+        self.assertEqual(json_to_ndjson(self.json_file, self.ndjson_file), 2)
+        self.assertEqual(list(read_ndjson(self.ndjson_file)), records)
+
+        converted = os.path.join(self.temp_dir, 'converted.json')
+        self.assertEqual(ndjson_to_json(self.ndjson_file, converted), 2)
+        with open(converted) as file:
+            self.assertEqual(json.load(file), records)
+
+    def test_ndjson_to_json_empty(self):
+        open(self.ndjson_file, 'w').close()
+
+        self.assertEqual(ndjson_to_json(self.ndjson_file, self.json_file), 0)
+        with open(self.json_file) as file:
+            self.assertEqual(json.load(file), [])
+
+    def test_write_json_array_append(self):
+        with open(self.json_file, 'w') as file:
+            file.write('[{"Id": "1"}]\n')
+
+        count = write_json_array(iter([{'Id': '2'}, {'Id': '3'}]), self.json_file, True,
+                                 buffer_size=1)
+
+        self.assertEqual(count, 2)
+        with open(self.json_file) as file:
+            self.assertEqual(json.load(file), [{'Id': '1'}, {'Id': '2'}, {'Id': '3'}])
+
+    def test_write_json_array_append_error(self):
+        with open(self.json_file, 'w') as file:
+            file.write('[{"Id": "1"}]\n')
+
+        def records():
+            yield {'Id': '2'}
+            yield {'Id': '3'}
+            raise RuntimeError('crawl failed')
+
+        with self.assertRaises(RuntimeError):
+            write_json_array(records(), self.json_file, True, buffer_size=1)
+
+        # The array is closed after the records written before the error
+        with open(self.json_file) as file:
+            self.assertEqual(json.load(file), [{'Id': '1'}, {'Id': '2'}, {'Id': '3'}])
+
+    def test_write_json_array_append_empty(self):
+        with open(self.json_file, 'w') as file:
+            file.write('[ ]')
+
+        write_json_array([{'Id': '1'}], self.json_file, True)
+
+        with open(self.json_file) as file:
+            self.assertEqual(json.load(file), [{'Id': '1'}])
+
+    def test_write_json_array_append_missing_file(self):
+        write_json_array([{'Id': '1'}], self.json_file, True)
+
+        with open(self.json_file) as file:
+            self.assertEqual(json.load(file), [{'Id': '1'}])
+
+    def test_write_json_array_append_invalid(self):
+        with open(self.json_file, 'w') as file:
+            file.write('{"Id": "1"}')
+
+        with self.assertRaises(ValueError):
+            write_json_array([{'Id': '2'}], self.json_file, True)
+
+    def test_write_records_streams(self):
+        written = []
+
+        def records():
+            for index in range(5):
+                # Earlier records are already on disk when later ones are generated
+                with open(self.ndjson_file) as file:
+                    written.append(len(file.readlines()))
+                yield {'Id': index}
+
+        write_records(records(), self.ndjson_file, False, 'ndjson', buffer_size=2)
+
+        self.assertEqual(written, [0, 0, 2, 2, 4])
+        self.assertEqual(len(list(read_ndjson(self.ndjson_file))), 5)
+
+    def test_write_records_on_flush(self):
+        for file_path, file_format in [(self.ndjson_file, 'ndjson'), (self.json_file, 'json')]:
+            flushes = []
+
+            def on_flush(count, offset):
+                # Everything up to the offset is in the file when on_flush is called
+                with open(file_path, 'rb') as file:
+                    flushes.append((count, offset, len(file.read())))
+
+            records = [{'Id': index} for index in range(5)]
+            write_records(records, file_path, False, file_format, 2, on_flush)
+
+            self.assertEqual([count for count, _, _ in flushes], [0, 2, 4])
+            self.assertEqual([offset for _, offset, _ in flushes],
+                             [size for _, _, size in flushes])
+
+    def test_truncate_records(self):
+        for file_path, file_format in [(self.ndjson_file, 'ndjson'), (self.json_file, 'json')]:
+            offsets = []
+            write_records([{'Id': index} for index in range(5)], file_path, False,
+                          file_format, 2, lambda count, offset: offsets.append(offset))
+
+            # Cut back to the first two records and append the rest again
+            truncate_records(file_path, offsets[1], file_format)
+            write_records([{'Id': index} for index in range(2, 4)], file_path, True,
+                          file_format)
+
+            if file_format == 'ndjson':
+                records = list(read_ndjson(file_path))
+            else:
+                with open(file_path) as file:
+                    records = json.load(file)
+            self.assertEqual(records, [{'Id': index} for index in range(4)])
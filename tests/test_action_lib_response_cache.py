@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from lib.response_cache import (ResponseCache, build_batch_response, build_response,
+                                response_cache_key, validator_headers)
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.temp_dir, 'responses.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_response_cache_key(self):
+        key = response_cache_key('GET', 'https://test.com/_api/web', 'user', 'json')
+
+        self.assertEqual(key, response_cache_key('get', 'https://test.com/_api/web',
+                                                 'user', 'json'))
+        self.assertNotEqual(key, response_cache_key('GET', 'https://test.com/_api/web',
+                                                    'other', 'json'))
+        self.assertNotEqual(key, response_cache_key('GET', 'https://test.com/_api/web',
+                                                    'user', 'xml'))
+
+    @mock.patch('lib.response_cache.time.time')
+    def test_get_set(self, mock_time):
+        cache = ResponseCache(self.cache_file, ttl=60)
+        mock_time.return_value = 1000
+
+        self.assertIsNone(cache.get('key'))
+
+        cache.set('key', 200, {'ETag': '"1"', 'Content-Type': 'application/json'}, b'{}')
+        entry = cache.get('key')
+
+        self.assertEqual(entry['status_code'], 200)
+        self.assertEqual(entry['body'], b'{}')
+        self.assertEqual(entry['etag'], '"1"')
+        self.assertIsNone(entry['last_modified'])
+        self.assertTrue(entry['fresh'])
+        self.assertEqual(os.stat(self.cache_file).st_mode & 0o777, 0o600)
+
+        # Expired entries are still returned so they can be revalidated
+        mock_time.return_value = 1060
+        self.assertFalse(cache.get('key')['fresh'])
+
+        cache.refresh('key')
+        self.assertTrue(cache.get('key')['fresh'])
+
+    @mock.patch('lib.response_cache.time.time')
+    def test_evict(self, mock_time):
+        cache = ResponseCache(self.cache_file)
+        cache.max_size = 10
+
+        mock_time.return_value = 1
+        cache.set('key1', 200, {}, b'1234')
+        mock_time.return_value = 2
+        cache.set('key2', 200, {}, b'1234')
+        # Revalidating the first response makes the second the oldest. Reads don't count.
+        mock_time.return_value = 3
+        cache.refresh('key1')
+        cache.get('key2')
+        mock_time.return_value = 4
+        cache.set('key3', 200, {}, b'1234')
+
+        self.assertIsNotNone(cache.get('key1'))
+        self.assertIsNone(cache.get('key2'))
+        self.assertIsNotNone(cache.get('key3'))
+
+    def test_connect_renames_accessed_at(self):
+        connection = sqlite3.connect(self.cache_file)
+        connection.execute('CREATE TABLE responses (key TEXT PRIMARY KEY, status_code INTEGER, '
+                           'headers TEXT, body BLOB, size INTEGER, expires_at REAL, '
+                           'accessed_at REAL)')
+        connection.commit()
+        connection.close()
+        cache = ResponseCache(self.cache_file)
+
+        cache.set('key', 200, {}, b'{}')
+        cache.refresh('key')
+
+        self.assertEqual(cache.get('key')['body'], b'{}')
+
+    @mock.patch('lib.response_cache.sqlite3.connect')
+    def test_connect_creates_table_once(self, mock_connect):
+        cache = ResponseCache(self.cache_file)
+
+        cache.connect()
+        cache.connect()
+
+        create_calls = [call for call in mock_connect.return_value.execute.call_args_list
+                        if call[0][0].startswith('CREATE TABLE')]
+        self.assertEqual(len(create_calls), 1)
+        self.assertEqual(mock_connect.call_count, 2)
+
+    def test_build_response(self):
+        entry = {'status_code': 200, 'headers': {'ETag': '"1"'}, 'body': b'{"d": {}}'}
+
+        response = build_response(entry, 'https://test.com/_api/web')
+
+        self.assertEqual(response.json(), {'d': {}})
+        self.assertEqual(response.headers['etag'], '"1"')
+        self.assertEqual(response.url, 'https://test.com/_api/web')
+        response.raise_for_status()
+
+        batch_response = build_batch_response(entry, 'https://test.com/_api/web')
+
+        self.assertEqual(batch_response.json(), {'d': {}})
+        self.assertEqual(batch_response.url, 'https://test.com/_api/web')
+
+    def test_validator_headers(self):
+        self.assertEqual(validator_headers({'etag': '"1"', 'last_modified': 'Mon'}),
+                         {'If-None-Match': '"1"', 'If-Modified-Since': 'Mon'})
+        self.assertEqual(validator_headers({'etag': None, 'last_modified': None}), {})
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.site_cache import (SiteTreeCache, diff_trees, get_site_tree_cache, site_tree_key,
+                            url_prefixes, DEFAULT_SITE_TREE_CACHE_FILE)
+
+
+def web(guid, url, doc_libs=None):
+    return {'Guid': guid, 'SiteUrl': url, 'DocLibs': doc_libs or []}
+
+
+class SiteTreeCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.temp_dir, 'site_tree.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_site_tree_key(self):
+        key = site_tree_key('https://test.com/', '/sites/A/')
+
+        self.assertEqual(key, site_tree_key('https://TEST.com', '/sites/a'))
+        self.assertNotEqual(key, site_tree_key('https://test.com', '/sites/b'))
+        self.assertNotEqual(key, site_tree_key('https://test.com', '/sites/a', ['Title']))
+
+    def test_get_site_tree_cache(self):
+        self.assertEqual(get_site_tree_cache(None).file_path, DEFAULT_SITE_TREE_CACHE_FILE)
+        self.assertEqual(get_site_tree_cache({'site_tree_cache_file': self.cache_file})
+                         .file_path, self.cache_file)
+
+    def test_url_prefixes(self):
+        self.assertEqual(url_prefixes('https://Test.com/sites/a/Shared%20Documents/'),
+                         ['https://test.com/sites/a/shared documents',
+                          'https://test.com/sites/a', 'https://test.com/sites',
+                          'https://test.com'])
+
+    def test_diff_trees(self):
+        old = [web('a', 'https://test.com/a', [{'Id': '1'}, {'Id': '2'}]),
+               web('b', 'https://test.com/b')]
+        new = [web('a', 'https://test.com/a', [{'Id': '2'}, {'Id': '3'}]),
+               web('c', 'https://test.com/c', [{'Id': '4'}])]
+
+        changes = diff_trees(old, new)
+
+        self.assertEqual(changes['webs_added'], [new[1]])
+        self.assertEqual(changes['webs_removed'], [old[1]])
+        self.assertEqual(changes['doc_libs_added'], [(new[0], {'Id': '3'})])
+        self.assertEqual(changes['doc_libs_removed'], [(new[0], {'Id': '1'})])
+
+    @mock.patch('lib.site_cache.time.time')
+    def test_save_load_tree(self, mock_time):
+        cache = SiteTreeCache(self.cache_file)
+        mock_time.return_value = 1000
+
+        self.assertIsNone(cache.load_tree('key'))
+        self.assertIsNone(cache.get_refreshed_at('key'))
+
+        records = [web('b', 'https://test.com/b'), web('a', 'https://test.com/a')]
+        changes = cache.save_tree('key', 'https://test.com', '', records)
+
+        self.assertEqual(changes['webs_added'], records)
+        self.assertEqual(cache.load_tree('key'), records)
+        self.assertEqual(cache.get_refreshed_at('key'), 1000)
+        self.assertEqual(os.stat(self.cache_file).st_mode & 0o777, 0o600)
+
+        # Trees older than max_staleness aren't returned
+        mock_time.return_value = 1100
+        self.assertEqual(cache.load_tree('key', 100), records)
+        self.assertIsNone(cache.load_tree('key', 99))
+
+        changes = cache.save_tree('key', 'https://test.com', '', records[1:])
+
+        self.assertEqual(changes['webs_removed'], records[:1])
+        self.assertEqual(cache.load_tree('key'), records[1:])
+
+    @mock.patch('lib.site_cache.time.time')
+    def test_find_web(self, mock_time):
+        cache = SiteTreeCache(self.cache_file)
+        mock_time.return_value = 1000
+        cache.save_tree('old', 'https://test.com', '', [web('a', 'https://test.com/a'),
+                                                        web('x', 'https://test.com/a/b')])
+        mock_time.return_value = 1010
+        cache.save_tree('new', 'https://test.com', '/a', [web('y', 'https://test.com/a/b')])
+
+        # The deepest web wins, and the newest tree when several trees hold it
+        self.assertEqual(cache.find_web('https://test.com/a/b/Docs/file.docx')['Guid'], 'y')
+        self.assertEqual(cache.find_web('https://test.com/a/bc')['Guid'], 'a')
+        self.assertIsNone(cache.find_web('https://test.com/c'))
+
+        mock_time.return_value = 1020
+        self.assertEqual(cache.find_web('https://test.com/a/b', 10)['Guid'], 'y')
+        self.assertIsNone(cache.find_web('https://test.com/a', 10))
+
+    def test_get_site_urls(self):
+        cache = SiteTreeCache(self.cache_file)
+        cache.save_tree('a', 'https://test.com', '', [web('1', 'https://test.com/A'),
+                                                      web('2', 'https://test.com/B')])
+        cache.save_tree('b', 'https://test.com', '/a', [web('1', 'https://test.com/a')])
+
+        self.assertEqual(cache.get_site_urls(), ['https://test.com/A', 'https://test.com/B'])
+
+    @mock.patch('lib.site_cache.time.time')
+    def test_dirty(self, mock_time):
+        cache = SiteTreeCache(self.cache_file)
+        mock_time.return_value = 1000
+        records = [web('a', 'https://test.com/a'), web('b', 'https://test.com/b')]
+        cache.save_tree('key', 'https://test.com', '', records)
+
+        mock_time.return_value = 1010
+        cache.mark_dirty('https://test.com/A/', 'LIST1')
+
+        self.assertEqual(cache.get_dirty(), [{'url': 'https://test.com/a', 'list_id': 'list1',
+                                              'marked_at': 1010}])
+        # Trees holding a dirty web aren't used
+        self.assertIsNone(cache.load_tree('key'))
+
+        # Only marks made up to the given time are cleared
+        mock_time.return_value = 1020
+        cache.mark_dirty('https://test.com/a')
+        cache.clear_dirty('https://test.com/a', 1010)
+
+        self.assertEqual([mark['list_id'] for mark in cache.get_dirty()], [''])
+
+        # A crawl clears the marks of its webs made before it started
+        cache.mark_dirty('https://test.com/c')
+        cache.save_tree('key', 'https://test.com', '', records, crawled_at=1015)
+
+        self.assertEqual([mark['url'] for mark in cache.get_dirty()],
+                         ['https://test.com/a', 'https://test.com/c'])
+
+        cache.save_tree('key', 'https://test.com', '', records, crawled_at=1020)
+
+        self.assertEqual([mark['url'] for mark in cache.get_dirty()], ['https://test.com/c'])
+        self.assertEqual(cache.load_tree('key'), records)
+
+    def test_update_doc_libs(self):
+        cache = SiteTreeCache(self.cache_file)
+        cache.save_tree('key', 'https://test.com', '/x', [
+            web('a', 'https://test.com/a', [{'Id': '1'}]), web('b', 'https://test.com/b')])
+
+        updates = cache.update_doc_libs('https://test.com/A', [{'Id': '2'}])
+
+        new_web = web('a', 'https://test.com/a', [{'Id': '2'}])
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0]['base_url'], 'https://test.com')
+        self.assertEqual(updates[0]['endpoint'], '/x')
+        self.assertEqual(updates[0]['changes']['doc_libs_added'], [(new_web, {'Id': '2'})])
+        self.assertEqual(updates[0]['changes']['doc_libs_removed'], [(new_web, {'Id': '1'})])
+        self.assertEqual(cache.load_tree('key')[0], new_web)
+        self.assertEqual(cache.update_doc_libs('https://test.com/c', []), [])
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import mock
+import threading
+import unittest
+
+from lib.throttle import AimdLimiter, retry_delay
+
+
+class ThrottleTestCase(unittest.TestCase):
+    def test_retry_delay_retry_after(self):
+        self.assertEqual(retry_delay({'retry-after': '7'}, 0), 7)
+        # The delay is capped at the maximum
+        self.assertEqual(retry_delay({'retry-after': '120'}, 0, max_delay=60), 60)
+
+    @mock.patch('lib.throttle.time.time')
+    def test_retry_delay_retry_after_date(self, mock_time):
+        mock_time.return_value = 1445412480
+
+        result = retry_delay({'retry-after': 'Wed, 21 Oct 2015 07:28:10 GMT'}, 0)
+
+        self.assertEqual(result, 10)
+
+    @mock.patch('lib.throttle.random.uniform')
+    def test_retry_delay_backoff(self, mock_uniform):
+        mock_uniform.side_effect = lambda low, high: high
+
+        self.assertEqual(retry_delay(None, 0, backoff=1, max_delay=60), 1)
+        self.assertEqual(retry_delay({}, 3, backoff=1, max_delay=60), 8)
+        self.assertEqual(retry_delay({'retry-after': 'soon'}, 10, backoff=1, max_delay=60),
+                         60)
+
+    def test_aimd_limiter(self):
+        limiter = AimdLimiter(8)
+
+        # Throttled requests halve the limit
+        started = limiter.acquire()
+        limiter.release(started, throttled=True)
+        self.assertEqual(limiter.limit, 4)
+
+        # Requests sent before the decrease don't cut it again
+        limiter.acquire()
+        limiter.release(started - 1, throttled=True)
+        self.assertEqual(limiter.limit, 4)
+
+        # Clean responses grow the limit by about one per limit responses
+        for _ in range(4):
+            limiter.release(limiter.acquire())
+        self.assertGreater(limiter.limit, 4.9)
+        self.assertLess(limiter.limit, 5.1)
+
+        # The limit never leaves the bounds
+        for _ in range(100):
+            limiter.release(limiter.acquire())
+        self.assertEqual(limiter.limit, 8)
+        for _ in range(10):
+            limiter.release(limiter.acquire(), throttled=True)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_aimd_limiter_blocks(self):
+        limiter = AimdLimiter(1)
+        started = limiter.acquire()
+        acquired = threading.Event()
+
+        def acquire():
+            limiter.release(limiter.acquire())
+            acquired.set()
+
+        thread = threading.Thread(target=acquire)
+        thread.start()
+
+        # The second request waits until the first one is done
+        self.assertFalse(acquired.wait(0.05))
+        limiter.release(started)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
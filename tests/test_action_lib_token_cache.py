@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.token_cache import DatastoreTokenCache, FileTokenCache, token_cache_key, token_scope
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.temp_dir, 'tokens.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_token_scope(self):
+        self.assertEqual(token_scope('https://Tenant.sharepoint.com/sites/a/'),
+                         'https://tenant.sharepoint.com/.default')
+        self.assertEqual(token_scope('https://tenant.sharepoint.com'),
+                         'https://tenant.sharepoint.com/.default')
+
+    def test_token_cache_key(self):
+        key1 = token_cache_key('tenent', 'client', 'thumb', 'https://test.com/.default')
+        key2 = token_cache_key('tenent', 'client', 'thumb', 'https://other.com/.default')
+
+        self.assertEqual(key1, token_cache_key('tenent', 'client', 'thumb',
+                                               'https://test.com/.default'))
+        self.assertNotEqual(key1, key2)
+
+    @mock.patch('lib.token_cache.time.time')
+    def test_file_token_cache(self, mock_time):
+        cache = FileTokenCache(self.cache_file, refresh_margin=300)
+        mock_time.return_value = 1000
+
+        self.assertIsNone(cache.get('key'))
+
+        cache.set('key', 'token', 3600)
+
+        self.assertEqual(cache.get('key'), 'token')
+        self.assertEqual(os.stat(self.cache_file).st_mode & 0o777, 0o600)
+
+        # Tokens inside the refresh margin are treated as expired
+        mock_time.return_value = 1000 + 3600 - 300
+        self.assertIsNone(cache.get('key'))
+
+    @mock.patch('lib.token_cache.time.time')
+    def test_file_token_cache_drops_expired(self, mock_time):
+        cache = FileTokenCache(self.cache_file)
+        mock_time.return_value = 1000
+        cache.set('old', 'token1', 60)
+
+        mock_time.return_value = 2000
+        cache.set('new', 'token2', 3600)
+
+        with open(self.cache_file) as file:
+            self.assertEqual(list(json.load(file).keys()), ['new'])
+
+    @mock.patch('lib.token_cache.time.time')
+    def test_datastore_token_cache(self, mock_time):
+        action_service = mock.MagicMock()
+        cache = DatastoreTokenCache(action_service, refresh_margin=300)
+        mock_time.return_value = 1000
+
+        cache.set('key', 'token', 3600)
+
+        action_service.set_value.assert_called_with(
+            'token_cache.key', json.dumps({'access_token': 'token', 'expires_at': 4600}),
+            local=True, encrypt=True)
+
+        action_service.get_value.return_value = action_service.set_value.call_args[0][1]
+        self.assertEqual(cache.get('key'), 'token')
+        action_service.get_value.assert_called_with('token_cache.key', local=True,
+                                                    decrypt=True)
+
+        action_service.get_value.return_value = None
+        self.assertIsNone(cache.get('key'))
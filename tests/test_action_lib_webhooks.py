@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import mock
+import requests
+import threading
+import unittest
+
+from lib.webhooks import (create_subscription, create_webhook_server, delete_subscription,
+                          expiration_time, format_expiration, parse_expiration,
+                          parse_notifications, update_subscription, MAX_EXPIRATION_DAYS)
+
+
+class WebhooksTestCase(unittest.TestCase):
+    def test_format_parse_expiration(self):
+        self.assertEqual(format_expiration(1650557877), '2022-04-21T16:17:57Z')
+        self.assertEqual(parse_expiration('2022-04-21T16:17:57Z'), 1650557877)
+        self.assertEqual(parse_expiration('2022-04-21T16:17:57.0000000Z'), 1650557877)
+
+    def test_expiration_time(self):
+        self.assertEqual(expiration_time(2, 1000), 1000 + 2 * 86400)
+        self.assertEqual(expiration_time(365, 1000), 1000 + MAX_EXPIRATION_DAYS * 86400)
+
+    def test_parse_notifications(self):
+        body = json.dumps({'value': [{'subscriptionId': 'sub1'}]}).encode('utf-8')
+
+        self.assertEqual(parse_notifications(body), [{'subscriptionId': 'sub1'}])
+        with self.assertRaises(ValueError):
+            parse_notifications(b'{"other": []}')
+        with self.assertRaises(ValueError):
+            parse_notifications(b'not json')
+
+    def test_create_subscription(self):
+        action = mock.MagicMock()
+        action.parse_json.return_value = {'id': 'sub1',
+                                          'expirationDateTime': '2022-04-21T16:17:57Z'}
+
+        result = create_subscription(action, 'https://test.com/a', 'list1',
+                                     'https://hooks.test.com/webhook', '2022-04-21T16:17:57Z',
+                                     'auth', 'state')
+
+        self.assertEqual(result, {'id': 'sub1', 'expirationDateTime': '2022-04-21T16:17:57Z'})
+        action.post_request.assert_called_with(
+            'https://test.com/a', "https://test.com/a/_api/web/lists('list1')/subscriptions",
+            'auth', {'resource': "https://test.com/a/_api/web/lists('list1')",
+                     'notificationUrl': 'https://hooks.test.com/webhook',
+                     'expirationDateTime': '2022-04-21T16:17:57Z',
+                     'clientState': 'state'},
+            {'content-type': 'application/json'})
+        action.post_request.return_value.raise_for_status.assert_called_once_with()
+        action.parse_json.assert_called_with(action.post_request.return_value)
+
+    def test_update_subscription(self):
+        action = mock.MagicMock()
+        action.post_request.return_value.raise_for_status.side_effect = requests.HTTPError()
+
+        with self.assertRaises(requests.HTTPError):
+            update_subscription(action, 'https://test.com/a', 'list1', 'sub1',
+                                '2022-04-21T16:17:57Z', 'auth')
+
+        action.post_request.assert_called_with(
+            'https://test.com/a',
+            "https://test.com/a/_api/web/lists('list1')/subscriptions('sub1')", 'auth',
+            {'expirationDateTime': '2022-04-21T16:17:57Z'},
+            {'content-type': 'application/json', 'X-HTTP-Method': 'PATCH'})
+
+    def test_delete_subscription(self):
+        action = mock.MagicMock()
+        result = action.post_request.return_value
+
+        # A subscription that is already gone is fine
+        result.status_code = 404
+        delete_subscription(action, 'https://test.com/a', 'list1', 'sub1', 'auth')
+
+        result.raise_for_status.assert_not_called()
+        action.post_request.assert_called_with(
+            'https://test.com/a',
+            "https://test.com/a/_api/web/lists('list1')/subscriptions('sub1')", 'auth',
+            headers={'content-type': 'application/json', 'X-HTTP-Method': 'DELETE'})
+
+        result.status_code = 500
+        delete_subscription(action, 'https://test.com/a', 'list1', 'sub1', 'auth')
+
+        result.raise_for_status.assert_called_once_with()
+
+    def test_webhook_server(self):
+        # Notifications are handled after the response is sent
+        handled = threading.Event()
+        on_notifications = mock.MagicMock(side_effect=lambda notifications: handled.set())
+        server = create_webhook_server('127.0.0.1', 0, on_notifications)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(thread.join)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:{0}/webhook'.format(server.server_address[1])
+
+        # Subscribing makes SharePoint send a validation token that has to be echoed
+        response = requests.post(url + '?validationtoken=abc%20123')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.text, 'abc 123')
+        self.assertEqual(response.headers['Content-Type'], 'text/plain')
+        on_notifications.assert_not_called()
+
+        response = requests.post(url, json={'value': [{'subscriptionId': 'sub1'}]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(handled.wait(5))
+        on_notifications.assert_called_once_with([{'subscriptionId': 'sub1'}])
+
+        response = requests.post(url, data=b'not json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(on_notifications.call_count, 1)
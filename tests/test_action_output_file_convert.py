@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test_action_lib_base_action import SharePointBaseActionTestCase
+from output_file_convert import OutputFileConvert
+import mock
+
+
+class SharepointOutputFileConvertTest(SharePointBaseActionTestCase):
+    __test__ = True
+    action_cls = OutputFileConvert
+
+    def test_init(self):
+        action = self.get_action_instance({})
+        self.assertIsInstance(action, OutputFileConvert)
+
+    @mock.patch('output_file_convert.json_to_ndjson')
+    def test_run_ndjson(self, mock_convert):
+        action = self.get_action_instance({})
+        mock_convert.return_value = 3
+
+        result = action.run('/path/sites.json', '/path/sites.ndjson', 'ndjson')
+
+        self.assertEqual(result, 'Converted 3 records to: /path/sites.ndjson')
+        mock_convert.assert_called_with('/path/sites.json', '/path/sites.ndjson')
+
+    @mock.patch('output_file_convert.ndjson_to_json')
+    def test_run_json(self, mock_convert):
+        action = self.get_action_instance({})
+        mock_convert.return_value = 2
+
+        result = action.run('/path/sites.ndjson', '/path/sites.json', 'json')
+
+        self.assertEqual(result, 'Converted 2 records to: /path/sites.json')
+        mock_convert.assert_called_with('/path/sites.ndjson', '/path/sites.json')
+
+    def test_run_unknown_format(self):
+        action = self.get_action_instance({})
+
+        with self.assertRaises(ValueError):
+            action.run('/path/sites.json', '/path/sites.csv', 'csv')
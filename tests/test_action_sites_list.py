@@ -16,6 +16,11 @@
 from test_action_lib_base_action import SharePointBaseActionTestCase
 from sites_list import SitesList
 import mock
+import os
+import requests
+import shutil
+import tempfile
+import time
 
 
 class SharepointSitesListTest(SharePointBaseActionTestCase):
@@ -26,59 +31,131 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
         action = self.get_action_instance({})
         self.assertIsInstance(action, SitesList)
 
-    @mock.patch('sites_list.urljoin')
+    def search_page(self, total_rows, sites):
+        cells = [[{'Key': 'Rank', 'Value': '1'}, {'Key': 'SiteName', 'Value': site}]
+                 for site in sites]
+        return {'PrimaryQueryResult':
+                {'RelevantResults':
+                 {'TotalRows': total_rows,
+                  'Table':
+                  {'Rows': [{'Cells': cell} for cell in cells]}}}}
+
     @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
-    def test_get_sites_list(self, mock_request, mock_urljoin):
+    def test_get_search_page(self, mock_request):
         action = self.get_action_instance({})
         action.token_auth = False
 
         test_base_url = 'https://test.com/'
         test_auth = 'user'
         # The following variable is hard coded in the sites_list action
-        endpoint_uri = '/_api/search/query?querytext=\'contentclass:STS_Site\''
-        test_urljoin = 'https://test.com/_api/search/query?querytext=\'contentclass:STS_Site\''
-        test_site1 = 'https://test.com/endpoint1'
-        test_site2 = 'https://test.com/endpoint2'
+        endpoint_uri = '_api/search/query?querytext=\'contentclass:STS_Site%20AND%20' \
+                       '%28Path:%22https://test.com/it%27%27s%22%29\'' \
+                       '&selectproperties=\'SiteName\'&trimduplicates=false'
 
-        test_cells = [{'Key': 'TestKey', 'Value': 'TestValue'},
-                      {'Key': 'SiteName', 'Value': test_site1},
-                      {'Key': 'SiteName', 'Value': test_site2}]
+        mock_request.return_value.json.return_value = {'d': {'query': 'page'}}
 
-        rest_result = {'d':
-                       {'query':
-                        {'PrimaryQueryResult':
-                         {'RelevantResults':
-                          {'Table':
-                           {'Rows':
-                            {'results':
-                             [{'Cells':
-                              {'results': test_cells}}]}}}}}}}
+        result = action.get_search_page(test_base_url, test_auth,
+                                        'contentclass:STS_Site AND '
+                                        '(Path:"https://test.com/it\'s")', 500, 250)
 
-        # The expected result should be the same as the rest_result with 2
-        # additional variables
-        expected_result = [test_site1, test_site2]
+        self.assertEqual(result, 'page')
+        mock_request.assert_called_with(test_base_url + endpoint_uri +
+                                        '&rowlimit=250&startrow=500', test_auth)
 
-        mock_request.return_value = mock.MagicMock()
-        mock_request.return_value.json.return_value = rest_result
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_get_search_page_error(self, mock_request):
+        action = self.get_action_instance({})
+        mock_request.return_value.json.return_value = {'error': {'code': '-2147024891'}}
+        mock_request.return_value.raise_for_status.side_effect = \
+            requests.HTTPError('403 Client Error')
 
-        mock_urljoin.return_value = test_urljoin
+        with self.assertRaises(requests.HTTPError):
+            action.get_search_page('https://test.com/', 'user', 'contentclass:STS_Site', 0, 250)
 
-        result = action.get_sites_list(test_base_url, test_auth)
+    def test_get_search_queries(self):
+        action = self.get_action_instance({})
 
-        self.assertEqual(result, expected_result)
-        mock_request.assert_called_with(test_urljoin, test_auth)
-        mock_urljoin.assert_called_with(test_base_url, endpoint_uri)
+        self.assertEqual(action.get_search_queries([]), ['contentclass:STS_Site'])
+        self.assertEqual(action.get_search_queries(['https://test.com/a/',
+                                                    'https://test.com/b']),
+                         ['contentclass:STS_Site AND (Path:"https://test.com/a" OR '
+                          'Path:"https://test.com/b")'])
 
-    @mock.patch('lib.base_action.SharepointBaseAction.get_doc_libs')
-    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
-    def test_get_site_objects(self, mock_request, mock_get_doc_libs):
+    @mock.patch('sites_list.MAX_FILTER_LENGTH', 80)
+    def test_get_search_queries_chunked(self):
+        action = self.get_action_instance({})
+
+        sites = ['https://test.com/site{0}'.format(i) for i in range(5)]
+        result = action.get_search_queries(sites)
+
+        # Every site is in exactly one query and no query is too long
+        self.assertGreater(len(result), 1)
+        for site in sites:
+            self.assertEqual(len([query for query in result
+                                  if '"' + site + '"' in query]), 1)
+        for query in result:
+            self.assertTrue(query.startswith('contentclass:STS_Site AND ('))
+
+    @mock.patch('sites_list.SitesList.get_search_page')
+    def test_get_sites_list(self, mock_get_search_page):
+        action = self.get_action_instance({})
+        action.token_auth = False
+
+        test_base_url = 'https://test.com/'
+        test_auth = 'user'
+        test_site1 = 'https://test.com/endpoint1'
+        test_site2 = 'https://test.com/Endpoint2'
+        test_site3 = 'https://test.com/endpoint3'
+        test_query = 'contentclass:STS_Site AND (Path:"https://test.com/endpoint1" OR ' \
+                     'Path:"https://test.com/endpoint2" OR Path:"https://test.com/endpoint3")'
+
+        pages = {
+            0: self.search_page(5, [test_site1, 'https://test.com/endpoint1-other']),
+            2: self.search_page(5, [test_site2, test_site1]),
+            4: self.search_page(5, [test_site3])
+        }
+
+        mock_get_search_page.side_effect = \
+            lambda url, auth, query, start_row, row_limit: pages[start_row]
+
+        result = action.get_sites_list(test_base_url, test_auth,
+                                       [test_site1, 'https://test.com/endpoint2/', test_site3],
+                                       2, 2)
+
+        # Prefix matches and duplicates are dropped
+        self.assertEqual(result, [test_site1, test_site2, test_site3])
+        # The first page is only requested once since it also has the row count
+        self.assertEqual(mock_get_search_page.call_count, 3)
+        mock_get_search_page.assert_has_calls([
+            mock.call(test_base_url, test_auth, test_query, 0, 2),
+            mock.call(test_base_url, test_auth, test_query, 2, 2),
+            mock.call(test_base_url, test_auth, test_query, 4, 2)
+        ], any_order=True)
+
+    @mock.patch('sites_list.SitesList.get_search_page')
+    def test_get_sites_list_no_filter(self, mock_get_search_page):
+        action = self.get_action_instance({})
+
+        mock_get_search_page.return_value = self.search_page(2, ['https://test.com/a',
+                                                                 'https://test.com/b'])
+
+        result = action.get_sites_list('https://test.com/', 'user', [], 2, 500)
+
+        self.assertEqual(result, ['https://test.com/a', 'https://test.com/b'])
+        mock_get_search_page.assert_called_once_with('https://test.com/', 'user',
+                                                     'contentclass:STS_Site', 0, 500)
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    def test_get_site_objects(self, mock_batch_request):
         action = self.get_action_instance({})
         action.token_auth = False
 
         test_base_url = 'https://test.com'
         test_auth = 'user'
-        # The following variable is hard coded in the sites_list action
+        # The following variables are hard coded in the actions
         endpoint_uri = '/_api/site/rootweb'
+        doc_libs_uri = '/_api/web/lists?$filter=BaseTemplate eq ' \
+                       '101&$select=Title,Id,DocumentTemplateUrl'
 
         test_site_urls = ['https://test.com/endpoint1',
                           'https://test.com/endpoint2']
@@ -93,31 +170,34 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
             'ServerRelativeUrl': '/endpoint2'
         }
 
-        mock_request.return_value = mock.MagicMock()
-        mock_request.return_value.json.side_effect = [
-            {'d': site1},
-            {'d': site2}
-        ]
+        def response(data):
+            result = mock.MagicMock()
+            result.json.return_value = {'d': data}
+            return result
 
-        # These parent IDs will get added to the site objects and
-        # are in the expected result
-        mock_get_doc_libs.side_effect = ['doc1', 'doc2']
+        # The rootweb and doc libs responses for each site in the batch
+        mock_batch_request.return_value = [
+            response(site1), response({'results': ['doc1']}),
+            response(site2), response({'results': ['doc2']})
+        ]
 
         # Add parent IDs and site URLs to the site objects
         expected_result = [
             {
                 'Id': '1234',
-                'DocLibs': 'doc1',
+                'DocLibs': ['doc1'],
                 'Endpoint': '/endpoint1',
-                'ParentId': None,
+                'Guid': '1234/endpoint1',
+                'ParentGuid': None,
                 'ServerRelativeUrl': '/endpoint1',
                 'SiteUrl': 'https://test.com/endpoint1'
             },
             {
                 'Id': '6789',
-                'DocLibs': 'doc2',
+                'DocLibs': ['doc2'],
                 'Endpoint': '/endpoint2',
-                'ParentId': None,
+                'Guid': '6789/endpoint2',
+                'ParentGuid': None,
                 'ServerRelativeUrl': '/endpoint2',
                 'SiteUrl': 'https://test.com/endpoint2'
             }
@@ -126,21 +206,150 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
         result = action.get_site_objects(test_base_url, test_auth, test_site_urls)
 
         self.assertEqual(result, expected_result)
-        mock_request.assert_has_calls([
-            mock.call('https://test.com/endpoint1' + endpoint_uri, test_auth),
-            mock.call('https://test.com/endpoint2' + endpoint_uri, test_auth),
-            mock.call().json()
+        mock_batch_request.assert_called_once_with(test_base_url, [
+            'https://test.com/endpoint1' + endpoint_uri,
+            'https://test.com/endpoint1' + doc_libs_uri,
+            'https://test.com/endpoint2' + endpoint_uri,
+            'https://test.com/endpoint2' + doc_libs_uri
+        ], test_auth)
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    def test_get_site_objects_fields(self, mock_batch_request):
+        action = self.get_action_instance({})
+        action.fields = ['Title', 'ServerRelativeUrl']
+
+        result = mock.MagicMock()
+        result.json.return_value = {'d': {'Id': '1', 'ServerRelativeUrl': '/site1'}}
+        mock_batch_request.return_value = [result, result]
+
+        action.get_site_objects('https://test.com', 'user', ['https://test.com/site1'])
+
+        endpoints = mock_batch_request.call_args[0][1]
+        # The fields used by the action are always selected
+        self.assertEqual(endpoints[0], 'https://test.com/site1/_api/site/rootweb?$select='
+                         'Id,ServerRelativeUrl,LastItemModifiedDate,Title')
+
+    @mock.patch('sites_list.SitesList.get_site_objects_group')
+    def test_get_site_objects_concurrent(self, mock_get_group):
+        action = self.get_action_instance({'batch_size': 4})
+
+        test_base_url = 'https://test.com'
+        test_auth = 'user'
+        test_site_urls = ['https://test.com/site1',
+                          'https://other.com/site2',
+                          'https://test.com/site3',
+                          'https://test.com/site4']
+
+        def get_group(base_url, batch_url, auth, sites):
+            # Later groups finish first
+            time.sleep(0.05 if sites[0] == test_site_urls[0] else 0)
+            return dict((site, {'SiteUrl': site}) for site in sites)
+
+        mock_get_group.side_effect = get_group
+
+        result = action.get_site_objects(test_base_url, test_auth, test_site_urls, 3, 1)
+
+        # The result keeps the order of the site URLs
+        self.assertEqual([site['SiteUrl'] for site in result], test_site_urls)
+        # Two sites fit in each batch and sites are batched against their own host
+        mock_get_group.assert_has_calls([
+            mock.call(test_base_url, test_base_url, test_auth, ['https://test.com/site1']),
+            mock.call(test_base_url, 'https://other.com', test_auth,
+                      ['https://other.com/site2']),
+            mock.call(test_base_url, test_base_url, test_auth,
+                      ['https://test.com/site3', 'https://test.com/site4'])
         ], any_order=True)
-        # The get_doc_libs function should be called once for every site
-        mock_get_doc_libs.assert_has_calls([
-            mock.call('https://test.com/endpoint1', test_auth),
-            mock.call('https://test.com/endpoint2', test_auth)
+        self.assertEqual(mock_get_group.call_count, 3)
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    def test_get_last_modified_group(self, mock_batch_request):
+        action = self.get_action_instance({})
+
+        response = mock.MagicMock()
+        response.json.return_value = {'d': {'LastItemModifiedDate': '2022-01-01'}}
+        mock_batch_request.return_value = [response]
+
+        result = action.get_last_modified_group('https://test.com', 'https://test.com',
+                                                'user', ['https://test.com/site1'])
+
+        self.assertEqual(result, {'https://test.com/site1': '2022-01-01'})
+        mock_batch_request.assert_called_with(
+            'https://test.com',
+            ['https://test.com/site1/_api/site/rootweb?$select=LastItemModifiedDate'],
+            'user', use_cache=False)
+
+    @mock.patch('sites_list.SitesList.get_last_modified_group')
+    @mock.patch('sites_list.SitesList.get_site_objects_group')
+    def test_iter_site_objects_delta(self, mock_get_group, mock_get_last_modified):
+        action = self.get_action_instance({})
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        checkpoint_file = os.path.join(temp_dir, 'checkpoint.json')
+
+        test_base_url = 'https://test.com'
+        test_site_urls = ['https://test.com/site1', 'https://test.com/site2']
+        dates = {'https://test.com/site1': '1', 'https://test.com/site2': '1'}
+
+        def get_group(base_url, batch_url, auth, sites):
+            return dict((site, {'SiteUrl': site, 'LastItemModifiedDate': dates[site]})
+                        for site in sites)
+
+        mock_get_group.side_effect = get_group
+        mock_get_last_modified.side_effect = \
+            lambda base_url, batch_url, auth, sites: dict((site, dates[site])
+                                                          for site in sites)
+
+        # The first run fetches every site without checking the dates
+        result = list(action.iter_site_objects_delta(test_base_url, 'user', test_site_urls,
+                                                     checkpoint_file))
+
+        self.assertEqual([site['SiteUrl'] for site in result], test_site_urls)
+        mock_get_last_modified.assert_not_called()
+
+        # Later runs only fetch the sites that were modified
+        dates['https://test.com/site2'] = '2'
+        mock_get_group.reset_mock()
+
+        result = list(action.iter_site_objects_delta(test_base_url, 'user', test_site_urls,
+                                                     checkpoint_file))
+
+        self.assertEqual(result, [
+            {'SiteUrl': 'https://test.com/site1', 'LastItemModifiedDate': '1'},
+            {'SiteUrl': 'https://test.com/site2', 'LastItemModifiedDate': '2'}
         ])
+        mock_get_group.assert_called_once_with(test_base_url, test_base_url, 'user',
+                                               ['https://test.com/site2'])
+
+        # Runs with a different filter have their own checkpoint
+        mock_get_group.reset_mock()
+        list(action.iter_site_objects_delta(test_base_url, 'user', test_site_urls[:1],
+                                            checkpoint_file, test_site_urls[:1]))
+
+        mock_get_group.assert_called_once_with(test_base_url, test_base_url, 'user',
+                                               ['https://test.com/site1'])
 
     @mock.patch('sites_list.SitesList.get_sites_list')
-    @mock.patch('sites_list.SitesList.get_site_objects')
-    @mock.patch('lib.base_action.SharepointBaseAction.create_ntlm_auth_cred')
-    def test_run(self, mock_auth, mock_get_site_objects, mock_get_sites_list):
+    @mock.patch('sites_list.SitesList.iter_site_objects_delta')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run_delta(self, mock_auth, mock_iter_delta, mock_get_sites_list):
+        action = self.get_action_instance({})
+
+        mock_auth.return_value = 'auth'
+        mock_get_sites_list.return_value = ['site1']
+        mock_iter_delta.return_value = iter(['result'])
+
+        result = action.run('https://test.com/', 'dom', None, False, 'console', 'pass',
+                            'user', False, None, None, None, None, ['site1'], 4, 1, 500,
+                            'json', '/path/to/checkpoint.json')
+
+        self.assertEqual(result, ['result'])
+        mock_iter_delta.assert_called_with('https://test.com/', 'auth', ['site1'],
+                                           '/path/to/checkpoint.json', ['site1'], 4, 1)
+
+    @mock.patch('sites_list.SitesList.get_sites_list')
+    @mock.patch('sites_list.SitesList.iter_site_objects')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run(self, mock_auth, mock_iter_site_objects, mock_get_sites_list):
         action = self.get_action_instance({})
         action.token_auth = False
 
@@ -157,28 +366,32 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
         test_cert_thumbprint = 'cert_test'
         test_tenent_id = '123abc'
         test_client_id = '456dfg'
+        test_sites_filter = ['https://TEST.com/site1']
 
-        expected_result = 'result'
+        expected_result = ['result']
 
         mock_auth.return_value = test_auth
 
-        mock_get_site_objects.return_value = expected_result
+        mock_iter_site_objects.return_value = iter(expected_result)
         mock_get_sites_list.return_value = test_site_list
 
         result = action.run(test_base_url, test_domain, test_output_file, test_output_file_append,
                             test_output_type, test_pass, test_user, False,
                             test_rsa_private_key, test_cert_thumbprint, test_tenent_id,
-                            test_client_id)
+                            test_client_id, test_sites_filter)
 
         self.assertEqual(result, expected_result)
-        mock_auth.assert_called_with(test_domain, test_user, test_pass)
-        mock_get_sites_list.assert_called_with(test_base_url, test_auth)
-        mock_get_site_objects.assert_called_with(test_base_url, test_auth, test_site_list)
+        self.assert_auth_params(mock_auth, domain=test_domain, username=test_user,
+                                password=test_pass)
+        mock_get_sites_list.assert_called_with(test_base_url, test_auth,
+                                               test_sites_filter, 10, 500)
+        mock_iter_site_objects.assert_called_with(test_base_url, test_auth, test_site_list,
+                                                 10, 0)
 
     @mock.patch('sites_list.SitesList.get_sites_list')
-    @mock.patch('sites_list.SitesList.get_site_objects')
-    @mock.patch('lib.base_action.SharepointBaseAction.create_token_auth_cred')
-    def test_run_token(self, mock_auth, mock_get_site_objects, mock_get_sites_list):
+    @mock.patch('sites_list.SitesList.iter_site_objects')
+    @mock.patch('lib.auth.CertificateBackend.create_credential')
+    def test_run_token(self, mock_auth, mock_iter_site_objects, mock_get_sites_list):
         action = self.get_action_instance({})
         action.token_auth = False
 
@@ -195,33 +408,34 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
         test_cert_thumbprint = 'cert_test'
         test_tenent_id = '123abc'
         test_client_id = '456dfg'
+        test_sites_filter = ['https://TEST.com/site1']
 
-        expected_result = 'result'
+        expected_result = ['result']
 
         mock_auth.return_value = test_auth
 
-        mock_get_site_objects.return_value = expected_result
+        mock_iter_site_objects.return_value = iter(expected_result)
         mock_get_sites_list.return_value = test_site_list
 
         result = action.run(test_base_url, test_domain, test_output_file, test_output_file_append,
                             test_output_type, test_pass, test_user, True,
                             test_rsa_private_key, test_cert_thumbprint, test_tenent_id,
-                            test_client_id)
+                            test_client_id, test_sites_filter)
 
         self.assertEqual(result, expected_result)
-        mock_auth.assert_called_with(test_rsa_private_key,
-                                     test_cert_thumbprint,
-                                     test_tenent_id,
-                                     test_client_id,
-                                     test_base_url)
-        mock_get_sites_list.assert_called_with(test_base_url, test_auth)
-        mock_get_site_objects.assert_called_with(test_base_url, test_auth, test_site_list)
+        self.assert_auth_params(mock_auth, rsa_private_key=test_rsa_private_key,
+                                cert_thumbprint=test_cert_thumbprint, tenent_id=test_tenent_id,
+                                client_id=test_client_id, site_url=test_base_url)
+        mock_get_sites_list.assert_called_with(test_base_url, test_auth,
+                                               test_sites_filter, 10, 500)
+        mock_iter_site_objects.assert_called_with(test_base_url, test_auth, test_site_list,
+                                                 10, 0)
 
     @mock.patch('sites_list.SitesList.get_sites_list')
-    @mock.patch('sites_list.SitesList.get_site_objects')
-    @mock.patch('lib.base_action.SharepointBaseAction.create_ntlm_auth_cred')
+    @mock.patch('sites_list.SitesList.iter_site_objects')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
     @mock.patch('lib.base_action.SharepointBaseAction.save_sites_list_to_file')
-    def test_run_file(self, mock_save, mock_auth, mock_get_site_objects, mock_get_sites_list):
+    def test_run_file(self, mock_save, mock_auth, mock_iter_site_objects, mock_get_sites_list):
         action = self.get_action_instance({})
 
         test_base_url = 'https://test.com/'
@@ -238,22 +452,27 @@ class SharepointSitesListTest(SharePointBaseActionTestCase):
         test_cert_thumbprint = 'cert_test'
         test_tenent_id = '123abc'
         test_client_id = '456dfg'
+        test_sites_filter = ['https://TEST.com/site1']
 
         expected_result = 'result'
 
         mock_auth.return_value = test_auth
 
-        mock_get_site_objects.return_value = test_site_object
+        mock_iter_site_objects.return_value = test_site_object
         mock_get_sites_list.return_value = test_site_list
         mock_save.return_value = expected_result
 
         result = action.run(test_base_url, test_domain, test_output_file, test_output_file_append,
                             test_output_type, test_pass, test_user, False,
                             test_rsa_private_key, test_cert_thumbprint, test_tenent_id,
-                            test_client_id)
+                            test_client_id, test_sites_filter)
 
         self.assertEqual(result, expected_result)
-        mock_auth.assert_called_with(test_domain, test_user, test_pass)
-        mock_get_sites_list.assert_called_with(test_base_url, test_auth)
-        mock_get_site_objects.assert_called_with(test_base_url, test_auth, test_site_list)
-        mock_save.assert_called_with(test_site_object, test_output_file, test_output_file_append)
+        self.assert_auth_params(mock_auth, domain=test_domain, username=test_user,
+                                password=test_pass)
+        mock_get_sites_list.assert_called_with(test_base_url, test_auth,
+                                               test_sites_filter, 10, 500)
+        mock_iter_site_objects.assert_called_with(test_base_url, test_auth, test_site_list,
+                                                 10, 0)
+        mock_save.assert_called_with(test_site_object, test_output_file,
+                                     test_output_file_append, 'json')
@@ -15,7 +15,18 @@
 
 from test_action_lib_base_action import SharePointBaseActionTestCase
 from subsites_list import SubsitesList
+from lib.odata_batch import BatchResponse
+from lib.output_file import read_ndjson, write_records
+from lib.site_cache import SiteTreeCache, site_tree_key
+import functools
+import json
 import mock
+import os
+import requests
+import shutil
+import tempfile
+import threading
+import time
 
 
 class SharepointSubsitesListTest(SharePointBaseActionTestCase):
@@ -38,12 +49,13 @@ class SharepointSubsitesListTest(SharePointBaseActionTestCase):
         test_id = '1234'
 
         # The following variable is hard coded in the sites_list action
-        endpoint_uri = '/_api/web/parentweb'
-        test_urljoin = 'https://test.com/api/test/subsite/_api/web/parentweb'
+        endpoint_uri = '/_api/web/parentweb?$select=Id,ServerRelativeUrl'
+        test_urljoin = 'https://test.com/api/test/subsite' + endpoint_uri
 
         expected_result = {
             'd': {
-                'Id': test_id
+                'Id': test_id,
+                'ServerRelativeUrl': '/test'
             }
         }
 
@@ -54,22 +66,25 @@ class SharepointSubsitesListTest(SharePointBaseActionTestCase):
 
         result = action.get_parent_site(test_base_url, test_auth, test_subsite)
 
-        self.assertEqual(result, test_id)
+        self.assertEqual(result, test_id + '/test')
+        mock_request.return_value.json.assert_called_once_with()
         mock_request.assert_called_with(test_urljoin, test_auth)
         mock_urljoin.assert_called_with(test_base_url, test_subsite + endpoint_uri)
 
-    @mock.patch('subsites_list.SubsitesList.get_doc_libs')
     @mock.patch('subsites_list.SubsitesList.get_parent_site')
     @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
-    def test_get_sites_list(self, mock_request, mock_get_parent, mock_doc_libs):
-        action = self.get_action_instance({})
+    def test_get_sites_list(self, mock_request, mock_get_parent):
+        # Disable batching so every request goes through rest_request
+        action = self.get_action_instance({'batch_size': 1})
         action.token_auth = False
 
         test_base_url = 'https://test.com'
         test_auth = 'user'
-        # The following variable is hard coded in the sites_list action
+        # The following variables are hard coded in the actions
         endpoint_uri = '/_api/web/getsubwebsfilteredforcurrentuser' \
                        '(nwebtemplatefilter=-1,nconfigurationfilter=0)'
+        doc_libs_uri = '/_api/web/lists?$filter=BaseTemplate eq ' \
+                       '101&$select=Title,Id,DocumentTemplateUrl'
 
         # test sharepoint site objects
         site1 = {
@@ -86,65 +101,766 @@ class SharepointSubsitesListTest(SharePointBaseActionTestCase):
         }
 
         # Add a result for each rest_request
-        mock_request.return_value = mock.MagicMock()
-        mock_request.return_value.json.side_effect = [
-            {'d': {'results': [site1, site2]}},
-            {'d': {'results': []}},
-            {'d': {'results': [subsite1]}},
-            {'d': {'results': []}}
-        ]
+        results = {
+            test_base_url + endpoint_uri: [site1, site2],
+            test_base_url + '/endpoint1' + endpoint_uri: [],
+            test_base_url + '/endpoint2' + endpoint_uri: [subsite1],
+            test_base_url + '/subsite' + endpoint_uri: [],
+            test_base_url + '/endpoint1' + doc_libs_uri: ['doc1'],
+            test_base_url + '/endpoint2' + doc_libs_uri: ['doc2'],
+            test_base_url + '/subsite' + doc_libs_uri: ['doc3']
+        }
+
+        def rest_request(url, auth, use_cache=True):
+            response = mock.MagicMock()
+            response.json.return_value = {'d': {'results': results[url]}}
+            return response
 
-        # These parent IDs will get added to the site objects and
-        # are in the expected result
-        mock_get_parent.side_effect = ['p123', 'p987', 'p567']
-        # These doc libs will also be in the result
-        mock_doc_libs.side_effect = ['doc1', 'doc2', 'doc3']
+        mock_request.side_effect = rest_request
+
+        # The parent of the top level sites is looked up once, the subsite
+        # parent comes from the site that listed it
+        mock_get_parent.return_value = 'p123'
 
         # Add parent IDs and site URLs to the site objects
         expected_result = [
             {
                 'Id': '1234',
-                'DocLibs': 'doc1',
-                'ParentId': 'p123',
+                'DocLibs': ['doc1'],
+                'Guid': '1234/endpoint1',
+                'ParentGuid': 'p123',
                 'ServerRelativeUrl': '/endpoint1',
                 'SiteUrl': 'https://test.com/endpoint1'
             },
             {
                 'Id': '6789',
-                'DocLibs': 'doc2',
-                'ParentId': 'p987',
+                'DocLibs': ['doc2'],
+                'Guid': '6789/endpoint2',
+                'ParentGuid': 'p123',
                 'ServerRelativeUrl': '/endpoint2',
                 'SiteUrl': 'https://test.com/endpoint2'
             },
             {
                 'Id': '4321',
-                'DocLibs': 'doc3',
-                'ParentId': 'p567',
+                'DocLibs': ['doc3'],
+                'Guid': '4321/subsite',
+                'ParentGuid': '6789/endpoint2',
                 'ServerRelativeUrl': '/subsite',
                 'SiteUrl': 'https://test.com/subsite'
             }
         ]
 
-        result = action.get_sites_list(test_base_url, test_auth)
+        result = action.get_sites_list(test_base_url, test_auth, '', 4)
 
         self.assertEqual(result, expected_result)
-        mock_request.assert_has_calls([
-            mock.call(test_base_url + endpoint_uri, test_auth),
-            mock.call(test_base_url + '/endpoint1' + endpoint_uri, test_auth),
-            mock.call(test_base_url + '/endpoint2' + endpoint_uri, test_auth),
-            mock.call(test_base_url + '/subsite' + endpoint_uri, test_auth),
-            mock.call().json()
-        ], any_order=True)
-        # The get_parent function should be called once for every site
-        mock_get_parent.assert_has_calls([
-            mock.call(test_base_url, test_auth, '/endpoint1'),
-            mock.call(test_base_url, test_auth, '/endpoint2'),
-            mock.call(test_base_url, test_auth, '/subsite')
+        self.assertEqual(mock_request.call_count, len(results))
+        # The get_parent function should only be called for the top level sites
+        mock_get_parent.assert_called_once_with(test_base_url, test_auth, '/endpoint1')
+
+    @mock.patch('subsites_list.SubsitesList.get_site_objects')
+    @mock.patch('subsites_list.SubsitesList.get_root_subwebs')
+    def test_get_sites_list_order(self, mock_get_root_subwebs, mock_get_site_objects):
+        # A batch size of 2 puts every site in its own group
+        action = self.get_action_instance({'batch_size': 2})
+
+        test_base_url = 'https://test.com'
+        test_auth = 'user'
+
+        tree = {
+            '/a': ['/a/1', '/a/2'],
+            '/a/1': [],
+            '/a/2': [],
+            '/b': ['/b/1'],
+            '/b/1': []
+        }
+        # Siblings deeper in the list finish first
+        delays = {'/a': 0.05, '/a/1': 0.03, '/a/2': 0.0, '/b': 0.0, '/b/1': 0.0}
+
+        def get_site_objects(url, auth, elements, parent_guid):
+            results = []
+            for element in elements:
+                time.sleep(delays[element['ServerRelativeUrl']])
+                element['Guid'] = element['ServerRelativeUrl']
+                results.append((element, [{'ServerRelativeUrl': sub} for sub in
+                                          tree[element['ServerRelativeUrl']]]))
+            return results
+
+        mock_get_root_subwebs.return_value = ('root', [{'ServerRelativeUrl': '/a'},
+                                                       {'ServerRelativeUrl': '/b'}])
+        mock_get_site_objects.side_effect = get_site_objects
+
+        result = action.get_sites_list(test_base_url, test_auth, '', 5)
+
+        self.assertEqual([site['ServerRelativeUrl'] for site in result],
+                         ['/a', '/a/1', '/a/2', '/b', '/b/1'])
+        self.assertEqual(mock_get_site_objects.call_count, 5)
+        mock_get_root_subwebs.assert_called_with(test_base_url, test_auth, '')
+
+    @mock.patch('subsites_list.SubsitesList.get_site_objects')
+    @mock.patch('subsites_list.SubsitesList.get_root_subwebs')
+    def test_iter_sites_list_streams(self, mock_get_root_subwebs, mock_get_site_objects):
+        action = self.get_action_instance({'batch_size': 2})
+        first_site_yielded = threading.Event()
+
+        def get_site_objects(url, auth, elements, parent_guid):
+            element = elements[0]
+            if element['ServerRelativeUrl'] == '/b':
+                # The second site only finishes once the first one has been consumed
+                self.assertTrue(first_site_yielded.wait(5))
+            element['Guid'] = element['ServerRelativeUrl']
+            return [(element, [])]
+
+        mock_get_root_subwebs.return_value = ('root', [{'ServerRelativeUrl': '/a'},
+                                                       {'ServerRelativeUrl': '/b'}])
+        mock_get_site_objects.side_effect = get_site_objects
+
+        sites = action.iter_sites_list('https://test.com', 'user', '', 2)
+
+        self.assertEqual(next(sites)['ServerRelativeUrl'], '/a')
+        first_site_yielded.set()
+        self.assertEqual([site['ServerRelativeUrl'] for site in sites], ['/b'])
+
+    @mock.patch('subsites_list.SubsitesList.get_site_objects')
+    @mock.patch('subsites_list.SubsitesList.get_root_subwebs')
+    def test_iter_sites_list_revisit(self, mock_get_root_subwebs, mock_get_site_objects):
+        action = self.get_action_instance({'batch_size': 4})
+
+        # /a/1 lists its own parent and /b lists a web that was already reached
+        tree = {
+            '/a': ['/a/1'],
+            '/a/1': ['/A'],
+            '/b': ['/a/1/', '/b/1'],
+            '/b/1': []
+        }
+
+        def get_site_objects(url, auth, elements, parent_guid):
+            results = []
+            for element in elements:
+                element['Guid'] = element['ServerRelativeUrl']
+                results.append((element, [{'ServerRelativeUrl': sub} for sub in
+                                          tree[element['ServerRelativeUrl']]]))
+            return results
+
+        mock_get_root_subwebs.return_value = ('root', [{'ServerRelativeUrl': '/a'},
+                                                       {'ServerRelativeUrl': '/b'}])
+        mock_get_site_objects.side_effect = get_site_objects
+
+        result = list(action.iter_sites_list('https://test.com', 'user', '', 2))
+
+        self.assertEqual([site['ServerRelativeUrl'] for site in result],
+                         ['/a', '/a/1', '/b', '/b/1'])
+
+    def mock_crawl(self, mock_get_root_subwebs, mock_get_site_objects, fail_at=None):
+        tree = {
+            '/a': ['/a/1', '/a/2'],
+            '/a/1': [],
+            '/a/2': ['/a/2/1', '/a/2/2'],
+            '/a/2/1': [],
+            '/a/2/2': [],
+            '/b': ['/b/1'],
+            '/b/1': [],
+            '/c': []
+        }
+
+        def get_site_objects(url, auth, elements, parent_guid):
+            results = []
+            for element in elements:
+                if element['ServerRelativeUrl'] == fail_at:
+                    raise requests.ConnectionError()
+                element['Guid'] = element['ServerRelativeUrl']
+                element['ParentGuid'] = parent_guid
+                results.append((element, [{'ServerRelativeUrl': sub} for sub in
+                                          tree[element['ServerRelativeUrl']]]))
+            return results
+
+        mock_get_root_subwebs.return_value = ('root', [{'ServerRelativeUrl': '/a'},
+                                                       {'ServerRelativeUrl': '/b'},
+                                                       {'ServerRelativeUrl': '/c'}])
+        mock_get_site_objects.side_effect = get_site_objects
+
+    @mock.patch('subsites_list.SubsitesList.get_site_objects')
+    @mock.patch('subsites_list.SubsitesList.get_root_subwebs')
+    def test_iter_sites_list_frontier(self, mock_get_root_subwebs, mock_get_site_objects):
+        action = self.get_action_instance({'batch_size': 4})
+        self.mock_crawl(mock_get_root_subwebs, mock_get_site_objects)
+
+        full = list(action.iter_sites_list('https://test.com', 'user', '', 2))
+
+        # Stop a crawl part way and continue from its frontier
+        progress = {}
+        self.assertIsNone(action.get_frontier(progress))
+        sites = action.iter_sites_list('https://test.com', 'user', '', 2, None, progress)
+        first = [next(sites) for _ in range(3)]
+        frontier = action.get_frontier(progress)
+        sites.close()
+
+        self.assertEqual([element['ServerRelativeUrl'] for element, _ in frontier],
+                         ['/a/2/1', '/a/2/2', '/b', '/c'])
+        self.assertEqual([parent_guid for _, parent_guid in frontier],
+                         ['/a/2', '/a/2', 'root', 'root'])
+
+        mock_get_root_subwebs.reset_mock()
+        rest = list(action.iter_sites_list('https://test.com', 'user', '', 2, frontier))
+
+        mock_get_root_subwebs.assert_not_called()
+        self.assertEqual(first + rest, full)
+        self.assertEqual([site['ServerRelativeUrl'] for site in full],
+                         ['/a', '/a/1', '/a/2', '/a/2/1', '/a/2/2', '/b', '/b/1', '/c'])
+
+    @mock.patch('subsites_list.SubsitesList.get_site_objects')
+    @mock.patch('subsites_list.SubsitesList.get_root_subwebs')
+    def test_save_resumable(self, mock_get_root_subwebs, mock_get_site_objects):
+        action = self.get_action_instance({'batch_size': 2})
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        checkpoint_file = os.path.join(temp_dir, 'resume.json')
+        expected = ['/a', '/a/1', '/a/2', '/a/2/1', '/a/2/2', '/b', '/b/1', '/c']
+
+        for file_format in ['json', 'ndjson']:
+            output_file = os.path.join(temp_dir, 'sites.' + file_format)
+
+            # The first crawl fails part way
+            self.mock_crawl(mock_get_root_subwebs, mock_get_site_objects, fail_at='/b/1')
+            with mock.patch('subsites_list.write_records',
+                            functools.partial(write_records, buffer_size=2)):
+                with self.assertRaises(requests.ConnectionError):
+                    action.save_resumable('https://test.com', 'user', '', checkpoint_file,
+                                          output_file, False, file_format, 2)
+            with open(checkpoint_file) as file:
+                entry, = json.load(file).values()
+            self.assertGreater(entry['emitted'], 0)
+            self.assertEqual(entry['frontier'][-1][0], {'ServerRelativeUrl': '/c'})
+
+            # The second crawl continues where the first one saved its progress
+            self.mock_crawl(mock_get_root_subwebs, mock_get_site_objects)
+            mock_get_root_subwebs.reset_mock()
+            count = action.save_resumable('https://test.com', 'user', '', checkpoint_file,
+                                          output_file, False, file_format, 2)
+
+            mock_get_root_subwebs.assert_not_called()
+            self.assertEqual(count, len(expected))
+            if file_format == 'ndjson':
+                sites = list(read_ndjson(output_file))
+            else:
+                with open(output_file) as file:
+                    sites = json.load(file)
+            self.assertEqual([site['ServerRelativeUrl'] for site in sites], expected)
+            with open(checkpoint_file) as file:
+                self.assertEqual(json.load(file), {})
+
+    @mock.patch('subsites_list.SubsitesList.save_resumable')
+    def test_run_resumable_console(self, mock_save_resumable):
+        action = self.get_action_instance({})
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        checkpoint_file = os.path.join(temp_dir, 'resume.json')
+        records_file = checkpoint_file + '.records'
+
+        def save_resumable(base_url, auth, endpoint, resume_from, file_path, file_append,
+                           file_format, max_concurrency):
+            with open(file_path, 'w') as file:
+                file.write('{"Id": "a"}\n{"Id": "b"}\n')
+
+        mock_save_resumable.side_effect = save_resumable
+
+        result = action.run_resumable('https://test.com', 'user', '/endp', checkpoint_file,
+                                      None, False, 'console', 'json', 5)
+
+        self.assertEqual(result, [{'Id': 'a'}, {'Id': 'b'}])
+        mock_save_resumable.assert_called_with('https://test.com', 'user', '/endp',
+                                               checkpoint_file, records_file, False,
+                                               'ndjson', 5)
+        self.assertFalse(os.path.exists(records_file))
+
+    def test_run_resumable_no_file(self):
+        action = self.get_action_instance({})
+
+        with self.assertRaises(ValueError):
+            action.run_resumable('https://test.com', 'user', '/endp', '/tmp/resume.json',
+                                 None, False, 'file', 'json', 5)
+
+    @mock.patch('subsites_list.SubsitesList.get_subwebs')
+    @mock.patch('subsites_list.SubsitesList.get_parent_site')
+    def test_get_root_subwebs(self, mock_get_parent, mock_get_subwebs):
+        action = self.get_action_instance({})
+
+        test_subwebs = [{'ServerRelativeUrl': '/site1'}, {'ServerRelativeUrl': '/site2'}]
+        mock_get_subwebs.return_value = test_subwebs
+        mock_get_parent.return_value = 'p123'
+
+        result = action.get_root_subwebs('https://test.com', 'user', '/base')
+
+        self.assertEqual(result, ('p123', test_subwebs))
+        mock_get_subwebs.assert_called_with('https://test.com', 'user', '/base')
+        mock_get_parent.assert_called_once_with('https://test.com', 'user', '/site1')
+
+    @mock.patch('subsites_list.SubsitesList.get_subwebs')
+    @mock.patch('subsites_list.SubsitesList.get_parent_site')
+    def test_get_root_subwebs_empty(self, mock_get_parent, mock_get_subwebs):
+        action = self.get_action_instance({})
+
+        mock_get_subwebs.return_value = []
+
+        result = action.get_root_subwebs('https://test.com', 'user')
+
+        self.assertEqual(result, (None, []))
+        mock_get_parent.assert_not_called()
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    @mock.patch('subsites_list.SubsitesList.get_parent_site')
+    def test_get_site_objects(self, mock_get_parent, mock_batch_request):
+        action = self.get_action_instance({})
+
+        test_base_url = 'https://test.com'
+        test_auth = 'user'
+        endpoint_uri = '/_api/web/getsubwebsfilteredforcurrentuser' \
+                       '(nwebtemplatefilter=-1,nconfigurationfilter=0)'
+        doc_libs_uri = '/_api/web/lists?$filter=BaseTemplate eq ' \
+                       '101&$select=Title,Id,DocumentTemplateUrl'
+
+        def response(results):
+            result = mock.MagicMock()
+            result.json.return_value = {'d': {'results': results}}
+            return result
+
+        mock_batch_request.return_value = [response(['doc1']), response([{'Id': 's1'}]),
+                                           response(['doc2']), response([])]
+        # The parent of the second site can't be found so it is skipped
+        mock_get_parent.side_effect = ['p123', KeyError('d'), 'p123']
+
+        elements = [{'Id': '1', 'ServerRelativeUrl': '/site1'},
+                    {'Id': '2', 'ServerRelativeUrl': '/site2'},
+                    {'Id': '3', 'ServerRelativeUrl': '/site3'}]
+
+        result = action.get_site_objects(test_base_url, test_auth, elements)
+
+        self.assertEqual(result, [
+            ({'Id': '1', 'ServerRelativeUrl': '/site1', 'Guid': '1/site1',
+              'ParentGuid': 'p123', 'SiteUrl': 'https://test.com/site1',
+              'DocLibs': ['doc1']}, [{'Id': 's1'}]),
+            (None, []),
+            ({'Id': '3', 'ServerRelativeUrl': '/site3', 'Guid': '3/site3',
+              'ParentGuid': 'p123', 'SiteUrl': 'https://test.com/site3',
+              'DocLibs': ['doc2']}, [])
         ])
+        # Both requests for every resolved site go in a single batch
+        mock_batch_request.assert_called_once_with(test_base_url, [
+            test_base_url + '/site1' + doc_libs_uri,
+            test_base_url + '/site1' + endpoint_uri,
+            test_base_url + '/site3' + doc_libs_uri,
+            test_base_url + '/site3' + endpoint_uri
+        ], test_auth)
+
+    @mock.patch('subsites_list.SubsitesList.get_subwebs')
+    @mock.patch('subsites_list.SubsitesList.get_parent_site')
+    def test_get_root_subwebs_throttled(self, mock_get_parent, mock_get_subwebs):
+        action = self.get_action_instance({})
+        mock_get_subwebs.return_value = [{'ServerRelativeUrl': '/site1'}]
+        mock_get_parent.side_effect = requests.HTTPError('429 Client Error')
+
+        # Throttling that outlasted the retries isn't hidden behind a lookup per subsite
+        with self.assertRaises(requests.HTTPError):
+            action.get_root_subwebs('https://test.com', 'user')
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    @mock.patch('subsites_list.SubsitesList.get_parent_site')
+    def test_get_site_objects_throttled(self, mock_get_parent, mock_batch_request):
+        action = self.get_action_instance({})
+        mock_get_parent.side_effect = requests.HTTPError('429 Client Error')
+
+        with self.assertRaises(requests.HTTPError):
+            action.get_site_objects('https://test.com', 'user',
+                                    [{'Id': '1', 'ServerRelativeUrl': '/site1'}])
+        mock_batch_request.assert_not_called()
+
+    @mock.patch('lib.base_action.SharepointBaseAction.rest_request')
+    def test_get_root_subwebs_forbidden(self, mock_request):
+        action = self.get_action_instance({})
+
+        result = mock.MagicMock(ok=False, status_code=403)
+        result.json.return_value = {'error': {'code': '-2147024891',
+                                              'message': {'value': 'Access denied.'}}}
+        mock_request.return_value = result
+
+        self.assertEqual(action.get_root_subwebs('https://test.com', 'user'), (None, []))
 
+    def test_parse_subwebs_not_list(self):
+        action = self.get_action_instance({})
+
+        self.assertEqual(action.parse_subwebs(
+            BatchResponse('u', 200, {}, '{"d": {"Title": "site1"}}')), [])
+        self.assertEqual(action.parse_subwebs(BatchResponse('u', 200, {}, 'not json')), [])
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    def test_get_site_objects_forbidden(self, mock_batch_request):
+        action = self.get_action_instance({})
+
+        # The subwebs of the site can't be listed but the site itself is still returned
+        mock_batch_request.return_value = [
+            BatchResponse('u', 200, {}, '{"d": {"results": ["doc1"]}}'),
+            BatchResponse('u', 403, {}, '{"error": {"code": "-2147024891", '
+                                        '"message": {"value": "Access denied."}}}')]
+
+        sites = action.get_site_objects('https://test.com', 'user',
+                                        [{'Id': '1', 'ServerRelativeUrl': '/site1'}],
+                                        'parent')
+
+        self.assertEqual(sites, [({'Id': '1', 'ServerRelativeUrl': '/site1',
+                                   'Guid': '1/site1', 'ParentGuid': 'parent',
+                                   'SiteUrl': 'https://test.com/site1',
+                                   'DocLibs': ['doc1']}, [])])
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    @mock.patch('subsites_list.SubsitesList.get_parent_site')
+    def test_get_site_objects_parent_guid(self, mock_get_parent, mock_batch_request):
+        action = self.get_action_instance({})
+
+        result = mock.MagicMock()
+        result.json.return_value = {'d': {'results': []}}
+        mock_batch_request.return_value = [result, result]
+
+        sites = action.get_site_objects('https://test.com', 'user',
+                                        [{'Id': '1', 'ServerRelativeUrl': '/site1'}],
+                                        'parent')
+
+        self.assertEqual(sites[0][0]['ParentGuid'], 'parent')
+        mock_get_parent.assert_not_called()
+
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    def test_get_site_objects_fields(self, mock_batch_request):
+        action = self.get_action_instance({})
+        action.fields = ['Title', 'Id']
+
+        result = mock.MagicMock()
+        result.json.return_value = {'d': {'results': []}}
+        mock_batch_request.return_value = [result, result]
+
+        action.get_site_objects('https://test.com', 'user',
+                                [{'Id': '1', 'ServerRelativeUrl': '/site1'}], 'parent')
+
+        endpoints = mock_batch_request.call_args[0][1]
+        self.assertEqual(endpoints[1], 'https://test.com/site1/_api/web/'
+                         'getsubwebsfilteredforcurrentuser(nwebtemplatefilter=-1,'
+                         'nconfigurationfilter=0)?$select=Id,ServerRelativeUrl,Title')
+
+    @mock.patch('lib.base_action.SharepointBaseAction.post_request')
+    def test_get_changes(self, mock_post):
+        action = self.get_action_instance({})
+
+        pages = [
+            [{'WebId': 'a', 'ChangeToken': {'StringValue': '2'}},
+             {'WebId': 'b', 'ChangeToken': {'StringValue': '3'}}],
+            [{'WebId': 'c', 'ChangeToken': {'StringValue': '4'}}],
+            []
+        ]
+        mock_post.return_value.json.side_effect = [{'d': {'results': page}}
+                                                   for page in pages]
+
+        result = action.get_changes('https://test.com', 'user', '/endp', '1', '5')
+
+        self.assertEqual([change['WebId'] for change in result], ['a', 'b', 'c'])
+        self.assertEqual(mock_post.call_count, 3)
+        # Each page starts at the last change of the page before it
+        query = mock_post.call_args_list[1][0][3]['query']
+        self.assertEqual(query['ChangeTokenStart']['StringValue'], '3')
+        self.assertEqual(query['ChangeTokenEnd']['StringValue'], '5')
+        mock_post.assert_called_with('https://test.com/endp',
+                                     'https://test.com/endp/_api/site/getchanges',
+                                     'user', mock.ANY)
+
+    @mock.patch('lib.base_action.SharepointBaseAction.post_request')
+    def test_get_changes_no_changes(self, mock_post):
+        action = self.get_action_instance({})
+
+        self.assertEqual(action.get_changes('https://test.com', 'user', '', '1', '1'), [])
+        mock_post.assert_not_called()
+
+    @mock.patch('subsites_list.SubsitesList.get_subwebs')
+    @mock.patch('lib.base_action.SharepointBaseAction.post_request')
+    def test_get_changed_web(self, mock_post, mock_get_subwebs):
+        action = self.get_action_instance({})
+
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.ok = True
+        mock_post.return_value.json.return_value = {'d': {'ServerRelativeUrl': '/endp/a/b'}}
+        mock_get_subwebs.return_value = [{'Id': 'OTHER'}, {'Id': 'ID', 'Title': 'b'}]
+
+        result = action.get_changed_web('https://test.com', 'user', '/endp', 'id')
+
+        self.assertEqual(result, {'Id': 'ID', 'Title': 'b'})
+        mock_post.assert_called_with('https://test.com/endp',
+                                     "https://test.com/endp/_api/site/openWebById('id')"
+                                     "?$select=ServerRelativeUrl", 'user')
+        mock_get_subwebs.assert_called_with('https://test.com', 'user', '/endp/a')
+
+        # Webs outside of the endpoint are ignored
+        mock_post.return_value.json.return_value = {'d': {'ServerRelativeUrl': '/endp'}}
+        self.assertIsNone(action.get_changed_web('https://test.com', 'user', '/endp', 'id'))
+
+        # Webs that can't be opened are gone
+        mock_post.return_value.status_code = 404
+        mock_post.return_value.ok = False
+        self.assertIsNone(action.get_changed_web('https://test.com', 'user', '/endp', 'id'))
+
+        # Throttling and other errors are raised instead of dropping the web
+        for status_code in [403, 500, 503]:
+            mock_post.return_value.status_code = status_code
+            mock_post.return_value.raise_for_status.side_effect = requests.HTTPError()
+            with self.assertRaises(requests.HTTPError):
+                action.get_changed_web('https://test.com', 'user', '/endp', 'id')
+
+    @mock.patch('lib.base_action.SharepointBaseAction.post_request')
+    def test_apply_changes_error(self, mock_post):
+        action = self.get_action_instance({})
+        records = [{'Id': 'w1', 'ServerRelativeUrl': '/endp/a', 'Guid': 'w1/endp/a'},
+                   {'Id': 'w2', 'ServerRelativeUrl': '/endp/a/b', 'Guid': 'w2/endp/a/b'}]
+        mock_post.return_value.status_code = 500
+        mock_post.return_value.raise_for_status.side_effect = requests.HTTPError('500')
+
+        # An updated web that fails to open isn't taken for a deleted one
+        with self.assertRaises(requests.HTTPError):
+            action.apply_changes('https://test.com', 'user', '/endp', records,
+                                 [{'WebId': 'w1', 'ChangeType': 2}])
+
+    @mock.patch('lib.base_action.SharepointBaseAction.get_doc_libs_batch')
     @mock.patch('subsites_list.SubsitesList.get_sites_list')
-    @mock.patch('lib.base_action.SharepointBaseAction.create_ntlm_auth_cred')
-    def test_run(self, mock_auth, mock_get_sites_list):
+    @mock.patch('subsites_list.SubsitesList.get_site_objects')
+    @mock.patch('subsites_list.SubsitesList.get_changed_web')
+    def test_apply_changes(self, mock_get_changed_web, mock_get_site_objects,
+                           mock_get_sites_list, mock_get_doc_libs_batch):
+        action = self.get_action_instance({})
+
+        def site(web_id, url, parent_guid=None):
+            return {'Id': web_id, 'ServerRelativeUrl': url, 'Guid': web_id + url,
+                    'ParentGuid': parent_guid, 'SiteUrl': 'https://test.com' + url,
+                    'DocLibs': []}
+
+        records = [site('a', '/a'), site('a1', '/a/1', 'a/a'), site('b', '/b'),
+                   site('b1', '/b/1', 'b/b'), site('c', '/c'), site('d', '/d')]
+        changes = [
+            # /a was updated, /b/1 renamed, /c deleted and /d/1 added
+            {'WebId': 'A', 'ChangeType': 2},
+            {'WebId': 'b1', 'ChangeType': 4},
+            {'WebId': 'c', 'ChangeType': 3},
+            {'WebId': 'd1', 'ChangeType': 1},
+            # The lists of /a/1 changed
+            {'WebId': 'a1', 'ListId': 'l1', 'ChangeType': 1}
+        ]
+        elements = {
+            'a': {'Id': 'a', 'ServerRelativeUrl': '/a', 'Title': 'new'},
+            'b1': {'Id': 'b1', 'ServerRelativeUrl': '/b/renamed'},
+            'd1': {'Id': 'd1', 'ServerRelativeUrl': '/d/1'}
+        }
+
+        mock_get_changed_web.side_effect = \
+            lambda base_url, auth, endpoint, web_id: elements[web_id]
+
+        def get_site_objects(base_url, auth, elements, parent_guid):
+            element = dict(elements[0], Guid=elements[0]['Id'] + elements[0]['ServerRelativeUrl'],
+                           ParentGuid=parent_guid)
+            return [(element, [])]
+
+        mock_get_site_objects.side_effect = get_site_objects
+        mock_get_sites_list.side_effect = lambda base_url, auth, endpoint, concurrency: \
+            [site('renamed1', endpoint + '/1')] if endpoint == '/b/renamed' else []
+        mock_get_doc_libs_batch.return_value = [['lib']]
+
+        result = action.apply_changes('https://test.com', 'user', '', records, changes)
+
+        self.assertEqual([record['ServerRelativeUrl'] for record in result],
+                         ['/a', '/a/1', '/b', '/b/renamed', '/b/renamed/1', '/d', '/d/1'])
+        self.assertEqual(result[0]['Title'], 'new')
+        self.assertEqual(result[1]['DocLibs'], ['lib'])
+        self.assertEqual(result[3]['ParentGuid'], 'b/b')
+        self.assertEqual(result[6]['ParentGuid'], 'd/d')
+        # Deleted webs aren't looked up and only moved or new webs are crawled
+        self.assertEqual(sorted(call[0][3] for call in mock_get_changed_web.call_args_list),
+                         ['a', 'b1', 'd1'])
+        self.assertEqual(sorted(call[0][2] for call in mock_get_sites_list.call_args_list),
+                         ['/b/renamed', '/d/1'])
+        mock_get_doc_libs_batch.assert_called_with('https://test.com',
+                                                   ['https://test.com/a/1'], 'user')
+
+    @mock.patch('lib.base_action.SharepointBaseAction.get_doc_libs_batch')
+    @mock.patch('subsites_list.SubsitesList.get_subtree')
+    @mock.patch('subsites_list.SubsitesList.get_changed_web')
+    def test_apply_changes_nested(self, mock_get_changed_web, mock_get_subtree,
+                                  mock_get_doc_libs_batch):
+        action = self.get_action_instance({})
+
+        records = [{'Id': 'a', 'ServerRelativeUrl': '/a', 'Guid': 'a/a'}]
+        changes = [
+            {'WebId': 'a11', 'ChangeType': 1},
+            {'WebId': 'a1', 'ChangeType': 1},
+            {'WebId': 'a11', 'ListId': 'l1', 'ChangeType': 1}
+        ]
+        elements = {'a1': {'Id': 'a1', 'ServerRelativeUrl': '/a/1'},
+                    'a11': {'Id': 'a11', 'ServerRelativeUrl': '/a/1/1'}}
+        mock_get_changed_web.side_effect = \
+            lambda base_url, auth, endpoint, web_id: elements[web_id]
+        mock_get_subtree.return_value = [elements['a1'], elements['a11']]
+        mock_get_doc_libs_batch.return_value = []
+
+        result = action.apply_changes('https://test.com', 'user', '', records, changes)
+
+        self.assertEqual([record['Id'] for record in result], ['a', 'a1', 'a11'])
+        # The new web inside of the new subtree is fetched with it
+        mock_get_subtree.assert_called_once_with('https://test.com', 'user', elements['a1'],
+                                                 'a/a', 10)
+        mock_get_doc_libs_batch.assert_called_with('https://test.com', [], 'user')
+
+    @mock.patch('subsites_list.SubsitesList.apply_changes')
+    @mock.patch('subsites_list.SubsitesList.get_changes')
+    @mock.patch('subsites_list.SubsitesList.iter_sites_list')
+    @mock.patch('subsites_list.SubsitesList.get_change_token')
+    def test_iter_sites_delta(self, mock_get_change_token, mock_iter_sites_list,
+                              mock_get_changes, mock_apply_changes):
+        action = self.get_action_instance({})
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        checkpoint_file = os.path.join(temp_dir, 'checkpoint.json')
+
+        # The first run crawls every subsite
+        mock_get_change_token.return_value = '1'
+        mock_iter_sites_list.return_value = iter([{'Id': 'a'}, {'Id': 'b'}])
+
+        result = list(action.iter_sites_delta('https://test.com', 'user', '/endp',
+                                              checkpoint_file, 5))
+
+        self.assertEqual(result, [{'Id': 'a'}, {'Id': 'b'}])
+        mock_iter_sites_list.assert_called_with('https://test.com', 'user', '/endp', 5)
+        mock_get_changes.assert_not_called()
+
+        # Later runs apply the changes since the saved token
+        mock_get_change_token.return_value = '2'
+        mock_get_changes.return_value = ['change']
+        mock_apply_changes.return_value = [{'Id': 'a'}]
+
+        result = list(action.iter_sites_delta('https://test.com', 'user', '/endp',
+                                              checkpoint_file, 5))
+
+        self.assertEqual(result, [{'Id': 'a'}])
+        mock_get_changes.assert_called_with('https://test.com', 'user', '/endp', '1', '2')
+        mock_apply_changes.assert_called_with('https://test.com', 'user', '/endp',
+                                              [{'Id': 'a'}, {'Id': 'b'}], ['change'], 5)
+        self.assertEqual(mock_iter_sites_list.call_count, 1)
+
+        # A token SharePoint no longer has changes for falls back to a full crawl
+        mock_get_change_token.return_value = '3'
+        mock_get_changes.side_effect = requests.HTTPError()
+        mock_iter_sites_list.return_value = iter([{'Id': 'c'}])
+
+        result = list(action.iter_sites_delta('https://test.com', 'user', '/endp',
+                                              checkpoint_file, 5))
+
+        self.assertEqual(result, [{'Id': 'c'}])
+        self.assertEqual(mock_iter_sites_list.call_count, 2)
+        mock_get_changes.assert_called_with('https://test.com', 'user', '/endp', '2', '3')
+
+    @mock.patch('subsites_list.SubsitesList.iter_sites_delta')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run_delta(self, mock_auth, mock_iter_sites_delta):
+        action = self.get_action_instance({})
+
+        mock_auth.return_value = 'auth'
+        mock_iter_sites_delta.return_value = iter(['result'])
+
+        result = action.run('https://test.com/', 'dom', 'endp1', None, False, 'console',
+                            'pass', 'user', False, None, None, None, None, 4, 'json',
+                            '/path/to/checkpoint.json')
+
+        self.assertEqual(result, ['result'])
+        mock_iter_sites_delta.assert_called_with('https://test.com/', 'auth', 'endp1',
+                                                 '/path/to/checkpoint.json', 4)
+
+    @mock.patch('subsites_list.SubsitesList.run_resumable')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run_resume_from(self, mock_auth, mock_run_resumable):
+        action = self.get_action_instance({})
+
+        mock_auth.return_value = 'auth'
+        mock_run_resumable.return_value = ['result']
+
+        result = action.run('https://test.com/', 'dom', 'endp1', '/path/to/out.json', True,
+                            'file', 'pass', 'user', False, None, None, None, None, 4, 'json',
+                            resume_from='/path/to/resume.json')
+
+        self.assertEqual(result, ['result'])
+        mock_run_resumable.assert_called_with('https://test.com/', 'auth', 'endp1',
+                                              '/path/to/resume.json', '/path/to/out.json',
+                                              True, 'file', 'json', 4)
+
+        # Delta crawls keep their own checkpoint
+        with self.assertRaises(ValueError):
+            action.run('https://test.com/', 'dom', 'endp1', None, False, 'console', 'pass',
+                       'user', False, None, None, None, None, 4, 'json',
+                       '/path/to/checkpoint.json', resume_from='/path/to/resume.json')
+
+    @mock.patch('subsites_list.SubsitesList.iter_sites_list')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run_use_cache(self, mock_auth, mock_iter_sites_list):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        cache_file = os.path.join(temp_dir, 'site_tree.sqlite')
+        action = self.get_action_instance({'site_tree_cache_file': cache_file})
+        mock_auth.return_value = 'auth'
+        mock_iter_sites_list.side_effect = lambda *args: iter(['crawled'])
+
+        # Nothing cached yet so SharePoint is crawled
+        result = action.run('https://test.com/', 'dom', '/endp', None, False, 'console',
+                            'pass', 'user', False, None, None, None, None, use_cache=True)
+
+        self.assertEqual(result, ['crawled'])
+
+        site = {'Guid': 'a/sites/endp/a', 'SiteUrl': 'https://test.com/endp/a',
+                'DocLibs': []}
+        SiteTreeCache(cache_file).save_tree(site_tree_key('https://test.com', '/endp'),
+                                            'https://test.com', '/endp', [site])
+        mock_auth.reset_mock()
+
+        result = action.run('https://test.com/', 'dom', '/endp/', None, False, 'console',
+                            'pass', 'user', False, None, None, None, None, use_cache=True)
+
+        self.assertEqual(result, [site])
+        mock_auth.assert_not_called()
+        self.assertEqual(mock_iter_sites_list.call_count, 1)
+
+        # Trees saved with other fields or too long ago aren't used
+        action.run('https://test.com/', 'dom', '/endp', None, False, 'console', 'pass',
+                   'user', False, None, None, None, None, fields=['Title'], use_cache=True)
+        action.run('https://test.com/', 'dom', '/endp', None, False, 'console', 'pass',
+                   'user', False, None, None, None, None, use_cache=True, max_staleness=-1)
+
+        self.assertEqual(mock_iter_sites_list.call_count, 3)
+
+    @mock.patch('subsites_list.SubsitesList.iter_sites_list')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run_fields(self, mock_auth, mock_iter_sites_list):
+        action = self.get_action_instance({})
+        mock_iter_sites_list.return_value = iter([])
+
+        action.run('https://test.com/', 'dom', 'endp1', None, False, 'console', 'pass',
+                   'user', False, None, None, None, None, fields=[' Title ', '', 'Url'])
+
+        self.assertEqual(action.fields, ['Title', 'Url'])
+
+    @mock.patch('subsites_list.SubsitesList.iter_sites_list')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run_metrics(self, mock_auth, mock_iter_sites_list):
+        action = self.get_action_instance({})
+        mock_iter_sites_list.return_value = iter(['site'])
+        action.metrics.record('https://test.com/_api/web/getsubwebsfilteredforcurrentuser',
+                              200, 10, 0.1)
+
+        result = action.run('https://test.com/', 'dom', 'endp1', None, False, 'console',
+                            'pass', 'user', False, None, None, None, None, metrics=True)
+
+        self.assertEqual(result['result'], ['site'])
+        self.assertEqual(result['_metrics']['endpoints']['subwebs']['requests'], 1)
+
+    @mock.patch('subsites_list.SubsitesList.iter_sites_list')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run(self, mock_auth, mock_iter_sites_list):
         action = self.get_action_instance({})
         action.token_auth = False
 
@@ -165,7 +881,7 @@ class SharepointSubsitesListTest(SharePointBaseActionTestCase):
         expected_result = ['result']
 
         mock_auth.return_value = test_auth
-        mock_get_sites_list.return_value = expected_result
+        mock_iter_sites_list.return_value = expected_result
 
         result = action.run(test_base_url, test_domain, test_endpoint, test_output_file,
                             test_output_file_append, test_output_type, test_pass, test_user, False,
@@ -173,12 +889,13 @@ class SharepointSubsitesListTest(SharePointBaseActionTestCase):
                             test_client_id)
 
         self.assertEqual(result, expected_result)
-        mock_auth.assert_called_with(test_domain, test_user, test_pass)
-        mock_get_sites_list.assert_called_with(test_base_url, test_auth, test_endpoint)
+        self.assert_auth_params(mock_auth, domain=test_domain, username=test_user,
+                                password=test_pass)
+        mock_iter_sites_list.assert_called_with(test_base_url, test_auth, test_endpoint, 10)
 
-    @mock.patch('subsites_list.SubsitesList.get_sites_list')
-    @mock.patch('lib.base_action.SharepointBaseAction.create_token_auth_cred')
-    def test_run_token(self, mock_auth, mock_get_sites_list):
+    @mock.patch('subsites_list.SubsitesList.iter_sites_list')
+    @mock.patch('lib.auth.CertificateBackend.create_credential')
+    def test_run_token(self, mock_auth, mock_iter_sites_list):
         action = self.get_action_instance({})
         action.token_auth = False
 
@@ -199,7 +916,7 @@ class SharepointSubsitesListTest(SharePointBaseActionTestCase):
         expected_result = ['result']
 
         mock_auth.return_value = test_auth
-        mock_get_sites_list.return_value = expected_result
+        mock_iter_sites_list.return_value = expected_result
 
         result = action.run(test_base_url, test_domain, test_endpoint, test_output_file,
                             test_output_file_append, test_output_type, test_pass, test_user, True,
@@ -207,17 +924,15 @@ class SharepointSubsitesListTest(SharePointBaseActionTestCase):
                             test_client_id)
 
         self.assertEqual(result, expected_result)
-        mock_auth.assert_called_with(test_rsa_private_key,
-                                     test_cert_thumbprint,
-                                     test_tenent_id,
-                                     test_client_id,
-                                     test_base_url)
-        mock_get_sites_list.assert_called_with(test_base_url, test_auth, test_endpoint)
+        self.assert_auth_params(mock_auth, rsa_private_key=test_rsa_private_key,
+                                cert_thumbprint=test_cert_thumbprint, tenent_id=test_tenent_id,
+                                client_id=test_client_id, site_url=test_base_url)
+        mock_iter_sites_list.assert_called_with(test_base_url, test_auth, test_endpoint, 10)
 
-    @mock.patch('subsites_list.SubsitesList.get_sites_list')
-    @mock.patch('lib.base_action.SharepointBaseAction.create_ntlm_auth_cred')
+    @mock.patch('subsites_list.SubsitesList.iter_sites_list')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
     @mock.patch('lib.base_action.SharepointBaseAction.save_sites_list_to_file')
-    def test_run_file(self, mock_save, mock_auth, mock_get_sites_list):
+    def test_run_file(self, mock_save, mock_auth, mock_iter_sites_list):
         action = self.get_action_instance({})
         action.token_auth = False
 
@@ -239,7 +954,7 @@ class SharepointSubsitesListTest(SharePointBaseActionTestCase):
         expected_result = 'result'
 
         mock_auth.return_value = test_auth
-        mock_get_sites_list.return_value = test_sites
+        mock_iter_sites_list.return_value = test_sites
         mock_save.return_value = expected_result
 
         result = action.run(test_base_url, test_domain, test_endpoint, test_output_file,
@@ -248,6 +963,8 @@ class SharepointSubsitesListTest(SharePointBaseActionTestCase):
                             test_client_id)
 
         self.assertEqual(result, expected_result)
-        mock_auth.assert_called_with(test_domain, test_user, test_pass)
-        mock_get_sites_list.assert_called_with(test_base_url, test_auth, test_endpoint)
-        mock_save.assert_called_with(test_sites, test_output_file, test_output_file_append)
+        self.assert_auth_params(mock_auth, domain=test_domain, username=test_user,
+                                password=test_pass)
+        mock_iter_sites_list.assert_called_with(test_base_url, test_auth, test_endpoint, 10)
+        mock_save.assert_called_with(test_sites, test_output_file, test_output_file_append,
+                                     'json')
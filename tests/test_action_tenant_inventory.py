@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from test_action_lib_base_action import SharePointBaseActionTestCase
+from tenant_inventory import TenantInventory
+from subsites_list import SubsitesList
+from lib.odata_batch import BatchResponse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import mock
+
+
+def site(url):
+    return {'SiteUrl': url, 'Guid': url, 'ParentGuid': None}
+
+
+class SharepointTenantInventoryTest(SharePointBaseActionTestCase):
+    __test__ = True
+    action_cls = TenantInventory
+
+    def test_init(self):
+        action = self.get_action_instance({})
+        self.assertIsInstance(action, TenantInventory)
+
+    def test_iter_site_chunks(self):
+        action = self.get_action_instance({'batch_size': 2})
+        sites = [site('https://a.com/1'), site('https://a.com/2'), site('https://a.com/3'),
+                 site('https://B.com/1'), site('https://a.com/4')]
+
+        chunks = list(action.iter_site_chunks(iter(sites)))
+
+        # Chunks hold up to batch_size sites on the same host
+        self.assertEqual(chunks, [sites[:2], sites[2:3], sites[3:4], sites[4:]])
+
+    def test_create_shared_action(self):
+        action = self.get_action_instance({})
+        action.token_auth = True
+        action.fields = ['Title']
+
+        subsites = action.create_shared_action(SubsitesList)
+
+        self.assertIsInstance(subsites, SubsitesList)
+        self.assertTrue(subsites.token_auth)
+        self.assertEqual(subsites.fields, ['Title'])
+        for name in ['sessions', 'sessions_lock', 'limiter', 'metrics', 'memo']:
+            self.assertIsNotNone(getattr(subsites, name))
+            self.assertIs(getattr(subsites, name), getattr(action, name))
+
+    @mock.patch('subsites_list.SubsitesList.get_site_objects')
+    @mock.patch('lib.base_action.SharepointBaseAction.batch_request')
+    def test_iter_chunk(self, mock_batch_request, mock_get_site_objects):
+        action = self.get_action_instance({'batch_size': 4})
+        subsites = action.create_shared_action(SubsitesList)
+        sites = [site('https://test.com/sites/a'), site('https://test.com/sites/b'),
+                 site('https://test.com/sites/c')]
+
+        tree = {'/sites/a/1': ['/sites/a/1/1'], '/sites/a/1/1': [], '/sites/c/1': []}
+
+        def get_site_objects(url, auth, elements, parent_guid):
+            results = []
+            for element in elements:
+                element['Guid'] = element['ServerRelativeUrl']
+                element['ParentGuid'] = parent_guid
+                results.append((element, [{'ServerRelativeUrl': sub} for sub in
+                                          tree[element['ServerRelativeUrl']]]))
+            return results
+
+        def subwebs(urls):
+            return BatchResponse('url', 200, {}, json.dumps(
+                {'d': {'results': [{'ServerRelativeUrl': url} for url in urls]}}))
+
+        mock_batch_request.return_value = [subwebs(['/sites/a/1']), subwebs([]),
+                                           subwebs(['/sites/c/1'])]
+        mock_get_site_objects.side_effect = get_site_objects
+
+        result = list(action.iter_chunk(subsites, 'user', sites, 2))
+
+        # Every site is followed by its own subsites
+        self.assertEqual([record['Guid'] for record in result],
+                         ['https://test.com/sites/a', '/sites/a/1', '/sites/a/1/1',
+                          'https://test.com/sites/b', 'https://test.com/sites/c',
+                          '/sites/c/1'])
+        self.assertEqual(result[1]['ParentGuid'], 'https://test.com/sites/a')
+        # The subwebs of every site in the chunk are requested together
+        mock_batch_request.assert_called_once_with(
+            'https://test.com',
+            [url + '/_api/web/getsubwebsfilteredforcurrentuser'
+                   '(nwebtemplatefilter=-1,nconfigurationfilter=0)'
+             for url in ['https://test.com/sites/a', 'https://test.com/sites/b',
+                         'https://test.com/sites/c']],
+            'user')
+
+    @mock.patch('tenant_inventory.TenantInventory.iter_chunk')
+    @mock.patch('sites_list.SitesList.iter_site_objects')
+    def test_iter_inventory(self, mock_iter_site_objects, mock_iter_chunk):
+        action = self.get_action_instance({'batch_size': 2})
+        sites = [site('https://test.com/1'), site('https://test.com/2'),
+                 site('https://test.com/3')]
+
+        mock_iter_site_objects.return_value = iter(sites)
+        mock_iter_chunk.side_effect = lambda subsites, auth, chunk, max_concurrency, executor: \
+            iter(chunk + [{'Guid': 'sub'}])
+
+        result = list(action.iter_inventory('https://test.com', 'user', ['url'], 5, 1))
+
+        self.assertEqual(result, sites[:2] + [{'Guid': 'sub'}] + sites[2:] +
+                         [{'Guid': 'sub'}])
+        executor = mock_iter_site_objects.call_args[0][5]
+        mock_iter_site_objects.assert_called_with('https://test.com', 'user', ['url'], 5, 1,
+                                                  executor)
+        # One subsite crawler shares the action's sessions for the whole inventory
+        crawlers = set(id(call[0][0]) for call in mock_iter_chunk.call_args_list)
+        self.assertEqual(len(crawlers), 1)
+        self.assertIs(mock_iter_chunk.call_args[0][0].sessions, action.sessions)
+        # Both stages run on the same workers
+        self.assertIsInstance(executor, ThreadPoolExecutor)
+        self.assertTrue(all(call[0][4] is executor for call in mock_iter_chunk.call_args_list))
+
+    @mock.patch('tenant_inventory.TenantInventory.iter_inventory')
+    @mock.patch('sites_list.SitesList.get_sites_list')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_run(self, mock_auth, mock_get_sites_list, mock_iter_inventory):
+        action = self.get_action_instance({})
+
+        mock_auth.return_value = 'auth'
+        mock_get_sites_list.return_value = ['site1', 'site2']
+        mock_iter_inventory.return_value = iter(['result'])
+
+        result = action.run('https://test.com/', 'dom', None, False, 'console', 'pass',
+                            'user', False, None, None, None, None,
+                            ['https://TEST.com/site1', 'https://test.com/site1/'], 4, 2,
+                            fields=[' Title '])
+
+        self.assertEqual(result, ['result'])
+        self.assertEqual(action.fields, ['Title'])
+        self.assert_auth_params(mock_auth, domain='dom', username='user', password='pass')
+        mock_get_sites_list.assert_called_with('https://test.com/', 'auth',
+                                               ['https://test.com/site1/'], 4, 500)
+        mock_iter_inventory.assert_called_with('https://test.com/', 'auth',
+                                               ['site1', 'site2'], 4, 2)
+
+    @mock.patch('tenant_inventory.TenantInventory.iter_inventory')
+    @mock.patch('sites_list.SitesList.get_sites_list')
+    @mock.patch('lib.base_action.SharepointBaseAction.save_sites_list_to_file')
+    @mock.patch('lib.auth.CertificateBackend.create_credential')
+    def test_run_file(self, mock_auth, mock_save, mock_get_sites_list, mock_iter_inventory):
+        action = self.get_action_instance({})
+
+        mock_auth.return_value = 'token'
+        mock_get_sites_list.return_value = ['site1']
+        mock_save.return_value = 'Output saved to: /path/to/out.ndjson'
+
+        result = action.run('https://test.com/', 'dom', '/path/to/out.ndjson', True, 'file',
+                            None, None, True, 'rsa', 'thumb', 'tenant', 'client', None,
+                            output_file_format='ndjson')
+
+        self.assertEqual(result, 'Output saved to: /path/to/out.ndjson')
+        self.assert_auth_params(mock_auth, rsa_private_key='rsa', cert_thumbprint='thumb',
+                                tenent_id='tenant', client_id='client',
+                                site_url='https://test.com/')
+        mock_save.assert_called_with(mock_iter_inventory.return_value, '/path/to/out.ndjson',
+                                     True, 'ndjson')
+
+    @mock.patch('tenant_inventory.TenantInventory.iter_inventory')
+    @mock.patch('sites_list.SitesList.get_sites_list')
+    @mock.patch('lib.base_action.write_metrics')
+    @mock.patch('lib.auth.BearerBackend.create_credential')
+    def test_run_metrics_file(self, mock_auth, mock_write_metrics, mock_get_sites_list,
+                              mock_iter_inventory):
+        action = self.get_action_instance({})
+
+        mock_get_sites_list.return_value = []
+        mock_iter_inventory.return_value = iter([])
+
+        action.run('https://test.com/', None, None, False, 'console', None, None, False,
+                   None, None, None, None, None, metrics_file='/path/to/metrics',
+                   access_token='token')
+
+        # The metrics are labelled with this action, not sites_list
+        mock_write_metrics.assert_called_with(action.metrics, '/path/to/metrics',
+                                              'prometheus', 'tenant_inventory')
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from st2tests.base import BaseSensorTestCase
+from site_tree_sensor import SiteTreeSensor
+from lib.site_cache import SiteTreeCache, site_tree_key
+import mock
+import os
+import shutil
+import tempfile
+import time
+
+
+class SiteTreeSensorTestCase(BaseSensorTestCase):
+    sensor_cls = SiteTreeSensor
+
+    def setUp(self):
+        super(SiteTreeSensorTestCase, self).setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.cache_file = os.path.join(temp_dir, 'site_tree.sqlite')
+        self.config = {'site_tree_cache_file': self.cache_file,
+                       'site_tree_sensor': {'base_url': 'https://test.com',
+                                            'endpoints': ['/a'],
+                                            'domain': 'dom',
+                                            'username': 'user',
+                                            'password': 'pass',
+                                            'max_concurrency': 4}}
+
+    def get_sensor(self, config=None):
+        sensor = self.get_sensor_instance(config=config or self.config)
+        sensor.setup()
+        return sensor
+
+    def test_poll_no_base_url(self):
+        sensor = self.get_sensor({'site_tree_cache_file': self.cache_file})
+
+        with mock.patch.object(sensor, 'refresh_tree') as mock_refresh_tree:
+            sensor.poll()
+
+        mock_refresh_tree.assert_not_called()
+
+    def test_poll_error(self):
+        config = dict(self.config)
+        config['site_tree_sensor'] = dict(self.config['site_tree_sensor'],
+                                          endpoints=['/a', '/b'])
+        sensor = self.get_sensor(config)
+
+        with mock.patch.object(sensor, 'refresh_tree') as mock_refresh_tree:
+            mock_refresh_tree.side_effect = [ValueError('failed'), None]
+            sensor.poll()
+
+        mock_refresh_tree.assert_has_calls([mock.call('https://test.com', '/a'),
+                                            mock.call('https://test.com', '/b')])
+
+    @mock.patch('subsites_list.SubsitesList.iter_sites_list')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_poll(self, mock_auth, mock_iter_sites_list):
+        sensor = self.get_sensor()
+        mock_auth.return_value = 'auth'
+        web_a = {'Guid': 'a', 'SiteUrl': 'https://test.com/a/1', 'DocLibs': [{'Id': '1'}]}
+        web_b = {'Guid': 'b', 'SiteUrl': 'https://test.com/a/2', 'DocLibs': []}
+        mock_iter_sites_list.return_value = iter([web_a, web_b])
+
+        # The first crawl fills the cache without dispatching every web
+        sensor.poll()
+
+        cache = SiteTreeCache(self.cache_file)
+        self.assertEqual(cache.load_tree(site_tree_key('https://test.com', '/a')),
+                         [web_a, web_b])
+        self.assertEqual(self.get_dispatched_triggers(), [])
+        self.assertEqual(mock_auth.call_args[0][1]['domain'], 'dom')
+        self.assertEqual(mock_auth.call_args[0][1]['username'], 'user')
+        self.assertEqual(mock_auth.call_args[0][1]['password'], 'pass')
+        mock_iter_sites_list.assert_called_with('https://test.com', 'auth', '/a', 4)
+
+        web_a2 = dict(web_a, DocLibs=[{'Id': '2'}])
+        web_c = {'Guid': 'c', 'SiteUrl': 'https://test.com/a/3', 'DocLibs': []}
+        mock_iter_sites_list.return_value = iter([web_a2, web_c])
+
+        sensor.poll()
+
+        self.assertEqual(len(self.get_dispatched_triggers()), 4)
+        base = {'base_url': 'https://test.com', 'endpoint': '/a'}
+        self.assertTriggerDispatched('sharepoint.web_added', dict(base, web=web_c))
+        self.assertTriggerDispatched('sharepoint.web_removed', dict(base, web=web_b))
+        self.assertTriggerDispatched('sharepoint.doc_lib_added', dict(
+            base, site_url='https://test.com/a/1', web_guid='a', doc_lib={'Id': '2'}))
+        self.assertTriggerDispatched('sharepoint.doc_lib_removed', dict(
+            base, site_url='https://test.com/a/1', web_guid='a', doc_lib={'Id': '1'}))
+
+    @mock.patch('subsites_list.SubsitesList.iter_sites_delta')
+    @mock.patch('lib.auth.CertificateBackend.create_credential')
+    def test_refresh_tree_delta(self, mock_auth, mock_iter_sites_delta):
+        config = dict(self.config)
+        config['site_tree_sensor'] = {'base_url': 'https://test.com',
+                                      'token_auth': True,
+                                      'rsa_private_key': 'rsa',
+                                      'cert_thumbprint': 'thumb',
+                                      'tenent_id': 'tenant',
+                                      'client_id': 'client',
+                                      'fields': ['Title'],
+                                      'delta_checkpoint_file': '/path/to/checkpoint.json'}
+        sensor = self.get_sensor(config)
+        mock_auth.return_value = 'token'
+        mock_iter_sites_delta.return_value = iter([])
+
+        sensor.refresh_tree('https://test.com', '')
+
+        self.assertEqual(mock_auth.call_args[0][1]['client_id'], 'client')
+        self.assertEqual(mock_auth.call_args[0][1]['site_url'], 'https://test.com')
+        mock_iter_sites_delta.assert_called_with('https://test.com', 'token', '',
+                                                 '/path/to/checkpoint.json', 10)
+        cache = SiteTreeCache(self.cache_file)
+        self.assertEqual(cache.load_tree(site_tree_key('https://test.com', '', ['Title'])),
+                         [])
+
+    @mock.patch('subsites_list.SubsitesList.iter_sites_list')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_poll_refresh_interval(self, mock_auth, mock_iter_sites_list):
+        config = dict(self.config)
+        config['site_tree_sensor'] = dict(self.config['site_tree_sensor'],
+                                          refresh_interval=3600)
+        sensor = self.get_sensor(config)
+        mock_iter_sites_list.side_effect = lambda *args: iter([])
+
+        sensor.poll()
+        sensor.poll()
+
+        self.assertEqual(mock_iter_sites_list.call_count, 1)
+
+        # Trees older than the interval are crawled again
+        sensor.sensor_config['refresh_interval'] = -1
+        sensor.poll()
+
+        self.assertEqual(mock_iter_sites_list.call_count, 2)
+
+    @mock.patch('doc_lib_list.DocLibList.iter_doc_libs')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_refresh_dirty(self, mock_auth, mock_iter_doc_libs):
+        sensor = self.get_sensor()
+        mock_auth.return_value = 'auth'
+        web_a = {'Guid': 'a', 'SiteUrl': 'https://test.com/a/1', 'DocLibs': [{'Id': '1'}]}
+        web_b = {'Guid': 'b', 'SiteUrl': 'https://test.com/a/2', 'DocLibs': []}
+        cache = SiteTreeCache(self.cache_file)
+        key = site_tree_key('https://test.com', '/a')
+        cache.save_tree(key, 'https://test.com', '/a', [web_a, web_b])
+
+        # Nothing is requested while no web is dirty
+        sensor.refresh_dirty()
+
+        mock_iter_doc_libs.assert_not_called()
+
+        cache.mark_dirty('https://test.com/a/1', 'list2')
+        cache.mark_dirty('https://test.com/a/2', 'list3')
+        cache.mark_dirty('https://test.com/gone', 'list4')
+        mock_iter_doc_libs.return_value = iter([
+            {'SiteUrl': 'https://test.com/a/1', 'DocLibs': [{'Id': '1'}, {'Id': '2'}]},
+            {'SiteUrl': 'https://test.com/a/2', 'Error': 'refused'}])
+
+        sensor.refresh_dirty()
+
+        # Only the dirty webs that are cached are requested, a web that failed stays dirty
+        mock_iter_doc_libs.assert_called_with(['https://test.com/a/1', 'https://test.com/a/2'],
+                                              'auth', 4)
+        self.assertEqual([mark['url'] for mark in cache.get_dirty()], ['https://test.com/a/2'])
+        web_a2 = dict(web_a, DocLibs=[{'Id': '1'}, {'Id': '2'}])
+        self.assertTriggerDispatched('sharepoint.doc_lib_added', {
+            'base_url': 'https://test.com', 'endpoint': '/a',
+            'site_url': 'https://test.com/a/1', 'web_guid': 'a', 'doc_lib': {'Id': '2'}})
+        self.assertEqual(len(self.get_dispatched_triggers()), 1)
+
+        cache.clear_dirty('https://test.com/a/2', time.time())
+        self.assertEqual(cache.load_tree(key), [web_a2, web_b])
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# Copyright 2022 Encore Technologies
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from st2tests.base import BaseSensorTestCase
+from webhook_sensor import WebhookSensor, subscription_key
+from doc_lib_list import DocLibList
+from lib.json_store import JsonStore
+from lib.site_cache import SiteTreeCache
+import mock
+import os
+import requests
+import shutil
+import tempfile
+import time
+
+
+class WebhookSensorTestCase(BaseSensorTestCase):
+    sensor_cls = WebhookSensor
+
+    def setUp(self):
+        super(WebhookSensorTestCase, self).setUp()
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        self.cache_file = os.path.join(temp_dir, 'site_tree.sqlite')
+        self.subscriptions_file = os.path.join(temp_dir, 'webhooks.json')
+        self.config = {'site_tree_cache_file': self.cache_file,
+                       'site_tree_sensor': {'base_url': 'https://test.com',
+                                            'domain': 'dom',
+                                            'username': 'user',
+                                            'password': 'pass'},
+                       'webhook_sensor': {'notification_url': 'https://hooks.test.com/hook',
+                                          'listen_host': '127.0.0.1',
+                                          'listen_port': 0,
+                                          'client_state': 'state',
+                                          'site_urls': ['https://test.com/a',
+                                                        'https://test.com/b'],
+                                          'subscriptions_file': self.subscriptions_file,
+                                          'max_concurrency': 4}}
+
+    def get_sensor(self, config=None):
+        sensor = self.get_sensor_instance(config=config or self.config)
+        sensor.setup()
+        self.addCleanup(sensor.cleanup)
+        return sensor
+
+    def save_subscription(self, site_url, list_id, subscription_id, expires_at):
+        JsonStore(self.subscriptions_file).save(
+            subscription_key(site_url, list_id),
+            {'site_url': site_url, 'list_id': list_id, 'subscription_id': subscription_id,
+             'expires_at': expires_at})
+
+    def test_setup_cleanup(self):
+        sensor = self.get_sensor()
+        url = 'http://127.0.0.1:{0}/hook'.format(sensor.server.server_address[1])
+
+        response = requests.post(url + '?validationtoken=token')
+
+        self.assertEqual(response.text, 'token')
+
+        sensor.cleanup()
+        self.assertIsNone(sensor.server)
+
+    def test_poll_no_notification_url(self):
+        config = dict(self.config, webhook_sensor={'listen_host': '127.0.0.1',
+                                                   'listen_port': 0})
+        sensor = self.get_sensor(config)
+
+        with mock.patch.object(sensor, 'sync_subscriptions') as mock_sync:
+            sensor.poll()
+
+        mock_sync.assert_not_called()
+
+    def test_get_site_urls(self):
+        config = dict(self.config, webhook_sensor=dict(self.config['webhook_sensor'],
+                                                       site_urls=[]))
+        SiteTreeCache(self.cache_file).save_tree('key', 'https://test.com', '', [
+            {'Guid': 'c', 'SiteUrl': 'https://test.com/c', 'DocLibs': []}])
+        sensor = self.get_sensor(config)
+
+        self.assertEqual(sensor.get_site_urls(), ['https://test.com/c'])
+
+    @mock.patch('webhook_sensor.delete_subscription')
+    @mock.patch('webhook_sensor.update_subscription')
+    @mock.patch('webhook_sensor.create_subscription')
+    @mock.patch('doc_lib_list.DocLibList.iter_doc_libs')
+    @mock.patch('lib.auth.NtlmBackend.create_credential')
+    def test_sync_subscriptions(self, mock_auth, mock_iter_doc_libs, mock_create,
+                                mock_update, mock_delete):
+        sensor = self.get_sensor()
+        mock_auth.return_value = 'auth'
+        now = time.time()
+        # Fresh, expiring, deleted library, failed site and unwatched site subscriptions
+        self.save_subscription('https://test.com/a', 'list1', 'sub1', now + 100 * 86400)
+        self.save_subscription('https://test.com/a', 'list2', 'sub2', now + 86400)
+        self.save_subscription('https://test.com/a', 'list3', 'sub3', now + 100 * 86400)
+        self.save_subscription('https://test.com/b', 'list4', 'sub4', now + 100 * 86400)
+        self.save_subscription('https://test.com/c', 'list5', 'sub5', now + 100 * 86400)
+        mock_iter_doc_libs.return_value = iter([
+            {'SiteUrl': 'https://test.com/a',
+             'DocLibs': [{'Id': 'list1'}, {'Id': 'list2'}, {'Id': 'list6'}]},
+            {'SiteUrl': 'https://test.com/b', 'Error': 'refused'}])
+        mock_create.return_value = {'id': 'sub6', 'expirationDateTime': '2030-01-01T00:00:00Z'}
+
+        sensor.sync_subscriptions()
+
+        mock_iter_doc_libs.assert_called_with(['https://test.com/a', 'https://test.com/b'],
+                                              'auth', 4)
+        mock_create.assert_called_once_with(mock.ANY, 'https://test.com/a', 'list6',
+                                            'https://hooks.test.com/hook', mock.ANY, 'auth',
+                                            'state')
+        mock_update.assert_called_once_with(mock.ANY, 'https://test.com/a', 'list2', 'sub2',
+                                            mock.ANY, 'auth')
+        mock_delete.assert_has_calls([
+            mock.call(mock.ANY, 'https://test.com/a', 'list3', 'sub3', 'auth'),
+            mock.call(mock.ANY, 'https://test.com/c', 'list5', 'sub5', 'auth')],
+            any_order=True)
+        self.assertEqual(mock_delete.call_count, 2)
+
+        entries = JsonStore(self.subscriptions_file).read_entries()
+        self.assertEqual(sorted(entry['subscription_id'] for entry in entries.values()),
+                         ['sub1', 'sub2', 'sub4', 'sub6'])
+        self.assertEqual(entries[subscription_key('https://test.com/a', 'list6')]['expires_at'],
+                         1893456000)
+        self.assertGreater(entries[subscription_key('https://test.com/a', 'list2')]
+                           ['expires_at'], now + 89 * 86400)
+
+    @mock.patch('webhook_sensor.update_subscription')
+    @mock.patch('webhook_sensor.create_subscription')
+    def test_subscribe_renew_failed(self, mock_create, mock_update):
+        sensor = self.get_sensor()
+        self.save_subscription('https://test.com/a', 'list1', 'sub1', 0)
+        key = subscription_key('https://test.com/a', 'list1')
+        entry = JsonStore(self.subscriptions_file).load(key)
+        mock_update.side_effect = requests.HTTPError()
+        mock_create.return_value = {'id': 'sub2', 'expirationDateTime': '2030-01-01T00:00:00Z'}
+
+        sensor.subscribe(DocLibList({}), 'auth', key, 'https://test.com/a', 'list1', entry)
+
+        self.assertEqual(JsonStore(self.subscriptions_file).load(key)['subscription_id'],
+                         'sub2')
+
+    def test_handle_notifications(self):
+        sensor = self.get_sensor()
+        self.save_subscription('https://test.com/a', 'list1', 'SUB1', 0)
+
+        sensor.handle_notifications([
+            {'subscriptionId': 'sub1', 'clientState': 'state', 'resource': 'list1'},
+            {'subscriptionId': 'sub1', 'clientState': 'forged', 'resource': 'list1'},
+            {'subscriptionId': 'unknown', 'clientState': 'state', 'resource': 'list2'}])
+
+        dirty = SiteTreeCache(self.cache_file).get_dirty()
+        self.assertEqual([(mark['url'], mark['list_id']) for mark in dirty],
+                         [('https://test.com/a', 'list1')])
+        self.assertEqual(self.get_dispatched_triggers(), [{
+            'trigger': 'sharepoint.doc_lib_changed',
+            'payload': {'site_url': 'https://test.com/a', 'list_id': 'list1',
+                        'subscription_id': 'SUB1'}}])